@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""Time the command line script, and check it holds up to many invocations at once. These don't need
+Django; the website's suites are in "manage.py benchmark"."""
+import argparse
+import concurrent.futures
+import http.server
+import json
+import logging
+import os
+import pathlib
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+if __package__:
+  from . import worktime
+else:
+  import worktime
+
+SUITES = ('web', 'startup', 'files')
+WEB_COMMANDS = ('status', 'switch', 'adjust')
+# The most time each command line invocation may take with local data (the text files, or the
+# SQLite database with -d), in milliseconds beyond what it takes to start a bare Python interpreter.
+STARTUP_BUDGETS = {'w':75, 'status':75, '-d w':90, '-d status':90}
+
+
+def make_argparser():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('suite', choices=SUITES,
+    help='web: Time the --web client\'s commands against a local stand-in server, with a new '
+         'client for each (like separate invocations) and with one reused client. startup: Time '
+         'running the command line script with the text files and with the SQLite database (in a '
+         'temporary data directory), and check it against the budget. files: Make switches and '
+         'adjustments from many processes at once with the file backend, and check that none '
+         'were lost.')
+  parser.add_argument('-r', '--repeat', type=int, default=5,
+    help='Run each test this many times and report the fastest. Default: %(default)s')
+  parser.add_argument('-s', '--seed', type=int, default=1,
+    help='Random seed. Default: %(default)s')
+  parser.add_argument('-d', '--connect-delay', type=float, default=50,
+    help='For the web suite, make the stand-in server take this many milliseconds to accept '
+         'each new connection, to stand in for TCP and TLS handshakes over the internet. '
+         'Default: %(default)s')
+  parser.add_argument('-i', '--importtime', action='store_true',
+    help='For the startup suite, also list the slowest modules each command imports.')
+  parser.add_argument('-w', '--workers', type=int, default=8,
+    help='For the files suite, how many processes to run at once. Default: %(default)s')
+  parser.add_argument('-o', '--operations', type=int, default=50,
+    help='For the files suite, how many changes each process makes. Default: %(default)s')
+  parser.add_argument('-x', '--speedup', type=float, default=1000,
+    help='For the files suite, run the clock this many times as fast as real time, so the '
+         'switches add up to more than a few seconds. Default: %(default)s')
+  return parser
+
+
+def main(argv):
+
+  parser = make_argparser()
+  args = parser.parse_args(argv[1:])
+
+  logging.basicConfig(stream=sys.stderr, level=logging.WARNING, format='%(message)s')
+
+  if args.suite == 'web':
+    bench_web(args)
+  elif args.suite == 'startup':
+    bench_startup(args)
+  elif args.suite == 'files':
+    bench_files(args)
+
+
+def bench_web(args):
+  server = StandInServer(args.connect_delay/1000)
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  url = 'http://{}:{}/worktime'.format(*server.server_address)
+  print('command\tclient\tms\trequests\tconnections')
+  try:
+    for command in WEB_COMMANDS:
+      for client in ('new', 'reused'):
+        work_times = worktime.WorkTimesWeb(api_endpoint=url, cookie='benchmark')
+        times = []
+        server.requests = server.connections = 0
+        for i in range(args.repeat):
+          if client == 'new':
+            work_times = worktime.WorkTimesWeb(api_endpoint=url, cookie='benchmark')
+          times.append(best_time(1, run_web_command, work_times, command))
+        print('{}\t{}\t{:0.1f}\t{:0.1f}\t{:0.1f}'.format(
+          command, client, min(times)*1000, server.requests/args.repeat,
+          server.connections/args.repeat
+        ))
+  finally:
+    server.shutdown()
+    server.server_close()
+
+
+def bench_startup(args):
+  script = pathlib.Path(worktime.__file__)
+  over_budget = []
+  with tempfile.TemporaryDirectory() as home:
+    # The script finds its data directory under $HOME.
+    data_dir = pathlib.Path(home) / worktime.DATA_DIR.relative_to(pathlib.Path.home())
+    data_dir.mkdir(parents=True)
+    env = dict(os.environ, HOME=home)
+    run_script(env, script, 'clear')
+    baseline = best_time(args.repeat, run_script, env, None)
+    print('command\tms\tover_python_ms\tbudget_ms')
+    for command, budget in STARTUP_BUDGETS.items():
+      elapsed = best_time(args.repeat, run_script, env, script, *command.split())
+      overhead = (elapsed - baseline) * 1000
+      print('{}\t{:0.1f}\t{:0.1f}\t{}'.format(command, elapsed*1000, overhead, budget))
+      if overhead > budget:
+        over_budget.append(command)
+      if args.importtime:
+        for name, microseconds in slowest_imports(env, script, *command.split()):
+          print('  {}\t{:0.1f}'.format(name, microseconds/1000))
+  if over_budget:
+    fail('Over the startup budget: {}'.format(', '.join(over_budget)))
+
+
+def bench_files(args):
+  with tempfile.TemporaryDirectory() as data_dir:
+    paths = {'log_path':pathlib.Path(data_dir, 'worklog.txt'),
+             'status_path':pathlib.Path(data_dir, 'workstatus.txt')}
+    start = time.perf_counter()
+    result = check_files(paths, args.workers, args.operations, args.seed,
+                         speedup=args.speedup)
+    elapsed = time.perf_counter() - start
+  switched, expected_switched, adjusted, expected_adjusted = result
+  n_operations = args.workers * args.operations
+  print('operations\tseconds\tper_s\tswitched_s\texpected_s\tadjusted_s\texpected_s')
+  print('{}\t{:0.2f}\t{:0.0f}\t{}\t{}\t{}\t{}'.format(
+    n_operations, elapsed, n_operations/elapsed, switched, expected_switched, adjusted,
+    expected_adjusted
+  ))
+  if switched != expected_switched or adjusted != expected_adjusted:
+    fail('Changes were lost.')
+
+
+def check_files(paths, workers, n_operations, seed, pause=0.1, speedup=1):
+  """Have `workers` processes each make `n_operations` changes to the file backend at `paths`, with
+  the clock running `speedup` times as fast as real time (so short pauses still add up to minutes).
+  Returns how much time was switched between 'w' and 'p' and how much should have been, then how
+  much was adjusted in 'n' and how much should have been."""
+  origin = time.time()
+  clock = make_clock(origin, speedup)
+  work_times = worktime.WorkTimesFiles(**paths)
+  work_times.set_status('w')
+  now = int(clock())
+  first_start = now - work_times.get_status(now=now)[1]
+  with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+    futures = [executor.submit(stress_files, paths, n_operations, seed+i, pause, speedup, origin)
+               for i in range(workers)]
+    adjustments = sum(future.result() for future in futures)
+  # Every switch was between 'w' and 'p', so their totals should add up to exactly the time from
+  # the first switch to the last.
+  now = int(clock())
+  mode, current_elapsed = work_times.get_status(now=now)
+  all_elapsed = work_times.get_all_elapsed()
+  switched = all_elapsed.get('w', 0) + all_elapsed.get('p', 0)
+  return switched, now - current_elapsed - first_start, all_elapsed.get('n', 0), adjustments*60
+
+
+def stress_files(paths, n_operations, seed, pause=0.1, speedup=1, origin=None):
+  """Make `n_operations` random switches between 'w' and 'p' and one-minute adjustments to 'n',
+  with the clock sped up like in check_files(). Returns how many adjustments were made."""
+  rng = random.Random(seed)
+  work_times = worktime.WorkTimesFiles(**paths)
+  adjustments = 0
+  real_time = time.time
+  if speedup != 1:
+    time.time = make_clock(origin, speedup)
+  try:
+    for i in range(n_operations):
+      if rng.random() < 0.25:
+        work_times.add_elapsed('n', 60)
+        adjustments += 1
+      else:
+        work_times.switch_mode(rng.choice(('w', 'p')))
+        # Let some time pass, so the switches have something to add up.
+        time.sleep(rng.random()*pause)
+  finally:
+    time.time = real_time
+  return adjustments
+
+
+def make_clock(origin, speedup, real_time=time.time):
+  """A replacement for time.time() which runs `speedup` times as fast, starting from `origin`.
+  Every process using it agrees on the time, since it's based on the same real clock."""
+  return lambda: origin + (real_time() - origin) * speedup
+
+
+def run_script(env, script, *arguments, python_args=()):
+  """Run the command line script (or just start Python, if `script` is None)."""
+  if script is None:
+    command = [sys.executable, *python_args, '-c', 'pass']
+  else:
+    command = [sys.executable, *python_args, str(script), *arguments]
+  return subprocess.run(command, env=env, check=True, stdout=subprocess.DEVNULL,
+                        stderr=subprocess.PIPE, universal_newlines=True)
+
+
+def slowest_imports(env, script, *arguments, limit=5):
+  """Use `python -X importtime` to find the top-level imports which took the longest.
+  Returns a list of (module, microseconds) tuples."""
+  result = run_script(env, script, *arguments, python_args=('-X', 'importtime'))
+  imports = []
+  for line in result.stderr.splitlines():
+    fields = line.split('|')
+    # Skip the header, and modules imported by other modules (their names are indented).
+    if len(fields) != 3 or not fields[1].strip().isdigit() or fields[2].startswith('  '):
+      continue
+    imports.append((fields[2].strip(), int(fields[1])))
+  imports.sort(key=lambda item: item[1], reverse=True)
+  return imports[:limit]
+
+
+def run_web_command(work_times, command):
+  # Don't let the client answer from the summary it already has.
+  work_times._summary = None
+  if command == 'switch':
+    work_times.switch_mode('w')
+  elif command == 'adjust':
+    worktime.adjust(work_times, ['p+20', 'w-5', 'n+10'])
+  worktime.make_report(work_times)
+
+
+class StandInServer(http.server.ThreadingHTTPServer):
+  """A server that answers the requests WorkTimesWeb makes with a fixed summary."""
+
+  def __init__(self, connect_delay):
+    super().__init__(('127.0.0.1', 0), StandInHandler)
+    self.connect_delay = connect_delay
+    self.requests = 0
+    self.connections = 0
+    self.summary = {'current_mode':'p', 'current_elapsed':600, 'era':'benchmark',
+                    'elapsed':[{'mode':'w', 'time':3600}, {'mode':'p', 'time':1200}]}
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  # Send each response in one packet, so delayed ACKs don't add to the timings.
+  wbufsize = -1
+  disable_nagle_algorithm = True
+
+  def setup(self):
+    super().setup()
+    self.server.connections += 1
+    time.sleep(self.server.connect_delay)
+
+  def do_GET(self):
+    self.server.requests += 1
+    self.send_json(self.server.summary)
+
+  def do_POST(self):
+    self.server.requests += 1
+    body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+    results = []
+    for operation in body['operations']:
+      if operation['type'] == 'switch':
+        results.append(['p', 600])
+      else:
+        results.append(None)
+    self.send_json({'results':results, 'summary':self.server.summary})
+
+  def send_json(self, data):
+    content = json.dumps(data).encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(content)))
+    self.end_headers()
+    self.wfile.write(content)
+
+  def log_message(self, format, *args):
+    pass
+
+
+def best_time(repeat, function, *args):
+  times = []
+  for i in range(repeat):
+    start = time.perf_counter()
+    function(*args)
+    times.append(time.perf_counter() - start)
+  return min(times)
+
+
+def fail(message):
+  logging.critical(message)
+  if __name__ == '__main__':
+    sys.exit(1)
+  else:
+    raise Exception('Unrecoverable error')
+
+
+if __name__ == '__main__':
+  try:
+    sys.exit(main(sys.argv))
+  except BrokenPipeError:
+    pass
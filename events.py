@@ -0,0 +1,76 @@
+import collections
+import logging
+import threading
+import time
+from django.conf import settings
+from django.utils.module_loading import import_string
+log = logging.getLogger(__name__)
+
+HEARTBEAT = 15
+BACKLOG = 50
+
+_broker = None
+
+
+def events_enabled():
+  """Whether to push change events to pages, as set by the WORKTIME_EVENTS setting. It's off by
+  default, and pages just poll for summaries (which is cheap, thanks to the ETags).
+  Each open stream ties up a worker for as long as it lasts, so only turn this on when serving
+  with an async or threaded server that can hold one per open page. And with more than one
+  process, also set WORKTIME_EVENT_BROKER (see get_broker())."""
+  return getattr(settings, 'WORKTIME_EVENTS', False)
+
+
+def get_broker():
+  """Get the process-wide broker for change events.
+  By default this is a `LocalBroker`, which only sees events published in the same process, so it
+  only works with a single worker process. When running multiple worker processes, set
+  WORKTIME_EVENT_BROKER to the dotted path of a class with the same `publish()` and `listen()`
+  methods (e.g. one backed by a shared message queue)."""
+  global _broker
+  if _broker is None:
+    broker_path = getattr(settings, 'WORKTIME_EVENT_BROKER', None)
+    if broker_path:
+      _broker = import_string(broker_path)()
+    else:
+      _broker = LocalBroker()
+  return _broker
+
+
+class LocalBroker(object):
+  """An in-process publish/subscribe channel for each user's change events.
+  The last `backlog` events for each user are kept, so a client that reconnects can pick up the
+  ones it missed. Event ids are increasing integers, no smaller than the millisecond timestamp of
+  when they were published."""
+
+  def __init__(self, backlog=BACKLOG):
+    self._condition = threading.Condition()
+    self._events = collections.defaultdict(lambda: collections.deque(maxlen=backlog))
+    self._last_id = 0
+
+  def publish(self, user_id, kind, data=None):
+    with self._condition:
+      # Base ids on the time, so they keep increasing even if the process restarts.
+      self._last_id = max(self._last_id+1, int(time.time()*1000))
+      event = {'id':self._last_id, 'kind':kind, 'data':data}
+      self._events[user_id].append(event)
+      self._condition.notify_all()
+    log.info('Published event {} for user {}.'.format(event['id'], user_id))
+    return event
+
+  def listen(self, user_id, last_id=None, timeout=HEARTBEAT):
+    """Wait up to `timeout` seconds for events newer than `last_id`, and return them as a list.
+    If `last_id` is older than the backlog goes back, this returns a single 'reset' event, since
+    some events were missed. If `last_id` is None, only wait for new events."""
+    with self._condition:
+      if last_id is None:
+        last_id = self._last_id
+      backlog = self._events.get(user_id)
+      if backlog and len(backlog) == backlog.maxlen and backlog[0]['id'] > last_id:
+        return [{'id':backlog[-1]['id'], 'kind':'reset', 'data':None}]
+      self._condition.wait_for(lambda: self._get_newer(user_id, last_id), timeout=timeout)
+      return self._get_newer(user_id, last_id)
+
+  def _get_newer(self, user_id, last_id):
+    backlog = self._events.get(user_id, ())
+    return [event for event in backlog if event['id'] > last_id]
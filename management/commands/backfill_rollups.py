@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+from worktime.models import Era
+from worktime.worktime import WorkTimesDatabase
+
+
+class Command(BaseCommand):
+  help = 'Rebuild the Rollup buckets for existing eras from their Periods and Adjustments.'
+
+  def add_arguments(self, parser):
+    parser.add_argument('eras', type=int, nargs='*',
+      help='Ids of the eras to rebuild. Default: all of them.')
+    parser.add_argument('-b', '--batch-size', type=int, default=1000,
+      help='Number of rows to fetch or insert at a time. Default: %(default)s')
+
+  def handle(self, *args, **options):
+    if options['eras']:
+      eras = Era.objects.filter(pk__in=options['eras'])
+      if len(eras) != len(set(options['eras'])):
+        raise CommandError('Could not find all the eras given.')
+    else:
+      eras = Era.objects.all()
+    for era in eras:
+      work_times = WorkTimesDatabase(era.user, era=era)
+      buckets = work_times.rebuild_rollups(era, batch_size=options['batch_size'])
+      self.stdout.write('Era {}: {} buckets'.format(era.id, buckets))
@@ -0,0 +1,332 @@
+import concurrent.futures
+import io
+import json
+import random
+import time
+import tracemalloc
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, transaction
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from worktime import views, worktime
+from worktime.models import User, Era, Period, Total, Adjustment, Rollup, Cookie
+
+SUITES = ('ratios', 'import', 'database', 'summary')
+MODE_WEIGHTS = {'w':5, 'p':3, 'n':1, 's':1}
+# The (format, numbers) query parameters of each summary the summary suite times.
+SUMMARY_VARIANTS = [(format, numbers) for format in ('html', 'json', 'plain')
+                    for numbers in ('values', 'text')]
+# Timings within this many milliseconds of the baseline never count as regressions, whatever the
+# threshold, since they're mostly noise.
+REGRESSION_MIN_MS = 1
+# How many times the database suite tries each change. SQLite gives up on a lock at once when two
+# transactions which have both read try to write, instead of waiting.
+DATABASE_ATTEMPTS = 20
+
+
+class Command(BaseCommand):
+  help = 'Time parts of the summary pipeline on synthetic histories.'
+
+  def add_arguments(self, parser):
+    parser.add_argument('suite', choices=SUITES,
+      help='ratios: Time clip_totals() against the number of timespans and periods, with and '
+           'without NumPy. import: Time importing histories of each size into a new era (the '
+           'changes are rolled back afterward). database: Make switches and adjustments from many '
+           'threads at once in a new era in the configured database, check that the Totals add up '
+           'to exactly the Periods and Adjustments and that only one Period is open, then delete '
+           'it. summary: Time each format and numbers variant of the main view on histories of '
+           'each size, with and without the summary cached, and count its queries and peak memory '
+           '(the histories are rolled back afterward). The command line script\'s suites are in '
+           'benchmark.py, next to worktime.py.')
+    parser.add_argument('-p', '--periods', type=int, nargs='+', default=[1000, 10000, 100000],
+      help='Sizes of history to test. Default: %(default)s')
+    parser.add_argument('-t', '--timespans', type=int, nargs='+', default=[1, 2, 4, 8, 16],
+      help='Numbers of timespans to test. Default: %(default)s')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+      help='Run each test this many times and report the fastest. Default: %(default)s')
+    parser.add_argument('-s', '--seed', type=int, default=1,
+      help='Random seed for generating histories. Default: %(default)s')
+    parser.add_argument('-w', '--workers', type=int, default=8,
+      help='For the database suite, how many threads to run at once. Default: %(default)s')
+    parser.add_argument('-o', '--operations', type=int, default=50,
+      help='For the database suite, how many changes each thread makes. Default: %(default)s')
+    parser.add_argument('-j', '--json',
+      help='For the summary suite, also write the results to this JSON file ("-" for stdout).')
+    parser.add_argument('-b', '--baseline',
+      help='For the summary suite, compare the results to those in this JSON file (written by '
+           '--json), and fail if any are worse by more than the --threshold.')
+    parser.add_argument('--threshold', type=float, default=0.25,
+      help='How much slower, or how much more memory, than the --baseline counts as a regression, '
+           'as a fraction. Any more queries always does. Default: %(default)s')
+
+  def handle(self, *args, **options):
+    if options['suite'] == 'ratios':
+      self.bench_ratios(options)
+    elif options['suite'] == 'import':
+      self.bench_import(options)
+    elif options['suite'] == 'database':
+      self.bench_database(options)
+    elif options['suite'] == 'summary':
+      self.bench_summary(options)
+
+  def bench_ratios(self, options):
+    if worktime.import_numpy() is None:
+      raise CommandError('NumPy is not installed.')
+    now = int(time.time())
+    self.stdout.write('periods\ttimespans\tnumpy_ms\tpython_ms')
+    for n_periods in options['periods']:
+      periods, adjustments = make_history(n_periods, now, seed=options['seed'])
+      span = now - periods[0][1]
+      for n_timespans in options['timespans']:
+        # Spread the timespans evenly over the history.
+        cutoffs = [now - span*(i+1)//n_timespans for i in range(n_timespans)]
+        numpy_time = best_time(options['repeat'], worktime.clip_totals,
+                               periods, adjustments, cutoffs, now)
+        python_time = best_time(options['repeat'], worktime.clip_totals_python,
+                                periods, adjustments, cutoffs, now)
+        self.stdout.write('{}\t{}\t{:0.2f}\t{:0.2f}'.format(n_periods, n_timespans,
+                                                            numpy_time*1000, python_time*1000))
+
+  def bench_import(self, options):
+    now = int(time.time())
+    self.stdout.write('periods\tadjustments\tseconds\tperiods_per_s')
+    for n_periods in options['periods']:
+      periods, adjustments = make_history(n_periods, now, seed=options['seed'])
+      records = [{'type':'period', 'mode':mode, 'start':start, 'end':end or now}
+                 for mode, start, end in periods]
+      records.extend({'type':'adjustment', 'mode':mode, 'delta':delta, 'timestamp':timestamp}
+                     for mode, delta, timestamp in adjustments)
+      times = []
+      for i in range(options['repeat']):
+        with transaction.atomic():
+          user = User.objects.create(name='benchmark')
+          era = Era.objects.create(user=user, current=True, description='benchmark')
+          work_times = worktime.WorkTimesDatabase(user, era=era)
+          start = time.perf_counter()
+          work_times.import_history(records, era=era)
+          times.append(time.perf_counter() - start)
+          transaction.set_rollback(True)
+      elapsed = min(times)
+      self.stdout.write('{}\t{}\t{:0.2f}\t{:0.0f}'.format(n_periods, len(adjustments), elapsed,
+                                                           n_periods/elapsed))
+
+  def bench_database(self, options):
+    user = User.objects.create(name='benchmark')
+    era = Era.objects.create(user=user, current=True, description='benchmark')
+    try:
+      start = time.perf_counter()
+      with concurrent.futures.ThreadPoolExecutor(options['workers']) as executor:
+        futures = [executor.submit(stress_database, era, options['operations'], options['seed']+i)
+                   for i in range(options['workers'])]
+        counts = [future.result() for future in futures]
+      elapsed = time.perf_counter() - start
+      adjustments = sum(count[0] for count in counts)
+      retries = sum(count[1] for count in counts)
+      # Add up the history and compare it to the Totals.
+      expected = {}
+      periods = Period.objects.filter(era=era).values_list('mode', 'start', 'end')
+      for mode, period_start, period_end in periods:
+        if mode is not None and period_end is not None:
+          expected[mode] = expected.get(mode, 0) + period_end - period_start
+      for mode, delta in Adjustment.objects.filter(era=era).values_list('mode', 'delta'):
+        expected[mode] = expected.get(mode, 0) + delta
+      totals = dict(Total.objects.filter(era=era).values_list('mode', 'elapsed'))
+      open_periods = Period.objects.filter(era=era, end=None).count()
+      n_operations = options['workers'] * options['operations']
+      self.stdout.write('operations\tseconds\tper_s\tretries\topen_periods\ttotals\texpected')
+      self.stdout.write('{}\t{:0.2f}\t{:0.0f}\t{}\t{}\t{}\t{}'.format(
+        n_operations, elapsed, n_operations/elapsed, retries, open_periods,
+        json.dumps(totals, sort_keys=True), json.dumps(expected, sort_keys=True)
+      ))
+      n_adjustments = Adjustment.objects.filter(era=era).count()
+    finally:
+      for model in (Period, Adjustment, Total, Rollup):
+        model.objects.filter(era=era).delete()
+      era.delete()
+      user.delete()
+    if totals != expected or n_adjustments != adjustments:
+      raise CommandError('Changes were lost.')
+    if open_periods != 1:
+      raise CommandError('{} Periods are open at once.'.format(open_periods))
+
+
+  def bench_summary(self, options):
+    now = int(time.time())
+    results = []
+    self.stdout.write('periods\tadjustments\tformat\tnumbers\tcold_ms\twarm_ms\tqueries\tpeak_kb')
+    for n_periods in options['periods']:
+      periods, adjustments = make_history(n_periods, now, seed=options['seed'])
+      with transaction.atomic():
+        user, cookie_value = make_user_with_history(periods, adjustments)
+        work_times = worktime.WorkTimesDatabase(user)
+        for format, numbers in SUMMARY_VARIANTS:
+          params = {'format':format, 'numbers':numbers}
+          cold_times = []
+          warm_times = []
+          for i in range(options['repeat']):
+            # Bumping the Era's version means the summary has to be computed from scratch.
+            work_times.invalidate_cache(work_times.era)
+            cold_times.append(best_time(1, get_main, cookie_value, params))
+            warm_times.append(best_time(1, get_main, cookie_value, params))
+          work_times.invalidate_cache(work_times.era)
+          with CaptureQueriesContext(connection) as queries:
+            get_main(cookie_value, params)
+          work_times.invalidate_cache(work_times.era)
+          tracemalloc.start()
+          try:
+            get_main(cookie_value, params)
+            current, peak = tracemalloc.get_traced_memory()
+          finally:
+            tracemalloc.stop()
+          result = {'periods':n_periods, 'adjustments':len(adjustments), 'format':format,
+                    'numbers':numbers, 'cold_ms':round(min(cold_times)*1000, 2),
+                    'warm_ms':round(min(warm_times)*1000, 2),
+                    'queries':len(queries.captured_queries), 'peak_kb':round(peak/1024)}
+          results.append(result)
+          self.stdout.write('{periods}\t{adjustments}\t{format}\t{numbers}\t{cold_ms:0.2f}\t'
+                            '{warm_ms:0.2f}\t{queries}\t{peak_kb}'.format(**result))
+        transaction.set_rollback(True)
+    output = {'suite':'summary', 'seed':options['seed'], 'repeat':options['repeat'],
+              'results':results}
+    if options['json'] == '-':
+      self.stdout.write(json.dumps(output, indent=2))
+    elif options['json']:
+      with open(options['json'], 'w') as json_file:
+        json.dump(output, json_file, indent=2)
+    if options['baseline']:
+      with open(options['baseline']) as baseline_file:
+        baseline = json.load(baseline_file)
+      regressions = find_regressions(results, baseline['results'], options['threshold'])
+      for regression in regressions:
+        self.stdout.write('Regression: '+regression)
+      if regressions:
+        raise CommandError('{} regression(s) from the baseline.'.format(len(regressions)))
+
+
+def make_user_with_history(periods, adjustments):
+  """Make a User whose current Era holds the `periods` and `adjustments` from `make_history()`,
+  and a Cookie that logs in as them. Returns the User and the Cookie's value."""
+  user = User.objects.create(name='benchmark')
+  era = Era.objects.create(user=user, current=True, description='benchmark')
+  cookie = Cookie.objects.create(user=user, name=views.COOKIE_NAME, value='benchmark')
+  records = [{'type':'period', 'mode':mode, 'start':start, 'end':end}
+             for mode, start, end in periods[:-1]]
+  records.extend({'type':'adjustment', 'mode':mode, 'delta':delta, 'timestamp':timestamp}
+                 for mode, delta, timestamp in adjustments)
+  work_times = worktime.WorkTimesDatabase(user, era=era)
+  work_times.import_history(records, era=era)
+  # The last Period is still going.
+  mode, start, end = periods[-1]
+  work_times.switch_mode(mode, era=era, now=start)
+  return user, cookie.value
+
+
+def get_main(cookie_value, params):
+  request = RequestFactory().get('/worktime', params)
+  request.COOKIES[views.COOKIE_NAME] = cookie_value
+  response = views.main(request)
+  if response.status_code != 200:
+    raise CommandError('Got a {} response for {}.'.format(response.status_code, params))
+  return response
+
+
+def find_regressions(results, baseline_results, threshold):
+  """Compare the summary suite's `results` to earlier ones. Returns a description of each one
+  which got slower or used more memory by more than `threshold` (a fraction), or made more
+  queries. Results with no counterpart in the baseline are skipped."""
+  baseline = {(result['periods'], result['format'], result['numbers']): result
+              for result in baseline_results}
+  regressions = []
+  for result in results:
+    old = baseline.get((result['periods'], result['format'], result['numbers']))
+    if old is None:
+      continue
+    name = '{periods} periods, format={format}, numbers={numbers}'.format(**result)
+    for key in ('cold_ms', 'warm_ms'):
+      if result[key] > old[key]*(1+threshold) and result[key] - old[key] > REGRESSION_MIN_MS:
+        regressions.append('{}: {} went from {} to {}'.format(name, key, old[key], result[key]))
+    if result['peak_kb'] > old['peak_kb']*(1+threshold):
+      regressions.append('{}: peak_kb went from {} to {}'.format(name, old['peak_kb'],
+                                                                  result['peak_kb']))
+    if result['queries'] > old['queries']:
+      regressions.append('{}: queries went from {} to {}'.format(name, old['queries'],
+                                                                  result['queries']))
+  return regressions
+
+
+def stress_database(era, n_operations, seed):
+  """Make `n_operations` random switches and one-minute adjustments in the `era`, retrying any
+  that fail on a locked database. Returns how many adjustments were made and how many retries it
+  took."""
+  rng = random.Random(seed)
+  work_times = worktime.WorkTimesDatabase(era.user, era=era)
+  adjustments = retries = 0
+  try:
+    for i in range(n_operations):
+      adjust = rng.random() < 0.25
+      mode = rng.choice(('w', 'p', 'n'))
+      for attempt in range(DATABASE_ATTEMPTS):
+        try:
+          if adjust:
+            work_times.add_elapsed(mode, 60, era=era)
+          else:
+            work_times.switch_mode(mode, era=era)
+          break
+        except OperationalError:
+          retries += 1
+          time.sleep(rng.random() * 0.01 * 2**min(attempt, 6))
+      else:
+        raise CommandError('Gave up after {} tries.'.format(DATABASE_ATTEMPTS))
+      adjustments += adjust
+      # Let some time pass, so the switches have something to add up.
+      time.sleep(rng.random()/20)
+  finally:
+    # Each thread has its own connection.
+    connection.close()
+  return adjustments, retries
+
+
+def make_history(n_periods, now, seed=1):
+  """Make a realistic-ish history of `n_periods` Periods ending at `now`.
+  Returns (periods, adjustments): lists of (mode, start, end) and (mode, delta, timestamp) tuples.
+  The last Period is the current one (its end is None)."""
+  rng = random.Random(seed)
+  modes = list(MODE_WEIGHTS.keys())
+  weights = list(MODE_WEIGHTS.values())
+  periods = []
+  adjustments = []
+  mode = None
+  end = now
+  # Build it backward from now.
+  for i in range(n_periods):
+    last_mode = mode
+    while mode == last_mode:
+      mode = rng.choices(modes, weights)[0]
+    if mode == 's':
+      # Stopped overnight, or for a while during the day.
+      length = rng.randint(30*60, 12*60*60)
+    else:
+      length = int(rng.expovariate(1/(20*60))) + 1
+    start = end - length
+    periods.append([mode, start, end])
+    if rng.random() < 0.05:
+      delta = rng.choice((-1, 1)) * rng.randint(1, 30) * 60
+      adjustments.append((rng.choice(('w', 'p', 'n')), delta, rng.randint(start, end)))
+    # Sometimes leave a gap between Periods.
+    if rng.random() < 0.1:
+      end = start - rng.randint(1, 60*60)
+    else:
+      end = start
+  periods.reverse()
+  periods[-1][2] = None
+  adjustments.reverse()
+  return [tuple(period) for period in periods], adjustments
+
+
+def best_time(repeat, function, *args):
+  times = []
+  for i in range(repeat):
+    start = time.perf_counter()
+    function(*args)
+    times.append(time.perf_counter() - start)
+  return min(times)
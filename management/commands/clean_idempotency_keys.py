@@ -0,0 +1,14 @@
+import time
+from django.core.management.base import BaseCommand
+from worktime.models import IdempotencyKey
+from worktime.views import IDEMPOTENCY_KEY_TTL
+
+
+class Command(BaseCommand):
+  help = ('Delete the Idempotency-Keys (and stored responses) older than {} hours. Run this '
+          'periodically, e.g. from cron.'.format(IDEMPOTENCY_KEY_TTL//(60*60)))
+
+  def handle(self, *args, **options):
+    cutoff = int(time.time()) - IDEMPOTENCY_KEY_TTL
+    deleted, counts = IdempotencyKey.objects.filter(created__lt=cutoff).delete()
+    self.stdout.write('Deleted {} keys.'.format(deleted))
@@ -0,0 +1,182 @@
+import bisect
+import contextlib
+import functools
+import hmac
+import logging
+import threading
+import time
+from django.conf import settings
+from django.db import connection
+from .profiling import can_profile
+log = logging.getLogger(__name__)
+
+# Upper bounds of the histogram buckets.
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERIES_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+# Values of the "format" parameter to label requests with. Anything else counts as "other", so
+# clients can't make an unbounded number of series.
+FORMATS = ('html', 'json', 'plain', 'csv', 'jsonl')
+# Only read the "format" from the body of POSTs of these types. Others (like imports) aren't forms.
+FORM_TYPES = ('application/x-www-form-urlencoded', 'multipart/form-data')
+
+# The view being instrumented in each thread, if any.
+_local = threading.local()
+_no_phase = contextlib.nullcontext()
+
+
+def metrics_enabled():
+  """Whether the WORKTIME_METRICS setting is on. Views are only instrumented if it was on when
+  they were loaded. Who can read them is up to can_read_metrics()."""
+  return getattr(settings, 'WORKTIME_METRICS', False)
+
+
+def can_read_metrics(request):
+  """Only staff can read the metrics, plus scrapers which send the WORKTIME_METRICS_TOKEN setting
+  (if it's set) as a bearer token, in an "Authorization: Bearer <token>" header."""
+  token = getattr(settings, 'WORKTIME_METRICS_TOKEN', None)
+  if token:
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    if hmac.compare_digest(authorization.encode('utf8'), 'Bearer {}'.format(token).encode('utf8')):
+      return True
+  return can_profile(request)
+
+
+class Histogram(object):
+  """Counts of observed values in buckets, Prometheus-style, for each combination of label values.
+  The counts are only for this process: with multiple worker processes, each one has its own."""
+
+  def __init__(self, name, description, label_names, buckets):
+    self.name = name
+    self.description = description
+    self.label_names = label_names
+    self.buckets = buckets
+    self._lock = threading.Lock()
+    # Map label values to the count in each bucket (not cumulative), the sum, and the count.
+    self._series = {}
+
+  def observe(self, value, *label_values):
+    index = bisect.bisect_left(self.buckets, value)
+    with self._lock:
+      series = self._series.get(label_values)
+      if series is None:
+        series = self._series[label_values] = [[0]*len(self.buckets), 0, 0]
+      if index < len(self.buckets):
+        series[0][index] += 1
+      series[1] += value
+      series[2] += 1
+
+  def expose(self):
+    """Return the lines of the Prometheus text format for this histogram."""
+    with self._lock:
+      all_series = sorted((label_values, list(counts), total, count)
+                          for label_values, (counts, total, count) in self._series.items())
+    lines = ['# HELP {} {}'.format(self.name, self.description),
+             '# TYPE {} histogram'.format(self.name)]
+    for label_values, counts, total, count in all_series:
+      labels = ','.join('{}="{}"'.format(name, escape_label(value))
+                        for name, value in zip(self.label_names, label_values))
+      cumulative = 0
+      for bound, bucket_count in zip(self.buckets, counts):
+        cumulative += bucket_count
+        lines.append('{}_bucket{{{},le="{}"}} {}'.format(self.name, labels, bound, cumulative))
+      lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(self.name, labels, count))
+      lines.append('{}_sum{{{}}} {}'.format(self.name, labels, total))
+      lines.append('{}_count{{{}}} {}'.format(self.name, labels, count))
+    return lines
+
+
+REQUEST_SECONDS = Histogram('worktime_request_seconds', 'Time taken to handle each request.',
+                            ('view', 'format'), SECONDS_BUCKETS)
+REQUEST_QUERIES = Histogram('worktime_request_queries', 'Database queries made by each request.',
+                            ('view', 'format'), QUERIES_BUCKETS)
+REQUEST_DB_SECONDS = Histogram('worktime_request_db_seconds',
+                               'Time spent on database queries in each request.',
+                               ('view', 'format'), SECONDS_BUCKETS)
+PHASE_SECONDS = Histogram('worktime_phase_seconds', 'Time taken by each phase of a request.',
+                          ('view', 'phase'), SECONDS_BUCKETS)
+HISTOGRAMS = (REQUEST_SECONDS, REQUEST_QUERIES, REQUEST_DB_SECONDS, PHASE_SECONDS)
+
+
+class QueryRecorder(object):
+  """A database execute wrapper which counts queries and the time spent on them."""
+
+  def __init__(self):
+    self.queries = 0
+    self.seconds = 0
+
+  def __call__(self, execute, sql, params, many, context):
+    start = time.perf_counter()
+    try:
+      return execute(sql, params, many, context)
+    finally:
+      self.queries += 1
+      self.seconds += time.perf_counter() - start
+
+
+def instrument(view):
+  """Record the time, query count, and database time of each request to the `view`, labeled with
+  its name and "format" parameter.
+  If metrics are off, this returns the `view` itself, so it costs nothing. Queries made while a
+  streaming response is being sent aren't counted."""
+  if not metrics_enabled():
+    return view
+  name = view.__name__
+  @functools.wraps(view)
+  def wrapper(request, *args, **kwargs):
+    recorder = QueryRecorder()
+    _local.view = name
+    start = time.perf_counter()
+    try:
+      with connection.execute_wrapper(recorder):
+        return view(request, *args, **kwargs)
+    finally:
+      elapsed = time.perf_counter() - start
+      _local.view = None
+      format = get_format(request)
+      REQUEST_SECONDS.observe(elapsed, name, format)
+      REQUEST_QUERIES.observe(recorder.queries, name, format)
+      REQUEST_DB_SECONDS.observe(recorder.seconds, name, format)
+  return wrapper
+
+
+def time_phase(phase):
+  """Use as a context manager to record how long part of an instrumented request takes.
+  Outside of one (including whenever metrics are off) it does nothing."""
+  view = getattr(_local, 'view', None)
+  if view is None:
+    return _no_phase
+  return _time_phase(view, phase)
+
+
+@contextlib.contextmanager
+def _time_phase(view, phase):
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    PHASE_SECONDS.observe(time.perf_counter() - start, view, phase)
+
+
+def get_format(request):
+  if request.method == 'POST' and request.content_type in FORM_TYPES:
+    format = request.POST.get('format')
+  else:
+    format = request.GET.get('format')
+  if format is None:
+    return 'default'
+  elif format in FORMATS:
+    return format
+  else:
+    return 'other'
+
+
+def escape_label(value):
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def expose_metrics():
+  """Get all the metrics in the Prometheus text exposition format."""
+  lines = []
+  for histogram in HISTOGRAMS:
+    lines.extend(histogram.expose())
+  return '\n'.join(lines)+'\n'
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def merge_duplicate_totals(apps, schema_editor):
+    """Before adding the unique constraint on (era, mode), fold any duplicate Totals into one."""
+    Total = apps.get_model('worktime', 'Total')
+    seen = {}
+    for total in Total.objects.order_by('id'):
+        key = (total.era_id, total.mode)
+        if key in seen:
+            first = seen[key]
+            first.elapsed += total.elapsed
+            first.save()
+            total.delete()
+        else:
+            seen[key] = total
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('worktime', '0006_show_intro_setting'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_totals, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='period',
+            index=models.Index(fields=['era', 'end'], name='worktime_period_era_end'),
+        ),
+        migrations.AddIndex(
+            model_name='period',
+            index=models.Index(fields=['era', 'start'], name='worktime_period_era_start'),
+        ),
+        migrations.AddIndex(
+            model_name='adjustment',
+            index=models.Index(fields=['era', 'timestamp'], name='worktime_adjust_era_time'),
+        ),
+        migrations.AddConstraint(
+            model_name='total',
+            constraint=models.UniqueConstraint(fields=('era', 'mode'), name='worktime_total_era_mode'),
+        ),
+        migrations.AddIndex(
+            model_name='cookie',
+            index=models.Index(fields=['name', 'value'], name='worktime_cookie_name_value'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import utils.misc
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('worktime', '0007_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Rollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('mode', models.CharField(max_length=63)),
+                ('size', models.IntegerField()),
+                ('start', models.BigIntegerField()),
+                ('elapsed', models.IntegerField(default=0)),
+                ('era', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='worktime.Era')),
+            ],
+            bases=(utils.misc.ModelMixin, models.Model),
+        ),
+        migrations.AddConstraint(
+            model_name='rollup',
+            constraint=models.UniqueConstraint(fields=('era', 'size', 'start', 'mode'), name='worktime_rollup_bucket'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('worktime', '0008_rollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='period',
+            name='cumulative',
+            field=models.TextField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def end_duplicate_periods(apps, schema_editor):
+    """Before adding the unique constraint on open Periods, end all but the latest one in each Era
+    where the same switch happened twice at once. Each ends when the next one started, and its time
+    goes to the Total, like a switch would have done. The next one then follows it in the chain of
+    Periods."""
+    Period = apps.get_model('worktime', 'Period')
+    Total = apps.get_model('worktime', 'Total')
+    eras = (Period.objects.filter(end=None).values('era').annotate(count=models.Count('id'))
+                          .filter(count__gt=1).values_list('era', flat=True))
+    for era_id in list(eras):
+        periods = list(Period.objects.filter(era_id=era_id, end=None).order_by('start', 'id'))
+        for period, next_period in zip(periods, periods[1:]):
+            period.end = next_period.start
+            period.save()
+            next_period.prev = period
+            next_period.save()
+            if period.mode is not None:
+                total, created = Total.objects.get_or_create(era_id=era_id, mode=period.mode)
+                total.elapsed += period.end - period.start
+                total.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('worktime', '0010_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.RunPython(end_duplicate_periods, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='period',
+            constraint=models.UniqueConstraint(condition=models.Q(end=None), fields=('era',), name='worktime_period_era_open'),
+        ),
+    ]
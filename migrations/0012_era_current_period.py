@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import worktime.models
+
+
+def fill_current_periods(apps, schema_editor):
+    """Point each Era at its open Period, if any."""
+    Era = apps.get_model('worktime', 'Era')
+    Period = apps.get_model('worktime', 'Period')
+    for period in Period.objects.filter(end=None, era__isnull=False):
+        Era.objects.filter(pk=period.era_id).update(current_period=period, current_mode=period.mode,
+                                                    current_start=period.start)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('worktime', '0011_period_era_open'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='era',
+            name='current_mode',
+            field=models.CharField(blank=True, max_length=63, null=True),
+        ),
+        migrations.AddField(
+            model_name='era',
+            name='current_period',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='worktime.Period'),
+        ),
+        migrations.AddField(
+            model_name='era',
+            name='current_start',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='era',
+            name='version',
+            field=models.BigIntegerField(default=worktime.models.new_era_version),
+        ),
+        migrations.RunPython(fill_current_periods, migrations.RunPython.noop),
+    ]
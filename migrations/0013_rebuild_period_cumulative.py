@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+
+from django.db import migrations
+
+BATCH_SIZE = 1000
+
+
+def rebuild_cumulative(apps, schema_editor):
+    """Recompute the cumulative totals of every Period, the way
+    WorkTimesDatabase.rebuild_cumulative() now does: a Period counts whenever it had a mode, and
+    Adjustments made in the same second a Period started come after it."""
+    Era = apps.get_model('worktime', 'Era')
+    Period = apps.get_model('worktime', 'Period')
+    Adjustment = apps.get_model('worktime', 'Adjustment')
+    for era_id in list(Era.objects.values_list('pk', flat=True)):
+        adjustments = (Adjustment.objects.filter(era_id=era_id).order_by('timestamp', 'id')
+                                         .values_list('mode', 'delta', 'timestamp')
+                                         .iterator(chunk_size=BATCH_SIZE))
+        next_adjustment = next(adjustments, None)
+        totals = {}
+        last_period = None
+        batch = []
+        periods = (Period.objects.filter(era_id=era_id).order_by('start', 'id')
+                                 .only('mode', 'start', 'end', 'cumulative')
+                                 .iterator(chunk_size=BATCH_SIZE))
+        for period in periods:
+            if last_period is not None and last_period.mode is not None:
+                end = last_period.end if last_period.end is not None else period.start
+                totals[last_period.mode] = totals.get(last_period.mode, 0) + end - last_period.start
+            while next_adjustment is not None and next_adjustment[2] < period.start:
+                mode, delta, timestamp = next_adjustment
+                totals[mode] = totals.get(mode, 0) + delta
+                next_adjustment = next(adjustments, None)
+            cumulative = json.dumps(totals, sort_keys=True)
+            if period.cumulative != cumulative:
+                period.cumulative = cumulative
+                batch.append(period)
+                if len(batch) >= BATCH_SIZE:
+                    Period.objects.bulk_update(batch, ['cumulative'])
+                    batch = []
+            last_period = period
+        Period.objects.bulk_update(batch, ['cumulative'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('worktime', '0012_era_current_period'),
+    ]
+
+    operations = [
+        migrations.RunPython(rebuild_cumulative, migrations.RunPython.noop),
+    ]
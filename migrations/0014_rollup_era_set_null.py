@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('worktime', '0013_rebuild_period_cumulative'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='rollup',
+            name='era',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='worktime.Era'),
+        ),
+    ]
@@ -1,4 +1,5 @@
 import datetime
+import json
 import logging
 import time
 from django.db import models
@@ -46,10 +47,23 @@ class User(ModelMixin, models.Model):
         output += ', {}={!r}'.format(name, value)
     return output+')'
 
+def new_era_version():
+  # Start from the time, not 0, so an Era can't reuse the versions of an earlier one with the same id
+  # (which could still have summaries cached under them).
+  return int(time.time()*1000)
+
 class Era(ModelMixin, models.Model):
   user = models.ForeignKey(User, models.SET_NULL, null=True, blank=True)
   description = models.CharField(max_length=255)
   current = models.BooleanField()
+  # The Period in progress, and its mode and start, so the status can be read from this row alone.
+  # WorkTimesDatabase keeps them up to date in the same transaction as each switch.
+  current_period = models.ForeignKey('Period', models.SET_NULL, null=True, blank=True,
+                                     related_name='+')
+  current_mode = models.CharField(max_length=MODE_MAX_LEN, null=True, blank=True)
+  current_start = models.BigIntegerField(null=True, blank=True)
+  # Goes up with every write to the Era or its Periods, Adjustments, and Totals.
+  version = models.BigIntegerField(default=new_era_version)
   def __str__(self):
     if self.description:
       return self.description
@@ -65,6 +79,19 @@ class Period(ModelMixin, models.Model):
   end = models.BigIntegerField(null=True, blank=True)
   prev = models.OneToOneField('self', models.SET_NULL, null=True, blank=True, related_name='next')
   era = models.ForeignKey(Era, models.SET_NULL, null=True, blank=True)
+  # The Totals as of the start of this Period, as a JSON object mapping modes to seconds.
+  cumulative = models.TextField(null=True, blank=True)
+  class Meta:
+    indexes = [
+      # For finding the open Period and the Periods that ended within a recent timespan.
+      models.Index(fields=['era', 'end'], name='worktime_period_era_end'),
+      models.Index(fields=['era', 'start'], name='worktime_period_era_start'),
+    ]
+    constraints = [
+      # Only one Period in each Era can be in progress.
+      models.UniqueConstraint(fields=['era'], condition=models.Q(end=None),
+                              name='worktime_period_era_open'),
+    ]
   @property
   def elapsed(self):
     if self.end:
@@ -72,6 +99,11 @@ class Period(ModelMixin, models.Model):
     else:
       return int(time.time()) - self.start
   @property
+  def cumulative_totals(self):
+    if self.cumulative is None:
+      return None
+    return json.loads(self.cumulative)
+  @property
   def start_human(self):
     return timestamp_to_str(self.start)
   @property
@@ -96,6 +128,10 @@ class Adjustment(ModelMixin, models.Model):
   delta = models.IntegerField()
   timestamp = models.BigIntegerField()
   era = models.ForeignKey(Era, models.SET_NULL, null=True, blank=True)
+  class Meta:
+    indexes = [
+      models.Index(fields=['era', 'timestamp'], name='worktime_adjust_era_time'),
+    ]
   @property
   def timestamp_human(self):
     return timestamp_to_str(self.timestamp)
@@ -112,13 +148,60 @@ class Total(ModelMixin, models.Model):
   mode = models.CharField(max_length=MODE_MAX_LEN)
   elapsed = models.IntegerField(default=0)
   era = models.ForeignKey(Era, models.SET_NULL, null=True, blank=True)
+  class Meta:
+    constraints = [
+      models.UniqueConstraint(fields=['era', 'mode'], name='worktime_total_era_mode'),
+    ]
   def __str__(self):
     return '{} {:0.1f}hr'.format(self.mode, self.elapsed/60/60)
 
+class Rollup(ModelMixin, models.Model):
+  """The number of seconds spent in a mode during one fixed-size time bucket.
+  Adjustments are counted as "virtual periods" `delta` long, ending at the time the adjustment was
+  made (so a negative one takes time away from the buckets before it). Only finished Periods are
+  included. These let us total up long timespans without visiting every Period."""
+  era = models.ForeignKey(Era, models.SET_NULL, null=True, blank=True)
+  mode = models.CharField(max_length=MODE_MAX_LEN)
+  size = models.IntegerField()
+  start = models.BigIntegerField()
+  elapsed = models.IntegerField(default=0)
+  class Meta:
+    constraints = [
+      models.UniqueConstraint(fields=['era', 'size', 'start', 'mode'], name='worktime_rollup_bucket'),
+    ]
+  def __str__(self):
+    return '{} {}s@{} {}'.format(self.mode, self.size, self.start, self.elapsed)
+
+class IdempotencyKey(ModelMixin, models.Model):
+  """A key the client sent with a request that changes data, and the response we gave, so that if
+  it retries the request we can send the same response instead of making the change twice.
+  `status` is None while the first request is still being processed."""
+  user = models.ForeignKey(User, models.CASCADE)
+  key = models.CharField(max_length=128)
+  request_hash = models.CharField(max_length=64)
+  created = models.BigIntegerField()
+  status = models.IntegerField(null=True, blank=True)
+  content_type = models.CharField(max_length=255, blank=True)
+  location = models.CharField(max_length=1023, blank=True)
+  content = models.TextField(blank=True)
+  class Meta:
+    constraints = [
+      models.UniqueConstraint(fields=['user', 'key'], name='worktime_idempotency_user_key'),
+    ]
+    indexes = [
+      models.Index(fields=['created'], name='worktime_idempotency_created'),
+    ]
+  def __str__(self):
+    return self.key
+
 class Cookie(ModelMixin, models.Model):
   user = models.ForeignKey(User, models.SET_NULL, null=True, blank=True)
   name = models.CharField(max_length=128)
   value = models.CharField(max_length=128)
+  class Meta:
+    indexes = [
+      models.Index(fields=['name', 'value'], name='worktime_cookie_name_value'),
+    ]
   def __str__(self):
     return self.value
   def __repr__(self):
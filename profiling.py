@@ -0,0 +1,122 @@
+import cProfile
+import collections
+import io
+import logging
+import pstats
+import sys
+import time
+from django.db import connection
+log = logging.getLogger(__name__)
+
+# "cprofile": cProfile stats, then the SQL statements.
+# "collapsed": time spent in each call stack, in the collapsed format read by flamegraph.pl.
+# "sql": only the SQL statements, without the overhead of profiling the Python code.
+PROFILERS = ('cprofile', 'collapsed', 'sql')
+# How many functions to list in the cProfile stats.
+STATS_LIMIT = 60
+
+
+def can_profile(request):
+  """Only staff can profile requests. This depends on Django's AuthenticationMiddleware."""
+  user = getattr(request, 'user', None)
+  return user is not None and user.is_active and user.is_staff
+
+
+def profile(profiler, func, *args, **kwargs):
+  """Call `func` under the `profiler` (one of PROFILERS), and return a plain text report of what it
+  did. Whatever `func` returns is thrown away."""
+  recorder = StatementRecorder()
+  with connection.execute_wrapper(recorder):
+    if profiler == 'cprofile':
+      stats = cProfile.Profile()
+      stats.runcall(func, *args, **kwargs)
+      stream = io.StringIO()
+      pstats.Stats(stats, stream=stream).sort_stats('cumulative').print_stats(STATS_LIMIT)
+      return stream.getvalue()+'\n'+recorder.format()
+    elif profiler == 'collapsed':
+      stacks = StackProfiler()
+      stacks.runcall(func, *args, **kwargs)
+      return stacks.format()
+    elif profiler == 'sql':
+      func(*args, **kwargs)
+      return recorder.format()
+    else:
+      raise ValueError('Invalid profiler {!r}.'.format(profiler))
+
+
+class StatementRecorder(object):
+  """A database execute wrapper which keeps each SQL statement, its parameters, and how long it
+  took."""
+
+  def __init__(self):
+    self.statements = []
+
+  def __call__(self, execute, sql, params, many, context):
+    start = time.perf_counter()
+    try:
+      return execute(sql, params, many, context)
+    finally:
+      self.statements.append((time.perf_counter()-start, sql, params))
+
+  def format(self):
+    total = sum(elapsed for elapsed, sql, params in self.statements)
+    lines = ['{} queries in {:0.3f} ms'.format(len(self.statements), total*1000)]
+    for elapsed, sql, params in self.statements:
+      lines.append('{:9.3f} ms  {}  {!r}'.format(elapsed*1000, sql, params))
+    return '\n'.join(lines)+'\n'
+
+
+class StackProfiler(object):
+  """A deterministic profiler which adds up the time spent in each full call stack, for making
+  flame graphs. cProfile only keeps track of each function's immediate callers, so its stats can't
+  be turned into stacks."""
+
+  def __init__(self):
+    # Map each stack (a tuple of function names) to the time spent in its last function itself.
+    self.totals = collections.Counter()
+    # The open calls: their names, start times, and the total time spent in their callees.
+    self._stack = []
+
+  def runcall(self, func, *args, **kwargs):
+    sys.setprofile(self._trace)
+    try:
+      return func(*args, **kwargs)
+    finally:
+      sys.setprofile(None)
+      # All that's left is the call to sys.setprofile() itself.
+      self._stack.clear()
+
+  def _trace(self, frame, event, arg):
+    now = time.perf_counter()
+    if event == 'call':
+      code = frame.f_code
+      name = '{}.{}'.format(frame.f_globals.get('__name__'),
+                            getattr(code, 'co_qualname', code.co_name))
+      self._stack.append([name, now, 0])
+    elif event == 'c_call':
+      module = getattr(arg, '__module__', None) or type(getattr(arg, '__self__', None)).__name__
+      name = '{}.{}'.format(module, getattr(arg, '__qualname__', arg.__name__))
+      self._stack.append([name, now, 0])
+    elif self._stack:
+      # A 'return', 'c_return', or 'c_exception'. There's nothing to pop for the ones from calls
+      # which were already running when we started.
+      self._pop(now)
+
+  def _pop(self, now):
+    name, start, callee_time = self._stack.pop()
+    elapsed = now - start
+    stack = tuple(call[0] for call in self._stack) + (name,)
+    self.totals[stack] += elapsed - callee_time
+    if self._stack:
+      self._stack[-1][2] += elapsed
+
+  def format(self):
+    """One line per stack: the function names, separated by semicolons, then the microseconds
+    spent in it."""
+    lines = []
+    for stack, seconds in sorted(self.totals.items()):
+      microseconds = int(round(seconds*1000000))
+      if microseconds > 0:
+        lines.append('{} {}'.format(';'.join(name.replace(';', ':') for name in stack),
+                                    microseconds))
+    return '\n'.join(lines)+'\n'
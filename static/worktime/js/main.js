@@ -2,6 +2,14 @@
 
 var settings = {autoupdate:true, abbrev:false};
 var lastUpdate = Date.now()/1000;
+// The ETag of the last summary we applied, so the server can tell us when nothing's changed.
+var summaryEtag = null;
+// The metadata (modes, eras, settings) left out of the summaries we poll for, and its hash.
+var meta = null;
+var metaHash = null;
+// Whether we're currently connected to the server's stream of change events.
+var streamOpen = false;
+var lastFetch = 0;
 var clickedId = null;
 var lastClickCheck = 0;
 
@@ -34,7 +42,8 @@ function main() {
   attachListenerToAllForms(submitForm);
   addPopupListeners(historyBarElem);
   arrangeAdjustments(adjustmentsBarElem);
-  window.setInterval(updateSummary, 30*1000);
+  subscribeToChanges();
+  window.setInterval(pollSummary, 30*1000);
   window.setInterval(updateConnection, 1*1000);
   document.addEventListener('visibilitychange', updateSummary, false);
 }
@@ -52,45 +61,140 @@ function updateSummary(force) {
   //TODO: `force` is an event when this is called as an event listener.
   if (force === true || (settings.autoupdate && !document.hidden)) {
     loadingElem.style.display = "initial";
-    makeRequest('GET', '/worktime?format=json&numbers=text&via=js', applySummary, connectionWarn);
+    lastFetch = Date.now()/1000;
+    var headers = {};
+    if (summaryEtag) {
+      headers["If-None-Match"] = summaryEtag;
+    }
+    var url = '/worktime?format=json&numbers=text&meta=hash&via=js';
+    // Ask for the same timespans as the page was loaded with.
+    var params = getQueryParams();
+    if (params.timespans) {
+      url += '&timespans='+encodeURIComponent(params.timespans);
+    }
+    makeRequest('GET', url, applySummary, connectionWarn, undefined, headers);
   } else {
     loadingElem.style.display = "none";
   }
 }
 
+function subscribeToChanges() {
+  // Listen for the server to tell us when something changed, so we don't have to keep polling.
+  if (typeof EventSource === "undefined") {
+    return;
+  }
+  var source = new EventSource('/worktime/events');
+  source.addEventListener("open", function() {
+    streamOpen = true;
+  });
+  source.addEventListener("error", function() {
+    // The EventSource will keep trying to reconnect on its own. Poll until it does.
+    streamOpen = false;
+  });
+  source.addEventListener("change", updateSummary);
+  source.addEventListener("reset", updateSummary);
+  source.addEventListener("heartbeat", function() {
+    // This at least shows we're still in contact with the server.
+    lastUpdate = Date.now()/1000;
+    updateConnection();
+  });
+}
+
+function pollSummary() {
+  // When the event stream is open, changes are pushed to us, so we only have to refresh once in a
+  // while to keep the clock-dependent numbers current.
+  if (streamOpen && Date.now()/1000 - lastFetch < 60) {
+    return;
+  }
+  updateSummary();
+}
+
 function applySummary() {
   // Insert the new data into the page.
   // Called once the XMLHttpRequest has gotten a response.
   var connectionWarningElem = document.getElementById('connection-warning');
   var summary = this.response;
-  if (summary && summary.elapsed && summary.ratios) {
+  var loadingElem = document.getElementById("loading");
+  if (this.status === 304) {
+    // Nothing has changed since the summary we already have.
     unwarn(connectionWarningElem);
-    updateSettings(settings, summary);
-    updateParent(summary);
-    updateEras(summary);
-    updateStatus(summary);
-    updateTotals(summary);
-    updateHistory(summary);
-    updateAdjustments(summary);
-    updateActions(summary);
-    updateSettingsUI(summary);
     lastUpdate = Date.now()/1000;
-    /*TODO: Somehow, the lastUpdate is getting set to now even when the request fails.
-     *      Symptoms: on mobile devices, I switch back to the tab after a long time and the info
-     *      is definitely out of date, but the display says it's only a few seconds old.
-     *      Is `if (summary)` not properly detecting the failure? Doesn't seem like it.
-     *      Maybe it actually did get a response, but didn't properly update the display?
-     */
-     updateConnection();
+    updateConnection();
+    loadingElem.style.display = "none";
+    return;
+  }
+  if (summary && summary.elapsed && summary.ratios) {
+    unwarn(connectionWarningElem);
+    summaryEtag = this.getResponseHeader("ETag");
+    if (summary.meta_hash !== undefined && summary.meta_hash !== metaHash) {
+      // The metadata changed (or we don't have it yet). Get it before displaying anything.
+      fetchMeta(summary);
+      return;
+    }
+    displaySummary(addMeta(summary));
   } else if (summary) {
     warn(connectionWarningElem, "Invalid summary object returned");
   } else {
     warn(connectionWarningElem, "No summary object returned");
   }
-  var loadingElem = document.getElementById("loading");
   loadingElem.style.display = "none";
 }
 
+function fetchMeta(summary) {
+  var hash = summary.meta_hash;
+  function applyMeta() {
+    if (this.status === 200 && this.response) {
+      meta = this.response;
+      metaHash = hash;
+      displaySummary(addMeta(summary));
+    } else {
+      var connectionWarningElem = document.getElementById('connection-warning');
+      warn(connectionWarningElem, "Could not get metadata from server");
+    }
+    document.getElementById("loading").style.display = "none";
+  }
+  function connectionWarn(event) {
+    var connectionWarningElem = document.getElementById('connection-warning');
+    warn(connectionWarningElem, "Could not connect to server");
+    document.getElementById("loading").style.display = "none";
+  }
+  // The hash is in the url, so the browser can cache the response for as long as it's current.
+  var url = '/worktime/meta?hash='+encodeURIComponent(hash)+'&via=js';
+  makeRequest('GET', url, applyMeta, connectionWarn);
+}
+
+function addMeta(summary) {
+  // Fill in the metadata left out of a summary requested with meta=hash.
+  if (summary.meta_hash === undefined || meta === null) {
+    return summary;
+  }
+  var keys = Object.keys(meta);
+  for (var k = 0; k < keys.length; k++) {
+    summary[keys[k]] = meta[keys[k]];
+  }
+  return summary;
+}
+
+function displaySummary(summary) {
+  updateSettings(settings, summary);
+  updateParent(summary);
+  updateEras(summary);
+  updateStatus(summary);
+  updateTotals(summary);
+  updateHistory(summary);
+  updateAdjustments(summary);
+  updateActions(summary);
+  updateSettingsUI(summary);
+  lastUpdate = Date.now()/1000;
+  /*TODO: Somehow, the lastUpdate is getting set to now even when the request fails.
+   *      Symptoms: on mobile devices, I switch back to the tab after a long time and the info
+   *      is definitely out of date, but the display says it's only a few seconds old.
+   *      Is `if (summary)` not properly detecting the failure? Doesn't seem like it.
+   *      Maybe it actually did get a response, but didn't properly update the display?
+   */
+  updateConnection();
+}
+
 function updateConnection() {
   var statsElem = document.getElementById('stats');
   var historyElem = document.getElementById('history');
@@ -786,7 +890,7 @@ function formatTime(quantity, unit) {
   return output;
 }
 
-function makeRequest(method, url, callback, errorCallback, data) {
+function makeRequest(method, url, callback, errorCallback, data, headers) {
   var request = new XMLHttpRequest();
   request.responseType = 'json';
   //TODO: Wrap callback in our own which first checks that request.status === 200.
@@ -795,6 +899,12 @@ function makeRequest(method, url, callback, errorCallback, data) {
     request.addEventListener('error', errorCallback, true);
   }
   request.open(method, url);
+  if (headers) {
+    var names = Object.keys(headers);
+    for (var i = 0; i < names.length; i++) {
+      request.setRequestHeader(names[i], headers[names[i]]);
+    }
+  }
   if (data === undefined) {
     request.send();
   } else {
@@ -827,7 +937,16 @@ function submitForm(event) {
   if (event.target.tagName === "BUTTON" && event.target.name) {
     form.append(event.target.name, event.target.value);
   }
-  makeRequest("POST", formElem.action, updateSummary, formFailureWarn, form);
+  // Ask for the new summary in the response, instead of a redirect to the whole page.
+  form.append("redirect", "false");
+  form.append("format", "json");
+  form.append("numbers", "text");
+  form.append("meta", "hash");
+  var params = getQueryParams();
+  if (params.timespans) {
+    form.append("timespans", params.timespans);
+  }
+  makeRequest("POST", formElem.action, applySummary, formFailureWarn, form);
   if (formElem.id !== "era-rename") {
     var fields = getFormFields(formElem);
     clearFields(fields);
@@ -0,0 +1,610 @@
+import hashlib
+import io
+import json
+import pathlib
+import random
+import re
+import tempfile
+import threading
+import time
+import types
+import unittest
+from unittest import mock
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from . import events, views
+from .benchmark import check_files
+from .profiling import StatementRecorder
+from .models import Era, Period, Adjustment, Total, Cookie, User, IdempotencyKey
+from .worktime import WorkTimesDatabase, WorkTimesFiles, WorkTimesSQLite, WorkTimesWeb
+from .worktime import WorkTimeError, clip_totals, clip_totals_python, get_cache, import_numpy
+from .worktime import import_requests
+
+# How many queries a summary can take, whatever its format or number of timespans (one of them
+# totals up all the windows of the recent ratios).
+SUMMARY_QUERIES = 7
+# How many more it takes if any of the timespans are long enough to be totaled from Rollups.
+ROLLUP_QUERIES = 3
+# How many queries the metadata takes: the user, their current Era, and all their Eras.
+META_QUERIES = 3
+# How many times a change can fail on a locked database before the stress test gives up.
+DATABASE_ATTEMPTS = 20
+
+
+def make_era(description='Test'):
+  user = User.objects.create(name='test')
+  return Era.objects.create(user=user, description=description, current=True)
+
+
+def make_history(era, switches):
+  """Switch the `era` through each (mode, seconds ago) in `switches`."""
+  now = int(time.time())
+  work_times = WorkTimesDatabase(era.user, era=era)
+  for mode, ago in switches:
+    work_times.switch_mode(mode, era=era, now=now-ago)
+  return work_times
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN is specific to SQLite.')
+class IndexTests(TestCase):
+  """Check that none of the queries WorkTimesDatabase and the views make scan a whole table."""
+
+  @classmethod
+  def setUpTestData(cls):
+    cls.era = make_era()
+    Cookie.objects.create(user=cls.era.user, name=views.COOKIE_NAME, value='test')
+    make_history(cls.era, [('w', 200000), ('p', 90000), (None, 9000), ('w', 5000), ('p', 600)])
+
+  def setUp(self):
+    get_cache().clear()
+    self.work_times = WorkTimesDatabase(self.era.user, era=self.era)
+    self.recorder = StatementRecorder()
+
+  def record(self, func, *args, **kwargs):
+    with connection.execute_wrapper(self.recorder):
+      func(*args, **kwargs)
+
+  def get_scans(self):
+    """EXPLAIN each statement recorded, and return the ones which scan a table, with their plans."""
+    scans = []
+    for elapsed, sql, params in self.recorder.statements:
+      if not sql.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE', 'WITH')):
+        continue
+      with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN QUERY PLAN '+sql, params)
+        plan = '\n'.join(row[-1] for row in cursor.fetchall())
+      if re.search(r'\bSCAN worktime_', plan):
+        scans.append((sql, plan))
+    return scans
+
+  def assertNoScans(self):
+    self.assertTrue(self.recorder.statements)
+    self.assertEqual(self.get_scans(), [])
+
+  def test_summary(self):
+    for engine in ('sql', 'memory'):
+      with self.settings(WORKTIME_WINDOW_ENGINE=engine):
+        get_cache().clear()
+        self.record(self.work_times.get_summary, timespans=(15*60, 2*60*60, 24*60*60, 7*24*60*60))
+    self.assertNoScans()
+
+  def test_views(self):
+    for path, params in (('/worktime', {'format':'json'}), ('/worktime/meta', {})):
+      request = RequestFactory().get(path, params)
+      request.COOKIES[views.COOKIE_NAME] = 'test'
+      if path == '/worktime':
+        self.record(views.main, request)
+      else:
+        self.record(views.meta, request)
+    self.assertNoScans()
+
+  def test_writes(self):
+    now = int(time.time())
+    self.record(self.work_times.switch_mode, 'w', era=self.era)
+    self.record(self.work_times.add_elapsed, 'p', 60, era=self.era)
+    self.record(self.work_times.add_elapsed, 'w', 60, era=self.era, now=now-3000)
+    self.assertNoScans()
+
+  def test_asof(self):
+    now = int(time.time())
+    self.record(self.work_times.get_totals_asof, now-8000)
+    self.record(self.work_times.get_totals_between, now-100000, now-1000)
+    self.assertNoScans()
+
+
+class SummaryTests(TestCase):
+
+  @classmethod
+  def setUpTestData(cls):
+    cls.era = make_era()
+    Cookie.objects.create(user=cls.era.user, name=views.COOKIE_NAME, value='test')
+    make_history(cls.era, [('w', 20000), ('p', 15000), (None, 9000), ('w', 5000), ('p', 600)])
+    WorkTimesDatabase(cls.era.user, era=cls.era).add_elapsed('w', 300, era=cls.era)
+
+  def setUp(self):
+    get_cache().clear()
+
+  def get_main(self, **params):
+    request = RequestFactory().get('/worktime', params)
+    request.COOKIES[views.COOKIE_NAME] = 'test'
+    response = views.main(request)
+    self.assertEqual(response.status_code, 200)
+    return response
+
+  def test_query_budget(self):
+    budgets = {'2h':SUMMARY_QUERIES, '15m,1h,2h,6h':SUMMARY_QUERIES,
+               '2h,1d':SUMMARY_QUERIES+ROLLUP_QUERIES,
+               '15m,1h,2h,6h,1d,1w,4w':SUMMARY_QUERIES+ROLLUP_QUERIES}
+    for format in ('html', 'json', 'plain'):
+      for timespans, budget in budgets.items():
+        with self.subTest(format=format, timespans=timespans):
+          get_cache().clear()
+          with self.assertNumQueries(budget):
+            self.get_main(format=format, timespans=timespans)
+
+  def test_window_engines(self):
+    """Totaling the windows in SQL or in memory should give the same summary."""
+    summaries = {}
+    with mock.patch('time.time', return_value=time.time()):
+      for engine in ('sql', 'memory'):
+        with self.settings(WORKTIME_WINDOW_ENGINE=engine):
+          get_cache().clear()
+          response = self.get_main(format='json', numbers='values', timespans='15m,1h,2h,6h')
+          summaries[engine] = json.loads(response.content)
+    self.assertEqual(summaries['sql'], summaries['memory'])
+
+  def get_meta(self, **headers):
+    request = RequestFactory().get('/worktime/meta', **headers)
+    request.COOKIES[views.COOKIE_NAME] = 'test'
+    return views.meta(request)
+
+  def test_meta(self):
+    summary = json.loads(self.get_main(format='json', meta='hash').content)
+    full = json.loads(self.get_main(format='json').content)
+    with self.assertNumQueries(META_QUERIES):
+      response = self.get_meta()
+    self.assertEqual(json.loads(response.content),
+                     {key:full[key] for key in views.META_KEYS})
+    self.assertEqual(response['ETag'], '"{}"'.format(summary['meta_hash']))
+    with self.assertNumQueries(META_QUERIES):
+      self.assertEqual(self.get_meta(HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+  def test_invalid_parameter(self):
+    for params in ({'format':'xml'}, {'timespans':'2x'}, {'asof':'yesterday'}):
+      with self.subTest(**params):
+        request = RequestFactory().get('/worktime', params)
+        request.COOKIES[views.COOKIE_NAME] = 'test'
+        self.assertEqual(views.main(request).status_code, 400)
+
+  def test_snapshot_not_reused(self):
+    """A summary's data shouldn't stick around for later calls on the same instance."""
+    work_times = WorkTimesDatabase(self.era.user, era=self.era)
+    work_times.get_summary()
+    other = WorkTimesDatabase(self.era.user, era=self.era)
+    other.add_elapsed('p', 60, era=self.era)
+    self.assertEqual(work_times.get_all_elapsed(), other.get_all_elapsed())
+    mode, elapsed = work_times.get_status()
+    later = time.time() + 100
+    with mock.patch('time.time', return_value=later):
+      self.assertEqual(work_times.get_status(), (mode, elapsed+100))
+
+
+@override_settings(WORKTIME_METRICS=True, WORKTIME_METRICS_TOKEN='secret')
+class MetricsTests(TestCase):
+
+  def get_metrics(self, user=None, **headers):
+    request = RequestFactory().get('/worktime/metrics', **headers)
+    if user is not None:
+      request.user = user
+    return views.metrics(request)
+
+  def test_public(self):
+    self.assertEqual(self.get_metrics().status_code, 403)
+    self.assertEqual(self.get_metrics(HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+    user = types.SimpleNamespace(is_active=True, is_staff=False)
+    self.assertEqual(self.get_metrics(user).status_code, 403)
+
+  def test_token(self):
+    self.assertEqual(self.get_metrics(HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+
+  def test_staff(self):
+    user = types.SimpleNamespace(is_active=True, is_staff=True)
+    self.assertEqual(self.get_metrics(user).status_code, 200)
+
+  @override_settings(WORKTIME_METRICS_TOKEN=None)
+  def test_no_token(self):
+    self.assertEqual(self.get_metrics(HTTP_AUTHORIZATION='Bearer ').status_code, 403)
+
+
+class EventsTests(TestCase):
+
+  @classmethod
+  def setUpTestData(cls):
+    cls.era = make_era()
+    Cookie.objects.create(user=cls.era.user, name=views.COOKIE_NAME, value='test')
+
+  def setUp(self):
+    # Start each test with a new broker, without the events of the last one.
+    patcher = mock.patch.object(events, '_broker', None)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def get_events(self):
+    request = RequestFactory().get('/worktime/events')
+    request.COOKIES[views.COOKIE_NAME] = 'test'
+    return views.events(request)
+
+  def switch(self):
+    with self.captureOnCommitCallbacks(execute=True):
+      WorkTimesDatabase(self.era.user, era=self.era).switch_mode('w', era=self.era)
+    return events.get_broker().listen(self.era.user.id, 0, timeout=0)
+
+  def test_off_by_default(self):
+    # Pages poll instead.
+    self.assertEqual(self.get_events().status_code, 204)
+    self.assertEqual(self.switch(), [])
+
+  @override_settings(WORKTIME_EVENTS=True)
+  def test_on(self):
+    response = self.get_events()
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(response['Content-Type'], 'text/event-stream')
+    response.close()
+    self.assertEqual([event['kind'] for event in self.switch()], ['change'])
+
+
+class IdempotencyTests(TestCase):
+  """Retrying a change with the same Idempotency-Key should only ever make it once."""
+
+  @classmethod
+  def setUpTestData(cls):
+    cls.user = User.objects.create(name='test')
+    Cookie.objects.create(user=cls.user, name=views.COOKIE_NAME, value='test')
+
+  def adjust(self, key='abc'):
+    request = RequestFactory().post('/worktime/adjust', {'mode':'w', 'add':'5', 'format':'json'},
+                                    HTTP_IDEMPOTENCY_KEY=key)
+    request.COOKIES[views.COOKIE_NAME] = 'test'
+    return views.adjust(request)
+
+  def make_key(self, created, key='abc'):
+    request = RequestFactory().post('/worktime/adjust', {'mode':'w', 'add':'5', 'format':'json'})
+    request_data = request.get_full_path().encode('utf-8')+b'\n'+request.body
+    return IdempotencyKey.objects.create(user=self.user, key=key, created=created,
+                                         request_hash=hashlib.sha256(request_data).hexdigest())
+
+  def test_replay(self):
+    self.assertEqual(self.adjust().status_code, 200)
+    response = self.adjust()
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(response['Idempotent-Replayed'], 'true')
+    self.assertEqual(Adjustment.objects.count(), 1)
+
+  def test_error_after_change(self):
+    with mock.patch.object(views, 'change_response', side_effect=RuntimeError):
+      with self.assertRaises(RuntimeError):
+        self.adjust()
+    self.assertEqual(Adjustment.objects.count(), 0)
+    self.assertEqual(self.adjust().status_code, 200)
+    self.assertEqual(Adjustment.objects.count(), 1)
+
+  def test_server_error_after_change(self):
+    with mock.patch.object(views, 'change_response', return_value=views.HttpResponse(status=500)):
+      self.assertEqual(self.adjust().status_code, 500)
+    self.assertEqual(Adjustment.objects.count(), 0)
+    self.assertFalse(IdempotencyKey.objects.exists())
+
+  def test_pending(self):
+    self.make_key(int(time.time()))
+    self.assertEqual(self.adjust().status_code, 409)
+    self.assertEqual(Adjustment.objects.count(), 0)
+
+  def test_abandoned(self):
+    self.make_key(int(time.time()) - views.IDEMPOTENCY_PENDING_TIMEOUT - 1)
+    self.assertEqual(self.adjust().status_code, 200)
+    self.assertEqual(Adjustment.objects.count(), 1)
+    self.assertIsNotNone(IdempotencyKey.objects.get(key='abc').status)
+
+  def test_clean(self):
+    self.make_key(int(time.time()) - views.IDEMPOTENCY_KEY_TTL - 1, key='old')
+    self.make_key(int(time.time()), key='new')
+    call_command('clean_idempotency_keys', stdout=io.StringIO())
+    self.assertEqual([key.key for key in IdempotencyKey.objects.all()], ['new'])
+
+
+class AcceptEncodingTests(unittest.TestCase):
+
+  def test_accepts_encoding(self):
+    headers = {'gzip':True, 'gzip, deflate, br':True, 'deflate, GZIP;q=0.5':True, '*':True,
+               '':False, 'deflate':False, 'gzip;q=0':False, 'gzip; q=0.0, deflate':False,
+               '*;q=0':False, 'gzip;q=0, *':False, 'br, *;q=0.1':True, 'gzip;q=abc':False}
+    for header, expected in headers.items():
+      with self.subTest(header=header):
+        request = RequestFactory().get('/worktime/export', HTTP_ACCEPT_ENCODING=header)
+        self.assertEqual(views.accepts_encoding(request, 'gzip'), expected)
+
+
+class CumulativeTests(TestCase):
+  """The totals recorded on each Period, and the as-of totals made from them."""
+
+  def setUp(self):
+    self.era = make_era()
+    self.work_times = WorkTimesDatabase(self.era.user, era=self.era)
+    self.start = int(time.time()) - 1000
+
+  def switch(self, mode, offset):
+    self.work_times.switch_mode(mode, era=self.era, now=self.start+offset)
+
+  def get_cumulatives(self):
+    cumulatives = []
+    for period in Period.objects.filter(era=self.era).order_by('start', 'id'):
+      cumulatives.append({mode:elapsed for mode, elapsed in period.cumulative_totals.items()
+                          if elapsed})
+    return cumulatives
+
+  def assertRebuildMatches(self):
+    live = self.get_cumulatives()
+    Period.objects.filter(era=self.era).update(cumulative=None)
+    self.work_times.rebuild_cumulative(self.era)
+    self.assertEqual(self.get_cumulatives(), live)
+
+  def test_same_second_adjustments(self):
+    self.switch('w', 0)
+    # Made just before the switch to 'p', in the same second.
+    self.work_times.add_elapsed('w', 30, era=self.era, now=self.start+100)
+    self.switch('p', 100)
+    # Backdated to before the switch, so it's clamped to the second 'p' started.
+    self.work_times.add_elapsed('w', 50, era=self.era, now=self.start+10)
+    asof = self.work_times.get_totals_asof
+    self.assertEqual(asof(self.start+99), {'w':99})
+    self.assertEqual(asof(self.start+100), {'w':180, 'p':0})
+    self.assertEqual(asof(self.start+110), {'w':180, 'p':10})
+    self.assertEqual(self.work_times.get_totals_between(self.start+99, self.start+110),
+                     {'w':81, 'p':10})
+    self.assertRebuildMatches()
+
+  def test_switch_to_no_mode(self):
+    self.switch('w', 0)
+    self.switch(None, 100)
+    self.switch('p', 300)
+    self.assertEqual(self.work_times.get_all_elapsed(), {'w':100})
+    self.assertEqual(self.work_times.get_totals_asof(self.start+400), {'w':100, 'p':100})
+    self.assertRebuildMatches()
+
+
+  def import_adjustments(self, *adjustments):
+    records = [{'type':'adjustment', 'mode':mode, 'delta':delta, 'timestamp':self.start+offset}
+               for mode, delta, offset in adjustments]
+    self.work_times.import_history(records, era=self.era)
+
+  def test_import_backdated_adjustment(self):
+    self.switch('w', 0)
+    self.switch('p', 500)
+    self.switch('w', 900)
+    self.import_adjustments(('w', 300, 100))
+    self.assertEqual(self.work_times.get_totals_asof(self.start+950), {'w':850, 'p':400})
+    self.assertRebuildMatches()
+
+  def test_import_unsorted_adjustments(self):
+    self.switch('w', 0)
+    self.switch('p', 500)
+    self.switch('w', 900)
+    self.import_adjustments(('w', 20, 950), ('p', 70, 50))
+    self.assertEqual(self.work_times.get_totals_asof(self.start+990), {'w':610, 'p':470})
+    self.assertRebuildMatches()
+
+  def test_import_periods(self):
+    records = [{'type':'period', 'mode':'w', 'start':self.start, 'end':self.start+100},
+               {'type':'adjustment', 'mode':'p', 'delta':50, 'timestamp':self.start+150},
+               {'type':'period', 'mode':'p', 'start':self.start+200, 'end':self.start+300}]
+    self.assertEqual(self.work_times.import_history(records, era=self.era), (2, 1))
+    self.assertEqual(self.work_times.get_all_elapsed(), {'w':100, 'p':150})
+    self.assertEqual(self.get_cumulatives(), [{}, {'w':100, 'p':50}])
+    self.assertRebuildMatches()
+
+
+def make_random_history(rng, now):
+  """Make a random Era's worth of (mode, start, end) Periods, ending with an open one, and
+  (mode, delta, timestamp) Adjustments, plus cutoffs on and around their edges."""
+  periods = []
+  start = now - rng.randint(1000, 200000)
+  while start < now - 1:
+    end = min(start + rng.choice([1, 60, 299, 300, 3600, 20000]), now - 1)
+    periods.append((rng.choice(['w', 'p', 'n', None]), start, end))
+    start = end
+  mode, start, end = periods[-1]
+  periods[-1] = (mode, start, None)
+  adjustments = []
+  for i in range(rng.randint(0, 20)):
+    delta = rng.choice([-1, 1]) * rng.randint(1, 20000)
+    adjustments.append((rng.choice('wpn'), delta, rng.randint(periods[0][1], now)))
+  adjustments.sort(key=lambda adjustment: adjustment[2])
+  edges = [now]
+  for mode, start, end in periods:
+    edges.extend((start, end or now))
+  for mode, delta, timestamp in adjustments:
+    edges.extend((timestamp, timestamp - abs(delta)))
+  cutoffs = []
+  for edge in rng.sample(edges, min(len(edges), 8)):
+    cutoffs.append(min(now, edge + rng.choice([-1, 0, 0, 1])))
+  return periods, adjustments, cutoffs
+
+
+def nonzero(all_totals):
+  return [{mode:seconds for mode, seconds in totals.items() if seconds} for totals in all_totals]
+
+
+class ConcurrencyTests(TransactionTestCase):
+  """Switches and adjustments posted at once from several threads (each with its own connection)
+  shouldn't lose changes or leave more than one Period open."""
+
+  workers = 8
+  operations = 50
+
+  def stress(self, seed, deltas):
+    rng = random.Random(seed)
+    factory = RequestFactory()
+    my_deltas = []
+    try:
+      for i in range(self.operations):
+        choice = rng.random()
+        mode = rng.choice(('w', 'p', 'n'))
+        if choice < 0.2:
+          view, params, delta = views.adjust, {'mode':mode, 'add':'2'}, 120
+        elif choice < 0.4:
+          view, params, delta = views.adjust, {'mode':mode, 'subtract':'1'}, -60
+        else:
+          view, params, delta = views.switch, {'mode':mode}, None
+        for attempt in range(DATABASE_ATTEMPTS):
+          request = factory.post('/worktime/'+view.__name__, params)
+          request.COOKIES[views.COOKIE_NAME] = 'test'
+          try:
+            response = view(request)
+            break
+          except OperationalError:
+            time.sleep(rng.random() * 0.01 * 2**min(attempt, 6))
+        else:
+          raise AssertionError('Gave up after {} tries.'.format(DATABASE_ATTEMPTS))
+        assert response.status_code == 302, response.status_code
+        if delta is not None:
+          my_deltas.append((mode, delta))
+        time.sleep(rng.random()/1000)
+    finally:
+      connection.close()
+    deltas[seed] = my_deltas
+
+  def test_switch_mode(self):
+    era = make_era(views.DEFAULT_ERA_NAME)
+    Cookie.objects.create(user=era.user, name=views.COOKIE_NAME, value='test')
+    deltas = {}
+    threads = [threading.Thread(target=self.stress, args=(seed, deltas))
+               for seed in range(self.workers)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(len(deltas), self.workers, 'A thread failed.')
+    self.assertEqual(Era.objects.count(), 1)
+    self.assertEqual(Period.objects.filter(era=era, end=None).count(), 1)
+    posted = sorted(delta for my_deltas in deltas.values() for delta in my_deltas)
+    adjustments = sorted(Adjustment.objects.filter(era=era).values_list('mode', 'delta'))
+    self.assertEqual(adjustments, posted)
+    expected = {}
+    for mode, start, end in Period.objects.filter(era=era).values_list('mode', 'start', 'end'):
+      if mode is not None and end is not None:
+        expected[mode] = expected.get(mode, 0) + end - start
+    for mode, delta in adjustments:
+      expected[mode] = expected.get(mode, 0) + delta
+    totals = dict(Total.objects.filter(era=era).values_list('mode', 'elapsed'))
+    self.assertEqual(totals, expected)
+
+
+class WindowTotalsTests(TestCase):
+  """The NumPy and SQL versions of clip_totals() should give the same results as the pure Python
+  one."""
+
+  def get_histories(self):
+    rng = random.Random(1)
+    now = int(time.time())
+    for i in range(30):
+      yield make_random_history(rng, now) + (now,)
+
+  @unittest.skipIf(import_numpy() is None, 'NumPy is not installed.')
+  def test_numpy(self):
+    for periods, adjustments, cutoffs, now in self.get_histories():
+      expected = clip_totals_python(periods, adjustments, cutoffs, now)
+      self.assertEqual(clip_totals(periods, adjustments, cutoffs, now), expected)
+
+  def test_sql(self):
+    for periods, adjustments, cutoffs, now in self.get_histories():
+      era = make_era()
+      Period.objects.bulk_create([Period(era=era, mode=mode, start=start, end=end)
+                                  for mode, start, end in periods])
+      Adjustment.objects.bulk_create([Adjustment(era=era, mode=mode, delta=delta,
+                                                 timestamp=timestamp)
+                                      for mode, delta, timestamp in adjustments])
+      work_times = WorkTimesDatabase(era.user, era=era)
+      expected = clip_totals_python(periods, adjustments, cutoffs, now)
+      self.assertEqual(nonzero(work_times._query_window_totals(era.id, cutoffs, now)),
+                       nonzero(expected))
+
+
+class SQLiteTests(unittest.TestCase):
+  """The command line's SQLite backend."""
+
+  def setUp(self):
+    temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(temp_dir.cleanup)
+    self.dir = pathlib.Path(temp_dir.name)
+    self.log_path = self.dir/'worklog.txt'
+    self.status_path = self.dir/'workstatus.txt'
+
+  def make_work_times(self):
+    return WorkTimesSQLite(db_path=self.dir/'worktime.sqlite3', log_path=self.log_path,
+                           status_path=self.status_path)
+
+  def test_hidden_mode_not_totaled(self):
+    work_times = self.make_work_times()
+    now = int(time.time())
+    with mock.patch('time.time', return_value=now-100):
+      work_times.switch_mode('w')
+    with mock.patch('time.time', return_value=now-60):
+      work_times.switch_mode('s')
+    with mock.patch('time.time', return_value=now):
+      work_times.switch_mode('p')
+    self.assertEqual(work_times.get_all_elapsed(), {'w':40})
+
+  def test_import_files(self):
+    self.log_path.write_text('w\t100\np\t30\n')
+    work_times = self.make_work_times()
+    self.assertEqual(work_times.get_all_elapsed(), {'w':100, 'p':30})
+    # Reading the old files shouldn't leave a journal behind.
+    self.assertFalse(WorkTimesFiles(log_path=self.log_path).journal_path.exists())
+
+
+class FilesTests(unittest.TestCase):
+  """The command line's text file backend."""
+
+  def test_concurrent_changes(self):
+    """Changes made from several processes at once should all be counted, once."""
+    with tempfile.TemporaryDirectory() as data_dir:
+      paths = {'log_path':pathlib.Path(data_dir, 'worklog.txt'),
+               'status_path':pathlib.Path(data_dir, 'workstatus.txt')}
+      # Speed up the clock, so the switches add up to a few minutes.
+      switched, expected_switched, adjusted, expected_adjusted = check_files(paths, 8, 50, 1,
+                                                                             pause=0.01,
+                                                                             speedup=1000)
+    self.assertGreater(expected_switched, 100)
+    self.assertEqual(switched, expected_switched)
+    self.assertEqual(adjusted, expected_adjusted)
+
+
+@unittest.skipIf(import_requests() is None, 'requests is not installed.')
+class QueueTests(unittest.TestCase):
+  """The command line's queue of changes made while the website couldn't be reached."""
+
+  def setUp(self):
+    temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(temp_dir.cleanup)
+    self.queue_path = pathlib.Path(temp_dir.name)/'workqueue.jsonl'
+    self.work_times = WorkTimesWeb(api_endpoint='http://127.0.0.1:1', retries=0,
+                                   queue_path=self.queue_path)
+
+  def test_rejected_queue(self):
+    queued = {'type':'switch', 'mode':'w', 'timestamp':int(time.time())-60, 'id':'abc'}
+    self.queue_path.write_text(json.dumps(queued)+'\n')
+    response = {'summary':{}, 'results':[['w', 60]]}
+    with mock.patch.object(self.work_times, '_make_request',
+                           side_effect=[WorkTimeError('HTTP 422'), response]) as make_request:
+      with self.assertLogs(level='ERROR'):
+        self.assertEqual(self.work_times.switch_mode('p'), ('w', 60))
+    self.assertEqual(make_request.call_count, 2)
+    self.assertEqual(self.queue_path.read_text(), '')
+    rejected_path = self.queue_path.with_name('workqueue.jsonl.rejected')
+    self.assertEqual([json.loads(line) for line in rejected_path.read_text().splitlines()],
+                     [queued])
+    # The next change doesn't try the rejected ones again.
+    with mock.patch.object(self.work_times, '_make_request', return_value=response) as make_request:
+      self.work_times.switch_mode('w')
+    self.assertEqual(make_request.call_count, 1)
@@ -12,4 +12,10 @@ urlpatterns = [
   re_path(r'renamera$', views.renamera, name='renamera'),
   re_path(r'clear$', views.clear, name='clear'),
   re_path(r'settings$', views.settings, name='settings'),
+  re_path(r'events$', views.events, name='events'),
+  re_path(r'export$', views.export, name='export'),
+  re_path(r'import$', views.import_history, name='import'),
+  re_path(r'batch$', views.batch, name='batch'),
+  re_path(r'meta$', views.meta, name='meta'),
+  re_path(r'metrics$', views.metrics, name='metrics'),
 ]
@@ -1,20 +1,48 @@
+import functools
+import hashlib
 import json
 import logging
 import time
-from django.conf import settings
-from django.db import transaction
+from django.conf import settings as django_settings
+from django.db import IntegrityError, transaction
 from django.http import HttpResponse, HttpResponseRedirect, HttpResponseNotAllowed
+from django.http import StreamingHttpResponse
 from django.shortcuts import render, reverse
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.text import compress_sequence
 from django.views.decorators.csrf import csrf_exempt
-from .models import Era, Period, User, Cookie
-from .worktime import MODES, MODES_META, WorkTimesDatabase, timestring
+from django.views.decorators.http import condition
+from django.views.decorators.vary import vary_on_cookie
+from .events import events_enabled, get_broker
+from .metrics import instrument, time_phase, metrics_enabled, can_read_metrics, expose_metrics
+from .profiling import PROFILERS, can_profile, profile
+from .models import Era, Period, User, Cookie, IdempotencyKey
+from .worktime import MODES, MODES_META, EXPORT_FORMATS, WorkTimesDatabase, WorkTimeError
+from .worktime import format_history, parse_history, parse_timespan, timestring
 from utils.queryparams import QueryParams, boolish
 log = logging.getLogger(__name__)
 
 HISTORY_BAR_TIMESPAN = 2*60*60
+DEFAULT_TIMESPANS = (12*60*60, 2*60*60)
+MAX_TIMESPANS = 12
 COOKIE_NAME = 'visitors_v1'
 DEFAULT_ERA_NAME = 'Project 1'
 COLORS = {'p':'red', 'w':'green', 'n':'bluegray'}
+# The summary only displays minutes, so an unchanged state gives the same response for this long.
+ETAG_TIME_BUCKET = 60
+# Close event streams after this many seconds, so they don't tie up a worker forever.
+# The client reconnects automatically, and picks up where it left off.
+EVENT_STREAM_MAX_AGE = 5*60
+# How long to remember Idempotency-Keys (and the responses to them) for. The
+# clean_idempotency_keys management command deletes the ones older than this.
+IDEMPOTENCY_KEY_TTL = 24*60*60
+# How long a request with an Idempotency-Key can run before a retry assumes it died, and takes over.
+IDEMPOTENCY_PENDING_TIMEOUT = 60
+# The parts of the summary which rarely change. Clients polling for updates can ask for summaries
+# with just a hash of these (meta=hash), and only fetch them from the `meta` view when it changes.
+META_KEYS = ('modes', 'modes_meta', 'modes_list', 'era', 'eras', 'settings')
+# How long clients can keep the metadata for a given hash.
+META_MAX_AGE = 365*24*60*60
 
 #TODO: Improve experience for first-time visitors:
 #      1. Write some introduction at the top.
@@ -34,6 +62,7 @@ COLORS = {'p':'red', 'w':'green', 'n':'bluegray'}
 
 
 def require_post_and_cookie(view):
+  @functools.wraps(view)
   def wrapper(request):
     if request.method != 'POST':
       log.warning('Wrong method.')
@@ -45,75 +74,363 @@ def require_post_and_cookie(view):
   return wrapper
 
 
+def idempotent(view):
+  """Let clients safely retry a request that changes data, by sending an Idempotency-Key header.
+  The first time we see a key, the view runs normally and we store its response, in the same
+  transaction as its changes. A repeat of the same request gets the stored response without running
+  the view again. A request that reuses a key with different contents is refused with a 422, and
+  one that arrives while the first is still running gets a 409. If the first one has been running
+  for over IDEMPOTENCY_PENDING_TIMEOUT seconds, it's assumed to have died (its changes were never
+  committed), and the retry takes its place. Keys are forgotten after IDEMPOTENCY_KEY_TTL
+  seconds."""
+  @functools.wraps(view)
+  def wrapper(request):
+    key = request.META.get('HTTP_IDEMPOTENCY_KEY')
+    if not key:
+      return view(request)
+    user = get_or_create_user(request)
+    if user is None:
+      return view(request)
+    key = key[:128]
+    now = int(time.time())
+    request_data = request.get_full_path().encode('utf-8')+b'\n'+request.body
+    request_hash = hashlib.sha256(request_data).hexdigest()
+    try:
+      with transaction.atomic():
+        record = IdempotencyKey.objects.create(user=user, key=key, request_hash=request_hash,
+                                               created=now)
+    except IntegrityError:
+      record = IdempotencyKey.objects.filter(user=user, key=key).first()
+      if record is None:
+        return view(request)
+      if record.created < now-IDEMPOTENCY_KEY_TTL:
+        # It's expired, but hasn't been cleaned up yet.
+        record.request_hash = request_hash
+        record.status = None
+      elif record.request_hash != request_hash:
+        return HttpResponse('Idempotency-Key was already used for a different request.',
+                            status=422, content_type=django_settings.PLAINTEXT)
+      elif record.status is not None:
+        log.info('Replaying response to Idempotency-Key {!r}.'.format(key))
+        response = HttpResponse(record.content, status=record.status,
+                                content_type=record.content_type)
+        if record.location:
+          response['Location'] = record.location
+        response['Idempotent-Replayed'] = 'true'
+        return response
+      elif record.created >= now-IDEMPOTENCY_PENDING_TIMEOUT:
+        return HttpResponse('A request with this Idempotency-Key is still being processed.',
+                            status=409, content_type=django_settings.PLAINTEXT)
+      else:
+        log.warning('Taking over abandoned request with Idempotency-Key {!r}.'.format(key))
+      # Claim the key, unless another retry got to it first.
+      claimed = (IdempotencyKey.objects.filter(pk=record.pk, created=record.created)
+                                       .update(request_hash=request_hash, status=None, created=now))
+      if not claimed:
+        return HttpResponse('A request with this Idempotency-Key is still being processed.',
+                            status=409, content_type=django_settings.PLAINTEXT)
+      record.created = now
+    # The key's `created` time marks which request holds it. Only keep the view's changes if this
+    # one still does when it's done.
+    pending = IdempotencyKey.objects.filter(pk=record.pk, created=record.created, status=None)
+    try:
+      with transaction.atomic():
+        response = view(request)
+        if response.streaming or response.status_code >= 500:
+          transaction.set_rollback(True)
+        else:
+          saved = pending.update(status=response.status_code,
+                                 content_type=response.get('Content-Type', ''),
+                                 location=response.get('Location', ''),
+                                 content=response.content.decode(response.charset))
+          if not saved:
+            log.warning('Lost Idempotency-Key {!r} to a retry.'.format(key))
+            transaction.set_rollback(True)
+            return HttpResponse('A request with this Idempotency-Key is still being processed.',
+                                status=409, content_type=django_settings.PLAINTEXT)
+    except Exception:
+      # Nothing was changed, so let the client try again.
+      pending.delete()
+      raise
+    if response.streaming or response.status_code >= 500:
+      pending.delete()
+    return response
+  return wrapper
+
+
+def summary_etag(request):
+  """Make a validator for the json and plain summaries, which only change when the era is written
+  to or as time passes. Computing it takes no summary work, so a 304 is cheap."""
+  if request.GET.get('format') not in ('json', 'plain') or request.GET.get('profile'):
+    return None
+  user = get_user(request)
+  work_times = WorkTimesDatabase(user, era=get_current_era(request, user))
+  version = work_times.get_version()
+  bucket = int(time.time()) // ETAG_TIME_BUCKET
+  validator = '{}:{}:{}:{}'.format(getattr(user, 'id', None), version, bucket,
+                                   request.GET.urlencode())
+  return hashlib.sha1(validator.encode('utf8')).hexdigest()
+
+
 ##### Views #####
 
+@instrument
+@vary_on_cookie
+@condition(etag_func=summary_etag)
 def main(request):
   params = QueryParams()
   params.add('format', choices=('html', 'plain', 'json'), default='html')
   params.add('numbers', choices=('values', 'text'), default='text')
+  params.add('timespans', type=parse_timespans, default=DEFAULT_TIMESPANS)
+  params.add('asof', type=int)
+  params.add('from', type=int)
+  params.add('to', type=int)
   params.add('debug', type=boolish)
+  params.add('meta', choices=('full', 'hash'), default='full')
+  params.add('profile', choices=PROFILERS)
   params.parse(request.GET)
+  if params.invalid_value:
+    return HttpResponse('Invalid parameter.', status=400, content_type=django_settings.PLAINTEXT)
+  if params['profile']:
+    # Profile this one request, returning the results instead of the usual response.
+    if not can_profile(request):
+      return HttpResponse('Only staff can profile requests.', status=403,
+                          content_type=django_settings.PLAINTEXT)
+    log.info('Profiling request with {}.'.format(params['profile']))
+    report = profile(params['profile'], render_main, request, params)
+    response = HttpResponse(report, content_type=django_settings.PLAINTEXT)
+    patch_cache_control(response, private=True, no_store=True)
+    return response
+  return render_main(request, params)
+
+def render_main(request, params):
+  if params['from'] is not None or params['to'] is not None:
+    between = (params['from'] or 0, params['to'] or int(time.time()))
+  else:
+    between = None
   user = get_user(request)
-  abbrev = getattr(user, 'abbrev', User.get_default('abbrev'))
-  work_times = WorkTimesDatabase(user, abbrev=abbrev)
-  summary = work_times.get_summary(numbers=params['numbers'], timespans=(12*60*60, 2*60*60))
-  #TODO: Provide metadata via a separate API?
-  #      Then the client can just fetch it once per session.
-  summary['modes'] = MODES
-  summary['modes_meta'] = MODES_META
-  apply_colors(summary, COLORS)
-  context = build_context(summary, MODES, MODES_META, abbrev)
+  context = get_summary_context(user, numbers=params['numbers'], timespans=params['timespans'],
+                                era=get_current_era(request, user),
+                                asof=params['asof'], between=between)
   context['debug'] = params['debug']
-  if params['format'] == 'html':
-    return render(request, 'worktime/main.tmpl', context)
-  elif params['format'] == 'json':
-    return HttpResponse(json.dumps(context), content_type='application/json')
-  elif params['format'] == 'plain':
-    lines = []
-    lines.append('status\t{current_mode}\t{current_elapsed}'.format(**summary))
-    for elapsed in summary['elapsed']:
-      lines.append('total\t{mode}\t{time}'.format(**elapsed))
-    for ratio in summary['ratios']:
-      lines.append('ratio\t{0}\t{timespan}\t{value}'.format(summary['ratio_str'], **ratio))
-    return HttpResponse('\n'.join(lines), content_type=settings.PLAINTEXT)
+  with time_phase('render'):
+    if params['format'] == 'html':
+      return render(request, 'worktime/main.tmpl', context)
+    elif params['format'] == 'json':
+      if params['meta'] == 'hash':
+        context = split_meta(context)[0]
+      response = HttpResponse(json.dumps(context), content_type='application/json')
+      # Make clients check back with us (using the ETag) before using a stored copy.
+      patch_cache_control(response, private=True, no_cache=True)
+      return response
+    elif params['format'] == 'plain':
+      lines = []
+      lines.append('status\t{current_mode}\t{current_elapsed}'.format(**context))
+      for elapsed in context['elapsed']:
+        lines.append('total\t{mode}\t{time}'.format(**elapsed))
+      ratio_str = '{num}/{denom}'.format(**context['ratio_meta'])
+      for ratio in context['ratios']:
+        lines.append('ratio\t{0}\t{timespan}\t{value}'.format(ratio_str, **ratio))
+      if 'asof' in context:
+        for elapsed in context['asof']['elapsed']:
+          lines.append('asof\t{0}\t{mode}\t{time}'.format(context['asof']['timestamp'], **elapsed))
+      if 'between' in context:
+        for elapsed in context['between']['elapsed']:
+          lines.append('between\t{start}-{end}'.format(**context['between'])
+                       +'\t{mode}\t{time}'.format(**elapsed))
+      response = HttpResponse('\n'.join(lines), content_type=django_settings.PLAINTEXT)
+      patch_cache_control(response, private=True, no_cache=True)
+      return response
+
+def meta_etag(request):
+  """The hash of the metadata is all the ETag the `meta` view needs."""
+  return get_meta_hash(get_meta_context(request))
+
+@instrument
+@vary_on_cookie
+@condition(etag_func=meta_etag)
+def meta(request):
+  """The metadata left out of summaries requested with meta=hash: the modes, Eras, and settings.
+  If the "hash" parameter matches the current metadata, the response can be cached for a long
+  time, since any change to the metadata would give a different hash (and URL)."""
+  params = QueryParams()
+  params.add('hash')
+  params.parse(request.GET)
+  metadata = get_meta_context(request)
+  response = HttpResponse(json.dumps(metadata), content_type='application/json')
+  if params['hash'] == get_meta_hash(metadata):
+    patch_cache_control(response, private=True, max_age=META_MAX_AGE, immutable=True)
+  else:
+    patch_cache_control(response, private=True, no_cache=True)
+  return response
+
+def metrics(request):
+  """Timings and query counts of the requests this process has handled, in the Prometheus text
+  format. This is only available if the WORKTIME_METRICS setting is on, and only to staff or
+  requests with the WORKTIME_METRICS_TOKEN (see can_read_metrics())."""
+  if not metrics_enabled():
+    return HttpResponse('Metrics are not enabled.', status=404,
+                        content_type=django_settings.PLAINTEXT)
+  if not can_read_metrics(request):
+    return HttpResponse('Only staff can read the metrics.', status=403,
+                        content_type=django_settings.PLAINTEXT)
+  return HttpResponse(expose_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
-#TODO: For POSTs, let the client send a "redirect=false" parameter to avoid sending a redirect
-#      (that XMLHttpRequest automatically follows and loads). Return a 204 (or maybe 205?) instead.
+def events(request):
+  """A stream of Server-Sent Events announcing each change to the user's data.
+  Each event just carries the new version of the changed Era(s): clients should fetch a new
+  summary when they get one. A 'heartbeat' event is sent when there's been no change in a while,
+  and a 'reset' event if the client reconnected too late to get every change it missed.
+  This is only on if the WORKTIME_EVENTS setting is (see events_enabled()). Otherwise, pages poll
+  for changes."""
+  if request.method != 'GET':
+    return HttpResponseNotAllowed(['GET'])
+  if not events_enabled():
+    # 204 tells EventSource clients not to reconnect.
+    return HttpResponse(status=204)
+  user = get_user(request)
+  if user is None:
+    return HttpResponse(status=204)
+  last_id = request.META.get('HTTP_LAST_EVENT_ID', request.GET.get('lastEventId'))
+  try:
+    last_id = int(last_id)
+  except (TypeError, ValueError):
+    last_id = None
+  response = StreamingHttpResponse(stream_events(user.id, last_id), content_type='text/event-stream')
+  response['Cache-Control'] = 'no-cache'
+  # Tell nginx not to buffer the stream.
+  response['X-Accel-Buffering'] = 'no'
+  return response
 
+@instrument
+def export(request):
+  """Download the full history of an Era (by default, the current one) as CSV or JSONL.
+  The rows are streamed as they're read from the database, gzipped on the fly if the client
+  accepts it."""
+  params = QueryParams()
+  params.add('format', choices=EXPORT_FORMATS, default='csv')
+  params.add('era', type=int)
+  params.parse(request.GET)
+  if params.invalid_value:
+    return HttpResponse('Invalid parameter.', status=400, content_type=django_settings.PLAINTEXT)
+  user = get_user(request)
+  if user is None:
+    return HttpResponse('No history for this user.', status=404,
+                        content_type=django_settings.PLAINTEXT)
+  if params['era'] is None:
+    era = Era.objects.filter(user=user, current=True).first()
+  else:
+    era = Era.objects.filter(user=user, pk=params['era']).first()
+  if era is None:
+    return HttpResponse('Era not found.', status=404, content_type=django_settings.PLAINTEXT)
+  work_times = WorkTimesDatabase(user, era=era)
+  content = format_history(work_times.iter_history(), format=params['format'])
+  if params['format'] == 'csv':
+    content_type = 'text/csv; charset=utf-8'
+  else:
+    content_type = 'application/x-ndjson; charset=utf-8'
+  gzip = accepts_encoding(request, 'gzip')
+  if gzip:
+    content = compress_sequence(chunk.encode('utf-8') for chunk in content)
+  response = StreamingHttpResponse(content, content_type=content_type)
+  if gzip:
+    response['Content-Encoding'] = 'gzip'
+  patch_vary_headers(response, ('Accept-Encoding',))
+  response['Content-Disposition'] = 'attachment; filename="worktime-era{}.{}"'.format(
+    era.id, params['format']
+  )
+  return response
+
+@instrument
+@csrf_exempt
+@require_post_and_cookie
+@idempotent
+def import_history(request):
+  """Add Periods and Adjustments to the current Era in bulk.
+  The request body should be JSONL, in the same format as the export."""
+  user = get_or_create_user(request)
+  assert user is not None
+  work_times = WorkTimesDatabase(user)
+  era = get_or_create_era(user, DEFAULT_ERA_NAME)
+  try:
+    periods, adjustments = work_times.import_history(parse_history(request), era=era)
+  except WorkTimeError as error:
+    log.warning('Invalid import: {}'.format(error))
+    return HttpResponse(str(error), status=400, content_type=django_settings.PLAINTEXT)
+  result = {'periods':periods, 'adjustments':adjustments}
+  return HttpResponse(json.dumps(result), content_type='application/json')
+
+@instrument
 @csrf_exempt
 @require_post_and_cookie
+@idempotent
+def batch(request):
+  """Apply a list of switches and adjustments all at once, and return the resulting summary.
+  The request body should be a JSON object like
+  {"operations": [{"type": "switch", "mode": "w"}, {"type": "adjust", "mode": "p", "delta": 600}]}
+  where each "delta" is in seconds. Either all the operations are applied, or none are.
+  Operations made earlier (e.g. while a client was offline) can give the "timestamp" they were made
+  at, though they can't be placed before the start of the latest Period."""
+  params = QueryParams()
+  params.add('numbers', choices=('values', 'text'), default='text')
+  params.parse(request.GET)
+  try:
+    operations = json.loads(request.body)['operations']
+  except (ValueError, TypeError, KeyError):
+    return HttpResponse('Request body must be a JSON object with a list of "operations".',
+                        status=400, content_type=django_settings.PLAINTEXT)
+  if not isinstance(operations, list) or not all(isinstance(op, dict) for op in operations):
+    return HttpResponse('"operations" must be a list of objects.', status=400,
+                        content_type=django_settings.PLAINTEXT)
+  user = get_or_create_user(request)
+  assert user is not None
+  work_times = WorkTimesDatabase(user)
+  era = get_or_create_era(user, DEFAULT_ERA_NAME)
+  try:
+    results = work_times.apply_batch(operations, era=era)
+  except WorkTimeError as error:
+    log.warning('Invalid batch: {}'.format(error))
+    return HttpResponse(str(error), status=400, content_type=django_settings.PLAINTEXT)
+  context = get_summary_context(user, numbers=params['numbers'])
+  response = HttpResponse(json.dumps({'results':results, 'summary':context}),
+                          content_type='application/json')
+  patch_cache_control(response, private=True, no_cache=True)
+  return response
+
+@instrument
+@csrf_exempt
+@require_post_and_cookie
+@idempotent
 def switch(request):
   params = QueryParams()
   params.add('mode', choices=MODES)
-  params.add('debug', type=boolish)
+  add_response_params(params)
   params.parse(request.POST)
   if params.invalid_value:
     log.warning('Invalid parameter.')
-    return HttpResponseRedirect(reverse('worktime_main'))
+    return change_response(params, error='Invalid parameter.')
   user = get_or_create_user(request)
   assert user is not None
   work_times = WorkTimesDatabase(user)
   era = get_or_create_era(user, DEFAULT_ERA_NAME)
   old_mode, old_elapsed = work_times.switch_mode(params['mode'], era=era)
-  if params['debug']:
-    query_str = '?debug=true'
-  else:
-    query_str = ''
-  return HttpResponseRedirect(reverse('worktime_main')+query_str)
+  return change_response(params, user)
 
+@instrument
 @csrf_exempt
 @require_post_and_cookie
+@idempotent
 def adjust(request):
   params = QueryParams()
   params.add('mode', choices=MODES)
   params.add('add', type=int, min=0, allow_empty=True)
   params.add('subtract', type=int, min=0, allow_empty=True)
-  params.add('debug', type=boolish)
+  add_response_params(params)
   params.parse(request.POST)
   warning = validate_adjust_params(params)
   if warning:
     log.warning(warning)
-    return HttpResponseRedirect(reverse('worktime_main'))
+    return change_response(params, error=warning)
   if params['add'] is not None:
     delta = params['add']
   elif params['subtract'] is not None:
@@ -124,18 +441,15 @@ def adjust(request):
   work_times = WorkTimesDatabase(user)
   era = get_or_create_era(user, DEFAULT_ERA_NAME)
   work_times.add_elapsed(params['mode'], delta*60, era=era)
-  if params['debug']:
-    query_str = '?debug=true'
-  else:
-    query_str = ''
-  return HttpResponseRedirect(reverse('worktime_main')+query_str)
+  return change_response(params, user)
 
+@instrument
 @require_post_and_cookie
 def switchera(request):
   params = QueryParams()
   params.add('era', type=int)  # This is the Era.id (primary key).
   params.add('new-era')        # This is a name for the new Era.
-  params.add('debug', type=boolish)
+  add_response_params(params)
   params.parse(request.POST)
   user = get_or_create_user(request)
   assert user is not None
@@ -154,25 +468,18 @@ def switchera(request):
     dest_era_id = params['era']
   if dest_era_id is not None:
     work_times.switch_era(id=dest_era_id)
-  if params['debug']:
-    query_str = '?debug=true'
-  else:
-    query_str = ''
-  return HttpResponseRedirect(reverse('worktime_main')+query_str)
+  return change_response(params, user)
 
+@instrument
 @require_post_and_cookie
 def renamera(request):
   params = QueryParams()
   params.add('name')
-  params.add('debug', type=boolish)
+  add_response_params(params)
   params.parse(request.POST)
-  if params['debug']:
-    query_str = '?debug=true'
-  else:
-    query_str = ''
   if not params['name']:
     log.warning('Missing or empty name parameter: {!r}'.format(params['name']))
-    return HttpResponseRedirect(reverse('worktime_main')+query_str)
+    return change_response(params, error='Missing or empty name.')
   user = get_or_create_user(request)
   assert user is not None
   work_times = WorkTimesDatabase(user)
@@ -180,27 +487,35 @@ def renamera(request):
   if era.description != params['name']:
     era.description = params['name']
     era.save()
-  return HttpResponseRedirect(reverse('worktime_main')+query_str)
+    work_times.invalidate_cache(era)
+  return change_response(params, user)
 
 
+@instrument
 @csrf_exempt
 @require_post_and_cookie
+@idempotent
 def clear(request):
+  params = QueryParams()
+  add_response_params(params)
+  params.parse(request.POST)
   user = get_or_create_user(request)
   assert user is not None
   work_times = WorkTimesDatabase(user)
   work_times.clear()
-  return HttpResponseRedirect(reverse('worktime_main'))
+  return change_response(params, user)
 
+@instrument
 @require_post_and_cookie
 def settings(request):
   params = QueryParams()
   for setting in User.SETTINGS:
     params.add(setting, choices=('on', 'off'))
+  add_response_params(params)
   params.parse(request.POST)
   if params.invalid_value:
     log.warning('Invalid parameter.')
-    return HttpResponseRedirect(reverse('worktime_main'))
+    return change_response(params, error='Invalid parameter.')
   user = get_or_create_user(request)
   assert user is not None
   changed = False
@@ -215,11 +530,89 @@ def settings(request):
       changed = True
   if changed:
     user.save()
-  return HttpResponseRedirect(reverse('worktime_main'))
+    # The settings are part of the summary, so make sure clients don't keep using an old one.
+    work_times = WorkTimesDatabase(user)
+    work_times.invalidate_cache(work_times.era)
+  return change_response(params, user)
 
 
 ##### Helper functions #####
 
+def add_response_params(params):
+  """Add the parameters that let a client ask a view that changes data for the new summary,
+  instead of a redirect to the main page (which XMLHttpRequest would follow and load)."""
+  params.add('format', choices=('html', 'json'), default='html')
+  params.add('redirect', type=boolish, default=True)
+  params.add('numbers', choices=('values', 'text'), default='text')
+  params.add('timespans', type=parse_timespans, default=DEFAULT_TIMESPANS)
+  params.add('meta', choices=('full', 'hash'), default='full')
+  params.add('debug', type=boolish)
+
+def change_response(params, user=None, error=None):
+  """Respond to a request to change data, after the change is made (or refused, with `error`).
+  Returns the summary as JSON if asked for, or otherwise a redirect to the main page."""
+  if params['format'] == 'json' or not params['redirect']:
+    if error:
+      return HttpResponse(error, status=400, content_type=django_settings.PLAINTEXT)
+    context = get_summary_context(user, numbers=params['numbers'], timespans=params['timespans'])
+    if params['meta'] == 'hash':
+      context = split_meta(context)[0]
+    response = HttpResponse(json.dumps(context), content_type='application/json')
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+  if params['debug']:
+    query_str = '?debug=true'
+  else:
+    query_str = ''
+  return HttpResponseRedirect(reverse('worktime_main')+query_str)
+
+def get_summary_context(user, numbers='text', timespans=DEFAULT_TIMESPANS, era=None, **kwargs):
+  abbrev = getattr(user, 'abbrev', User.get_default('abbrev'))
+  work_times = WorkTimesDatabase(user, era=era, abbrev=abbrev)
+  summary = work_times.get_summary(numbers=numbers, timespans=timespans, **kwargs)
+  summary['modes'] = MODES
+  summary['modes_meta'] = MODES_META
+  apply_colors(summary, COLORS)
+  return build_context(summary, MODES, MODES_META, abbrev)
+
+def get_meta_context(request):
+  """Make just the metadata (META_KEYS) of the summary get_summary_context() would, without the
+  work of making the rest of it."""
+  if hasattr(request, '_worktime_meta'):
+    return request._worktime_meta
+  user = get_user(request)
+  abbrev = getattr(user, 'abbrev', User.get_default('abbrev'))
+  metadata = WorkTimesDatabase(user, era=get_current_era(request, user), abbrev=abbrev).get_meta()
+  metadata['modes'] = MODES
+  metadata['modes_meta'] = MODES_META
+  apply_mode_colors(MODES_META, COLORS)
+  metadata['modes_list'] = make_mode_list(MODES, MODES_META, abbrev)
+  request._worktime_meta = metadata
+  return metadata
+
+def stream_events(user_id, last_id, max_age=EVENT_STREAM_MAX_AGE):
+  broker = get_broker()
+  if last_id is None:
+    # Event ids are millisecond timestamps, so this means "anything published from now on".
+    last_id = int(time.time()*1000) - 1
+  yield 'retry: 5000\n\n'
+  deadline = time.time() + max_age
+  while time.time() < deadline:
+    events = broker.listen(user_id, last_id)
+    if not events:
+      yield 'event: heartbeat\ndata: \n\n'
+    for event in events:
+      last_id = event['id']
+      yield 'id: {}\nevent: {}\ndata: {}\n\n'.format(event['id'], event['kind'],
+                                                     json.dumps(event['data']))
+
+def parse_timespans(timespans_str):
+  """Parse a list of timespans like "15m,1h,1d" into a tuple of seconds."""
+  timespans = tuple(parse_timespan(timespan_str) for timespan_str in timespans_str.split(','))
+  if len(timespans) > MAX_TIMESPANS:
+    raise ValueError('Too many timespans ({} > {}).'.format(len(timespans), MAX_TIMESPANS))
+  return timespans
+
 def validate_adjust_params(params):
   if not params['mode']:
     return f'Invalid mode {params["mode"]!r}.'
@@ -232,6 +625,19 @@ def validate_adjust_params(params):
   else:
     return None
 
+def split_meta(context):
+  """Separate the metadata (META_KEYS) from a summary `context`.
+  Returns the rest of the context, with a hash of the metadata added as 'meta_hash', and the
+  metadata."""
+  summary = {key:value for key, value in context.items() if key not in META_KEYS}
+  metadata = {key:context[key] for key in META_KEYS if key in context}
+  summary['meta_hash'] = get_meta_hash(metadata)
+  return summary, metadata
+
+def get_meta_hash(metadata):
+  meta_json = json.dumps(metadata, sort_keys=True)
+  return hashlib.sha1(meta_json.encode('utf8')).hexdigest()
+
 def build_context(summary, modes, modes_meta, abbrev):
   context = summary.copy()
   context['modes_list'] = make_mode_list(MODES, MODES_META, abbrev)
@@ -258,8 +664,7 @@ def build_totals(summary, modes_meta):
   return totals
 
 def apply_colors(summary, colors):
-  for mode, mode_data in summary['modes_meta'].items():
-    mode_data['color'] = colors.get(mode)
+  apply_mode_colors(summary['modes_meta'], colors)
   summary['current_color'] = colors.get(summary['current_mode'])
   for period in summary['history']['periods']:
     period['color'] = colors.get(period['mode'])
@@ -271,6 +676,10 @@ def apply_colors(summary, colors):
         effective_mode = summary['modes_meta'][mode]['opposite']
     adjustment['color'] = colors.get(effective_mode)
 
+def apply_mode_colors(modes_meta, colors):
+  for mode, mode_data in modes_meta.items():
+    mode_data['color'] = colors.get(mode)
+
 def make_mode_list(modes, modes_meta, abbrev):
   mode_list = []
   for mode in modes:
@@ -283,12 +692,27 @@ def make_mode_list(modes, modes_meta, abbrev):
   return mode_list
 
 def get_user(request):
+  # Remember the result for the rest of the request (the ETag and the view both need it).
+  if hasattr(request, '_worktime_user'):
+    return request._worktime_user
   cookie_value = request.COOKIES.get(COOKIE_NAME)
-  try:
-    cookie = Cookie.objects.get(name=COOKIE_NAME, value=cookie_value)
-  except Cookie.DoesNotExist:
-    return None
-  return cookie.user
+  with time_phase('get_user'):
+    try:
+      cookie = Cookie.objects.select_related('user').get(name=COOKIE_NAME, value=cookie_value)
+      user = cookie.user
+    except Cookie.DoesNotExist:
+      user = None
+  request._worktime_user = user
+  return user
+
+def get_current_era(request, user):
+  """Get the user's current Era, if any, remembering it for the rest of the request like
+  get_user()."""
+  if hasattr(request, '_worktime_era'):
+    return request._worktime_era
+  era = Era.objects.filter(user=user, current=True).first()
+  request._worktime_era = era
+  return era
 
 def get_or_create_user(request):
   user = get_user(request)
@@ -301,6 +725,7 @@ def get_or_create_user(request):
   user.save()
   cookie = Cookie(user=user, name=COOKIE_NAME, value=cookie_value)
   cookie.save()
+  request._worktime_user = user
   return user
 
 def get_or_create_era(user, default_name):
@@ -310,6 +735,28 @@ def get_or_create_era(user, default_name):
     era.save()
   return era
 
+def accepts_encoding(request, coding):
+  """Whether the request's Accept-Encoding header allows the content `coding`: it's listed (or
+  "*" is, and it isn't) with a q-value above 0."""
+  qvalues = {}
+  for item in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+    name, *params = item.split(';')
+    name = name.strip().lower()
+    if not name:
+      continue
+    qvalue = 1
+    for param in params:
+      key, _, value = param.partition('=')
+      if key.strip().lower() == 'q':
+        try:
+          qvalue = float(value)
+        except ValueError:
+          qvalue = 0
+    qvalues[name] = qvalue
+  if coding in qvalues:
+    return qvalues[coding] > 0
+  return qvalues.get('*', 0) > 0
+
 def truncate(s, max_len=100):
   if s is not None and len(s) > max_len:
     return s[:max_len]+'...'
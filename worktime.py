@@ -1,21 +1,30 @@
 #!/usr/bin/env python3
-import argparse
+import bisect
 import collections
+import contextlib
+import csv
+import heapq
+import io
 import json
 import logging
 import os
 import pathlib
 import sys
 import time
-try:
-  import requests
-except ImportError:
-  requests = None
-try:
-  from .models import User, Era, Period, Total, Adjustment
-  from django.db import transaction
-except ImportError:
-  pass
+import types
+# Only load Django when running as part of the website, not as a command line script.
+# The requests module is loaded by import_requests(), only when it's needed.
+if __package__:
+  try:
+    from .models import User, Era, Period, Total, Adjustment, Rollup
+    from .events import events_enabled, get_broker
+    from .metrics import time_phase
+    from django.conf import settings as django_settings
+    from django.core.cache import caches
+    from django.db import models, transaction
+    from django.db.models.functions import Coalesce, Greatest, Least
+  except ImportError:
+    pass
 assert sys.version_info.major >= 3, 'Python 3 required'
 
 MODES  = ['w','p','n','s']
@@ -30,10 +39,77 @@ RATIO_MODES = ('p', 'w')
 DATA_DIR     = pathlib.Path('~/.local/share/nbsdata').expanduser()
 LOG_PATH     = DATA_DIR / 'worklog.txt'
 STATUS_PATH  = DATA_DIR / 'workstatus.txt'
+SOCKET_PATH  = DATA_DIR / 'worktime.sock'
+JOURNAL_PATH = DATA_DIR / 'workjournal.txt'
+SQLITE_PATH  = DATA_DIR / 'worktime.sqlite3'
+QUEUE_PATH   = DATA_DIR / 'workqueue.jsonl'
+LAST_SUMMARY_PATH = DATA_DIR / 'worklastsummary.json'
 API_ENDPOINT = 'https://nstoler.com/worktime'
 COOKIE_NAME  = 'visitors_v1'
+# Compact the file backend's journal into the status and log files once it has this many records.
+JOURNAL_COMPACT_SIZE = 100
 TIMEOUT = 5
+# How long to wait to connect to the daemon, and for it to answer (it may be retrying requests).
+DAEMON_CONNECT_TIMEOUT = 1
+DAEMON_TIMEOUT = 60
+# How many times to retry failed requests to the website, and how long to wait before the first
+# retry (the wait doubles each time).
+RETRIES = 3
+RETRY_BACKOFF = 0.5
+RETRY_STATUSES = (409, 500, 502, 503, 504)
+# Responses which mean the website is down, so changes should be queued until it's back.
+OFFLINE_STATUSES = (502, 503, 504)
+# How many connections to the website to keep open for reuse.
+POOL_SIZE = 4
 USER_AGENT = 'worktime/0.1'
+# How long a cached summary snapshot lives, if it's never invalidated by a write.
+SNAPSHOT_CACHE_TIMEOUT = 24*60*60
+# Sizes of the time buckets in the Rollup table, in seconds.
+ROLLUP_SIZES = (60*60, 5*60)
+# Ratios over timespans at least this long are totaled from the Rollup table, not every Period.
+ROLLUP_MIN_TIMESPAN = 24*60*60
+# Fields of each row in an exported history.
+EXPORT_FIELDS = ('type', 'mode', 'start', 'end', 'delta', 'timestamp')
+EXPORT_FORMATS = ('csv', 'jsonl')
+# How many characters of exported history to collect before sending them on.
+EXPORT_CHUNK_SIZE = 64*1024
+# Timespans of the recent ratios in reports, for data sources with the full history.
+REPORT_TIMESPANS = (12*60*60, 2*60*60)
+# The tables of the --database backend, in the same shape as the website's models. Bump the
+# version when changing them.
+SQLITE_SCHEMA_VERSION = 1
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS era (
+  id INTEGER PRIMARY KEY,
+  description TEXT NOT NULL DEFAULT '',
+  current INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS period (
+  id INTEGER PRIMARY KEY,
+  era_id INTEGER NOT NULL REFERENCES era (id),
+  mode TEXT,
+  start INTEGER NOT NULL,
+  "end" INTEGER
+);
+CREATE INDEX IF NOT EXISTS period_era_end ON period (era_id, "end");
+CREATE INDEX IF NOT EXISTS period_era_start ON period (era_id, start);
+CREATE UNIQUE INDEX IF NOT EXISTS period_era_current ON period (era_id) WHERE "end" IS NULL;
+CREATE TABLE IF NOT EXISTS adjustment (
+  id INTEGER PRIMARY KEY,
+  era_id INTEGER NOT NULL REFERENCES era (id),
+  mode TEXT NOT NULL,
+  delta INTEGER NOT NULL,
+  timestamp INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS adjustment_era_timestamp ON adjustment (era_id, timestamp);
+CREATE TABLE IF NOT EXISTS total (
+  era_id INTEGER NOT NULL REFERENCES era (id),
+  mode TEXT NOT NULL,
+  elapsed INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (era_id, mode)
+);
+"""
+TIMESPAN_UNITS = {'s':1, 'm':60, 'h':60*60, 'd':24*60*60, 'w':7*24*60*60}
 
 USAGE = """
   $ %(prog)s [options] [mode]
@@ -48,23 +124,59 @@ DESCRIPTION = """
           Give any number of arguments in the format [mode][+-][minutes]
           E.g. "p+20", "w-5", "n+100"
   status: Show the current times.
-[options] is one of the optional arguments listed below.""".format(', '.join(MODES))
+  export: Write the full history of the current era to stdout (requires --web).
+          Give "csv" (the default) or "jsonl" as an argument to choose the format.
+  import: Add periods and adjustments to the current era in bulk (requires --web).
+          Reads JSONL in the "export" format from the file given as an argument, or stdin.
+  daemon: Keep running, with the data source ready, and listen on {} for
+          mode switches and "adjust" and "status" commands. Other invocations with the same data
+          source options send those commands to the daemon, which is faster. If no daemon is
+          running, they do the work themselves.
+[options] is one of the optional arguments listed below.""".format(', '.join(MODES), SOCKET_PATH)
 
 EPILOG = 'Note: This requires the notify2 package.'
 
+# The value of each option when it's not given on the command line.
+ARG_DEFAULTS = {
+  'notify':False, 'stdout':True, 'abbrev':True, 'web':False, 'database':False, 'sync':False,
+  'summary':None,
+  'cookie':None, 'url':API_ENDPOINT, 'retries':RETRIES, 'verify':True, 'log':sys.stderr,
+  'volume':logging.WARNING,
+}
+# Commands quick enough to run without parsing the command line with argparse, when they're given
+# alone or with only the FAST_FLAGS (this is run from keyboard shortcuts, so startup time counts).
+FAST_COMMANDS = MODES + ['status']
+# Options which just set a value, and the (option, value) each one sets.
+FAST_FLAGS = {
+  '-n':('notify', True), '-O':('stdout', False), '-A':('abbrev', False), '-w':('web', True),
+  '-d':('database', True), '-q':('volume', logging.CRITICAL), '-v':('volume', logging.INFO),
+  '-D':('volume', logging.DEBUG),
+}
+# Commands a daemon can run for other invocations.
+DAEMON_COMMANDS = MODES + ['adjust', 'status']
+# Options which choose and configure the data source. The daemon only runs commands for invocations
+# that give the same ones it was started with.
+BACKEND_OPTIONS = ('web', 'database', 'url', 'cookie', 'verify', 'sync', 'summary', 'retries',
+                   'abbrev')
+
 
 def make_argparser():
+  import argparse
   parser = argparse.ArgumentParser(usage=USAGE, description=DESCRIPTION, epilog=EPILOG,
                                    formatter_class=argparse.RawDescriptionHelpFormatter)
   parser.add_argument('arguments', nargs='+', help=argparse.SUPPRESS)
   parser.add_argument('-n', '--notify', action='store_true',
     help='Report feedback to desktop notifications.')
-  parser.add_argument('-O', '--no-stdout', dest='stdout', action='store_false', default=True,
+  parser.add_argument('-O', '--no-stdout', dest='stdout', action='store_false',
     help='Don\'t print feedback to stdout.')
-  parser.add_argument('-A', '--no-abbrev', dest='abbrev', action='store_false', default=True,
+  parser.add_argument('-A', '--no-abbrev', dest='abbrev', action='store_false',
     help='Don\'t abbreviate mode names (show "work" instead of "w").')
   parser.add_argument('-w', '--web', action='store_true',
     help='Use the website ({}) as the history log instead of local files.'.format(API_ENDPOINT))
+  parser.add_argument('-d', '--database', action='store_true',
+    help='Use a local SQLite database ({}) as the history log instead of the plain text files. It '
+         'keeps the full history, so reports include recent ratios. When it\'s first created, it '
+         'starts with the totals and status from the text files.'.format(SQLITE_PATH))
   parser.add_argument('-s', '--sync', action='store_true',
     help='When using --web, sync the local state files with the web state. This will always '
          'overwrite the local state, and will never overwrite the web state with the local one.')
@@ -72,28 +184,92 @@ def make_argparser():
     help='When using --web, write the raw summary data to this file (in JSON).')
   parser.add_argument('-c', '--cookie',
     help='Authorization cookie to use when in --web mode.')
-  parser.add_argument('-u', '--url', default=API_ENDPOINT,
+  parser.add_argument('-u', '--url',
     help='An alternative url to use as the website API endpoint. Implies --web.')
+  parser.add_argument('-r', '--retries', type=int,
+    help='When using --web, retry failed requests this many times. Default: %(default)s')
   parser.add_argument('-k', '--skip-cert-verification', dest='verify', action='store_false',
-    default=True,
     help='Don\'t verify the website TLS certificate.')
-  parser.add_argument('-l', '--log', type=argparse.FileType('w'), default=sys.stderr,
+  parser.add_argument('-l', '--log', type=argparse.FileType('w'),
     help='Print log messages to this file instead of to stderr. Warning: Will overwrite the file.')
   volume = parser.add_mutually_exclusive_group()
-  volume.add_argument('-q', '--quiet', dest='volume', action='store_const', const=logging.CRITICAL,
-    default=logging.WARNING)
+  volume.add_argument('-q', '--quiet', dest='volume', action='store_const', const=logging.CRITICAL)
   volume.add_argument('-v', '--verbose', dest='volume', action='store_const', const=logging.INFO)
   volume.add_argument('-D', '--debug', dest='volume', action='store_const', const=logging.DEBUG)
+  parser.set_defaults(**ARG_DEFAULTS)
   return parser
 
 
+def parse_args(argv):
+  # Skip building the parser for the most common invocations, like "worktime.py -d w".
+  if len(argv) >= 2 and argv[-1] in FAST_COMMANDS and all(arg in FAST_FLAGS for arg in argv[1:-1]):
+    args = types.SimpleNamespace(arguments=argv[-1:], **ARG_DEFAULTS)
+    for arg in argv[1:-1]:
+      name, value = FAST_FLAGS[arg]
+      setattr(args, name, value)
+    return args
+  parser = make_argparser()
+  return parser.parse_args(argv[1:])
+
+
 def main(argv):
 
-  parser = make_argparser()
-  args = parser.parse_args(argv[1:])
+  args = parse_args(argv)
 
   logging.basicConfig(stream=args.log, level=args.volume, format='%(message)s')
 
+  command = args.arguments[0]
+  if command in DAEMON_COMMANDS:
+    response = ask_daemon(args)
+    if response is not None:
+      if 'error' in response:
+        fail('Error: {}'.format(response['error']))
+      feedback(response['title'], response['body'], stdout=args.stdout)
+      return
+
+  work_times = make_work_times(args)
+
+  if command in DAEMON_COMMANDS:
+    try:
+      title, body = run_command(work_times, args.arguments)
+    except WorkTimeError as error:
+      fail('Error: {}'.format(error))
+    feedback(title, body, stdout=args.stdout, notify=args.notify)
+  else:
+    if command == 'clear':
+      work_times.clear()
+      feedback('Log cleared', stdout=args.stdout, notify=args.notify)
+    elif command == 'daemon':
+      try:
+        serve(work_times, get_backend_options(args))
+      except WorkTimeError as error:
+        fail('Error: {}'.format(error))
+    elif command == 'export':
+      if not hasattr(work_times, 'export'):
+        fail('Error: "export" command requires --web.')
+      if len(args.arguments) > 1:
+        format = args.arguments[1]
+      else:
+        format = 'csv'
+      if format not in EXPORT_FORMATS:
+        fail('Error: Invalid export format {!r}. Must be one of {}.'.format(format, EXPORT_FORMATS))
+      work_times.export(sys.stdout, format=format)
+    elif command == 'import':
+      if not hasattr(work_times, 'import_history'):
+        fail('Error: "import" command requires --web.')
+      if len(args.arguments) > 1:
+        in_file = open(args.arguments[1], 'rb')
+      else:
+        in_file = sys.stdin.buffer
+      with in_file:
+        periods, adjustments = work_times.import_history(in_file)
+      feedback('History imported', '{} periods and {} adjustments added'.format(periods, adjustments),
+               stdout=args.stdout, notify=args.notify)
+    else:
+      fail('Error: Invalid command {!r}.'.format(command))
+
+
+def make_work_times(args):
   if args.web or args.url != API_ENDPOINT:
     if args.sync:
       status_path = STATUS_PATH
@@ -101,45 +277,157 @@ def main(argv):
     else:
       status_path = None
       log_path = None
-    work_times = WorkTimesWeb(modes=MODES, hidden=HIDDEN, abbrev=args.abbrev, api_endpoint=args.url,
-                              timeout=TIMEOUT, verify=args.verify, cookie=args.cookie,
-                              status_path=status_path, log_path=log_path, summary_path=args.summary)
+    return WorkTimesWeb(modes=MODES, hidden=HIDDEN, abbrev=args.abbrev, api_endpoint=args.url,
+                        timeout=TIMEOUT, verify=args.verify, cookie=args.cookie,
+                        status_path=status_path, log_path=log_path, summary_path=args.summary,
+                        retries=args.retries, queue_path=QUEUE_PATH)
+  elif args.database:
+    return WorkTimesSQLite(modes=MODES, hidden=HIDDEN, abbrev=args.abbrev, db_path=SQLITE_PATH,
+                           log_path=LOG_PATH, status_path=STATUS_PATH)
   else:
-    work_times = WorkTimesFiles(modes=MODES, hidden=HIDDEN, abbrev=args.abbrev,
-                                log_path=LOG_PATH, status_path=STATUS_PATH)
+    return WorkTimesFiles(modes=MODES, hidden=HIDDEN, abbrev=args.abbrev,
+                          log_path=LOG_PATH, status_path=STATUS_PATH)
 
-  if args.arguments[0] in MODES:
-    new_mode = args.arguments[0]
+
+def get_backend_options(args):
+  return {name: getattr(args, name) for name in BACKEND_OPTIONS}
+
+
+def run_command(work_times, arguments):
+  """Run one of the DAEMON_COMMANDS and return the (title, body) to report."""
+  command = arguments[0]
+  if command in MODES:
+    new_mode = command
     old_mode, old_elapsed = work_times.switch_mode(new_mode)
     if old_mode is None or old_mode in HIDDEN or old_mode == new_mode:
       message = '(was {})'.format(old_mode)
     else:
       message = '(added {} to {})'.format(timestring(old_elapsed), old_mode)
-    title, body = make_report(work_times, message)
-    feedback(title, body, stdout=args.stdout, notify=args.notify)
+    return make_report(work_times, message)
+  elif command == 'adjust':
+    adjustments = arguments[1:]
+    if len(adjustments) == 0:
+      raise WorkTimeError('"adjust" command requires arguments.')
+    return adjust(work_times, adjustments)
+  elif command == 'status':
+    return make_report(work_times)
   else:
-    command = args.arguments[0]
-    if command == 'clear':
-      work_times.clear()
-      feedback('Log cleared', stdout=args.stdout, notify=args.notify)
-    elif command == 'adjust':
-      adjustments = args.arguments[1:]
-      if len(adjustments) == 0:
-        fail('Error: "adjust" command requires arguments.')
-      title, body = adjust(work_times, adjustments)
-      feedback(title, body, stdout=args.stdout, notify=args.notify)
-    elif command == 'status':
-      title, body = make_report(work_times)
-      feedback(title, body, stdout=args.stdout, notify=args.notify)
-    else:
-      fail('Error: Invalid command {!r}.'.format(command))
+    raise WorkTimeError('Invalid command {!r}.'.format(command))
+
+
+def ask_daemon(args, socket_path=SOCKET_PATH):
+  """Send the command to the daemon to run, if one is listening.
+  Returns its response, or None if there's no daemon (or it uses a different data source)."""
+  if not socket_path.exists():
+    # Don't even load the socket module.
+    return None
+  import socket
+  request = {'arguments':args.arguments, 'notify':args.notify, 'backend':get_backend_options(args)}
+  connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  with connection:
+    connection.settimeout(DAEMON_CONNECT_TIMEOUT)
+    try:
+      connection.connect(str(socket_path))
+    except OSError as error:
+      logging.info('No daemon to send the command to ({}).'.format(error))
+      return None
+    # Once the command is sent, don't fall back to running it ourselves, or it could run twice.
+    connection.settimeout(DAEMON_TIMEOUT)
+    try:
+      connection.sendall(json.dumps(request).encode('utf-8')+b'\n')
+      with connection.makefile('rb') as reader:
+        response = json.loads(reader.readline())
+    except (OSError, ValueError) as error:
+      raise WorkTimeError('Error getting a response from the daemon: {}'.format(error))
+  if response.get('fallback'):
+    logging.info('The daemon uses a different data source. Running the command directly.')
+    return None
+  return response
+
+
+def serve(work_times, backend, socket_path=SOCKET_PATH):
+  """Run the daemon: listen on `socket_path` and run the commands sent there, one at a time."""
+  import signal
+  import socket
+  if daemon_is_running(socket_path):
+    raise WorkTimeError('A daemon is already listening on {}.'.format(str(socket_path)))
+  elif socket_path.exists():
+    # Left behind by a daemon that didn't exit cleanly.
+    socket_path.unlink()
+  init_notify()
+  server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  # Only let this user connect.
+  old_umask = os.umask(0o077)
+  try:
+    server.bind(str(socket_path))
+  finally:
+    os.umask(old_umask)
+  server.listen()
+  logging.info('Listening on {}.'.format(str(socket_path)))
+  # Exit through the `finally` below when killed, so the socket file is removed.
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+  try:
+    while True:
+      connection, address = server.accept()
+      with connection:
+        connection.settimeout(DAEMON_TIMEOUT)
+        try:
+          with connection.makefile('rb') as reader:
+            line = reader.readline()
+          if not line:
+            # Just checking whether we're running.
+            continue
+          request = json.loads(line)
+          response = handle_daemon_request(work_times, backend, request)
+          connection.sendall(json.dumps(response).encode('utf-8')+b'\n')
+        except (OSError, ValueError) as error:
+          logging.warning('Error talking to client: {}'.format(error))
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.close()
+    socket_path.unlink()
+
+
+def daemon_is_running(socket_path):
+  import socket
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+    try:
+      connection.connect(str(socket_path))
+    except OSError:
+      return False
+  return True
+
+
+def handle_daemon_request(work_times, backend, request):
+  if request.get('backend') != backend:
+    return {'fallback':True}
+  # Whatever's cached from the last command may be out of date by now.
+  work_times.forget()
+  try:
+    title, body = run_command(work_times, request['arguments'])
+  except WorkTimeError as error:
+    return {'error':str(error)}
+  except Exception as error:
+    # Keep running for the next command.
+    logging.exception('Error running {!r}:'.format(request['arguments']))
+    return {'error':'{}: {}'.format(type(error).__name__, error)}
+  if request.get('notify'):
+    feedback(title, body, stdout=False, notify=True)
+  return {'title':title, 'body':body}
 
 
 def adjust(work_times, adjustments):
   messages = []
+  operations = []
   for adjustment in adjustments:
     mode, delta = parse_adjustment(adjustment)
-    work_times.add_elapsed(mode, delta)
+    operations.append({'type':'adjust', 'mode':mode, 'delta':delta})
+  # Make all the changes at once (in a single request, with --web).
+  work_times.apply_batch(operations)
+  for operation in operations:
+    mode = operation['mode']
+    delta = operation['delta']
     if delta >= 0:
       change_str = 'added to'
     else:
@@ -191,14 +479,19 @@ def make_report(work_times, message=None):
   body = '\n'.join(lines)
   # If requested, calculate the ratio of the times for the specified modes.
   ratio = work_times.get_ratio(*RATIO_MODES, all_elapsed=all_elapsed)
-  if ratio is None:
-    return title, body
-  if ratio == float('inf'):
-    ratio_value_str = '∞'
-  else:
-    ratio_value_str = '{:0.2f}'.format(ratio)
   ratio_label = '{}/{}'.format(*RATIO_MODES)
-  body += '\n{}:\t{}'.format(ratio_label, ratio_value_str)
+  if ratio is not None:
+    if ratio == float('inf'):
+      ratio_value_str = '∞'
+    else:
+      ratio_value_str = '{:0.2f}'.format(ratio)
+    body += '\n{}:\t{}'.format(ratio_label, ratio_value_str)
+  # Add the recent ratios, if we have the history for them.
+  if isinstance(work_times, WorkTimesSQLite):
+    summary = work_times.get_summary(numbers='text', timespans=REPORT_TIMESPANS)
+    # The first is the total ratio, already reported above.
+    for recent_ratio in summary['ratios'][1:]:
+      body += '\n{} ({}):\t{}'.format(ratio_label, recent_ratio['timespan'], recent_ratio['value'])
   return title, body
 
 
@@ -278,6 +571,22 @@ def format_rounded_num(quantity, singular, plural):
     return '{:0.1f}{}'.format(quantity, plural)
 
 
+def parse_timespan(timespan_str):
+  """Parse a timespan like '15m', '4h', or '1w' into a number of seconds.
+  A bare number is taken as seconds."""
+  timespan_str = timespan_str.strip()
+  if timespan_str[-1:] in TIMESPAN_UNITS:
+    multiplier = TIMESPAN_UNITS[timespan_str[-1]]
+    number_str = timespan_str[:-1]
+  else:
+    multiplier = 1
+    number_str = timespan_str
+  seconds = int(number_str) * multiplier
+  if seconds <= 0:
+    raise ValueError('Timespan must be positive: {!r}'.format(timespan_str))
+  return seconds
+
+
 def untimestring(time_str):
   if time_str is None:
     return None
@@ -307,6 +616,15 @@ def feedback(title, body='', stdout=True, notify=False):
       notice.show()
 
 
+def init_notify():
+  """Connect to the notification service ahead of time, so the first notification is quick."""
+  try:
+    import notify2
+    notify2.init('worktime')
+  except Exception as error:
+    logging.info('Could not connect to the notification service: {}'.format(error))
+
+
 class WorkTimes(object):
   """The parent class, agnostic to backend data store.
   Most methods are unimplemented, since they depend on the data source."""
@@ -320,6 +638,10 @@ class WorkTimes(object):
     """Erase all history and the current status."""
     raise NotImplementedError
 
+  def forget(self):
+    """Drop any data cached from earlier calls, since it could have changed since then."""
+    pass
+
   def switch_mode(self, new_mode):
     old_mode, old_elapsed = self.get_status()
     if old_mode is not None and old_mode not in self.hidden:
@@ -336,6 +658,21 @@ class WorkTimes(object):
     elapsed = self.get_elapsed(mode)
     self.set_elapsed(mode, elapsed+delta)
 
+  def apply_batch(self, operations):
+    """Apply a list of operations in order. Each is a dict with a 'type' of 'switch' (with a
+    'mode') or 'adjust' (with a 'mode' and a 'delta' in seconds).
+    Returns a list of the results: (old_mode, old_elapsed) for a switch, None for an adjustment."""
+    results = []
+    for operation in operations:
+      if operation.get('type') == 'switch':
+        results.append(self.switch_mode(operation.get('mode')))
+      elif operation.get('type') == 'adjust':
+        self.add_elapsed(operation.get('mode'), operation.get('delta'))
+        results.append(None)
+      else:
+        raise WorkTimeError('Invalid operation type {!r}.'.format(operation.get('type')))
+    return results
+
   #TODO: Separate display stuff from core logic.
   #      Or maybe remove entirely? There may not be much of a point to a generic get_summary().
   #      It's very difficult to efficiently serve the needs of all possible consumers of this data.
@@ -357,20 +694,7 @@ class WorkTimes(object):
     if current_mode:
       all_elapsed[current_mode] = elapsed + all_elapsed.get(current_mode, 0)
     # Format a list of all the current elapsed times.
-    lines = []
-    all_modes = MODES[:]
-    for mode in all_elapsed.keys():
-      if mode not in all_modes:
-        all_modes.append(mode)
-    summary['elapsed'] = []
-    for mode in all_modes:
-      if mode in all_elapsed and mode not in HIDDEN:
-        if numbers == 'values':
-          elapsed_data = {'mode':mode, 'time':all_elapsed[mode]}
-        elif numbers == 'text':
-          elapsed_data = {'mode':mode, 'time':timestring(all_elapsed[mode])}
-        elapsed_data['mode_name'] = get_mode_name(elapsed_data['mode'], abbrev=self.abbrev)
-        summary['elapsed'].append(elapsed_data)
+    summary['elapsed'] = self._format_elapsed(all_elapsed, numbers)
     # If requested, calculate the ratio of the times for the specified modes.
     if modes:
       if self.abbrev:
@@ -396,6 +720,202 @@ class WorkTimes(object):
       summary['ratios'] = []
     return summary
 
+  def _add_eras(self, summary, snapshot):
+    """Add the name of the current Era and a list of the others to the `summary`."""
+    if snapshot['era'] is None:
+      summary['era'] = None
+    else:
+      summary['era'] = snapshot['era']['description']
+    summary['eras'] = []
+    for era_id, description in snapshot['eras']:
+      era_dict = {'id':era_id}
+      if description:
+        era_dict['name'] = description[:22]
+      else:
+        era_dict['name'] = str(era_id)
+      summary['eras'].append(era_dict)
+    summary['eras'].sort(key=lambda era_dict: era_dict['name'])
+
+  def _format_elapsed(self, all_elapsed, numbers='values'):
+    all_modes = MODES[:]
+    for mode in all_elapsed.keys():
+      if mode not in all_modes:
+        all_modes.append(mode)
+    elapsed_list = []
+    for mode in all_modes:
+      if mode in all_elapsed and mode not in HIDDEN:
+        if numbers == 'values':
+          elapsed_data = {'mode':mode, 'time':all_elapsed[mode]}
+        elif numbers == 'text':
+          elapsed_data = {'mode':mode, 'time':timestring(all_elapsed[mode])}
+        elapsed_data['mode_name'] = get_mode_name(elapsed_data['mode'], abbrev=self.abbrev)
+        elapsed_list.append(elapsed_data)
+    return elapsed_list
+
+  def _add_snapshot_summary(self, summary, snapshot, numbers='values', modes=RATIO_MODES,
+                            timespans=()):
+    """Add the Eras, the ratios over the last `timespans`, and the history bar to the `summary`,
+    from the data in a `snapshot` (see WorkTimesDatabase._query_snapshot())."""
+    self._add_eras(summary, snapshot)
+    if timespans:
+      ratios = self._get_recent_ratios(timespans, snapshot, numbers, modes)
+      #TODO: Make 'ratios' a dict with keys 'num', 'denom', and 'timespans', which is the regular list.
+      summary['ratios'].extend(ratios)
+      summary['ratio_meta'] = {}
+      summary['ratio_meta']['num'] = get_mode_name(RATIO_MODES[0], self.abbrev)
+      summary['ratio_meta']['denom'] = get_mode_name(RATIO_MODES[1], self.abbrev)
+      timespan = list(sorted(timespans))[0]
+      summary['history'] = {}
+      summary['history']['periods'] = self._get_recent_bars(timespan, snapshot, numbers=numbers)
+      summary['history']['adjustments'] = self._get_recent_adjustments(timespan, snapshot,
+                                                                       numbers=numbers)
+      if numbers == 'values':
+        summary['history']['timespan'] = timespan
+      elif numbers == 'text':
+        summary['history']['timespan'] = timestring(timespan, format='even', abbrev=False)
+
+  def _get_recent_ratios(self, timespans, snapshot, numbers='values', modes=RATIO_MODES):
+    """Get ratios for only the last `timespan`s seconds."""
+    ratios = []
+    if snapshot['era'] is None:
+      return ratios
+    totals = self._get_window_totals(timespans, snapshot)
+    # Calculate the ratios.
+    for c, timespan in enumerate(timespans):
+      ratio = {'totals':totals[c]}
+      mode0 = modes[0]
+      mode1 = modes[1]
+      logging.info('Totals for last {}s: {} in {}, {} in {}.'
+                   .format(timespan, totals[c][mode0], mode0, totals[c][mode1], mode1))
+      # Store the value of the ratio.
+      if totals[c][mode1] == 0:
+        if numbers == 'values':
+          ratio['value'] = float('inf')
+        elif numbers == 'text':
+          ratio['value'] = '∞'
+      else:
+        ratio['value'] = totals[c][mode0]/totals[c][mode1]
+        if numbers == 'text':
+          ratio['value'] = '{:0.2f}'.format(ratio['value'])
+      # Store the period of time the recent ratio is for.
+      if numbers == 'values':
+        ratio['timespan'] = timespan
+      elif numbers == 'text':
+        ratio['timespan'] = timestring(timespan, format='even', abbrev=True)
+      ratios.append(ratio)
+    return ratios
+
+  def _get_window_totals(self, timespans, snapshot):
+    """Get the number of seconds spent in each mode in the last `timespan`s seconds.
+    Returns a list of dicts mapping modes to seconds, one for each timespan."""
+    totals = self._get_snapshot_totals(timespans, snapshot)
+    # Make sure there are no negative totals.
+    for timespan_totals in totals:
+      for mode in timespan_totals.keys():
+        if timespan_totals[mode] < 0:
+          timespan_totals[mode] = 0
+    return totals
+
+  def _get_snapshot_totals(self, timespans, snapshot):
+    """Total up the time spent in each mode in the last `timespan`s seconds, from the Periods and
+    Adjustments in the `snapshot`. Totals can be negative."""
+    now = snapshot['now']
+    cutoffs = [now-timespan for timespan in timespans]
+    periods = list(snapshot['periods'])
+    if snapshot['current'] is not None:
+      mode, start = snapshot['current']
+      periods.append((mode, start, None))
+    return clip_totals(periods, snapshot['adjustments'], cutoffs, now)
+
+  def _get_recent_bars(self, timespan, snapshot, numbers='values', total_width=99):
+    """Get data for a display of recent periods."""
+    bar_periods = []
+    if snapshot['era'] is None:
+      return bar_periods
+    # Get a list of periods in the last `timespan` seconds.
+    now = snapshot['now']
+    cutoff = now - timespan
+    periods = [period for period in snapshot['periods'] if period[2] >= cutoff]
+    if snapshot['current'] is not None:
+      mode, start = snapshot['current']
+      periods.append((mode, start, None))
+    logging.info('Found {} periods in last {}.'.format(len(periods), timespan))
+    # Create a list of bars from the periods.
+    last_end = None
+    for mode, start, end in periods:
+      if end is None:
+        period_elapsed = now - start
+      else:
+        period_elapsed = end - start
+      # If we detect a gap between this period and the last one, insert an empty one.
+      if last_end and start - last_end > 1:
+        elapsed = start - last_end
+        width = round(total_width * elapsed / timespan, 1)
+        bar_periods.append({'mode':None, 'width':width, 'start':last_end, 'end':start,
+                            'timespan':format_timespan(elapsed, numbers), 'mode_name':'None'})
+        last_end = start
+      if start < cutoff:
+        if end is None:
+          elapsed = timespan
+        else:
+          elapsed = end - cutoff
+      else:
+        elapsed = period_elapsed
+      if end is None:
+        end = now
+      last_end = end
+      width = round(total_width * elapsed / timespan, 1)
+      bar_periods.append({'mode':mode, 'width':width, 'start':start, 'end':end,
+                          'timespan':format_timespan(period_elapsed, numbers),
+                          'mode_name':get_mode_name(mode, self.abbrev)})
+      logging.info('Found {} {} sec long ({}%): {} to {}'
+                   .format(mode, period_elapsed, width, start, end))
+    # Fill in empty gaps at start or end of timespan with empty bars.
+    if len(bar_periods) == 0:
+      bar_periods.append({'mode':None, 'width':total_width, 'start':cutoff, 'end':now,
+                          'timespan':format_timespan(timespan, numbers), 'mode_name':'None'})
+    else:
+      if bar_periods[0]['start'] > cutoff+10:
+        elapsed = bar_periods[0]['start'] - cutoff
+        width = round(total_width * elapsed / timespan, 1)
+        bar_periods.insert(0, {'mode':None, 'width':width, 'end':bar_periods[0]['start'], 'start':cutoff,
+                               'timespan':format_timespan(elapsed, numbers), 'mode_name':'None'})
+      if bar_periods[-1]['end'] < now-10:
+        elapsed = now - bar_periods[-1]['end']
+        width = round(total_width * elapsed / timespan, 1)
+        bar_periods.append({'mode':None, 'width':width, 'start':bar_periods[-1]['end'], 'end':now,
+                            'timespan':format_timespan(elapsed, numbers), 'mode_name':'None'})
+    # Some post-processing to drop periods that are too small and make sure it all adds up to
+    # total_width.
+    bar_periods = [p for p in bar_periods if p['width'] >= 0.3]
+    total_width = sum([p['width'] for p in bar_periods])
+    if total_width != total_width:
+      diff = min(0.3, total_width - total_width)
+      bar_periods[-1]['width'] = round(bar_periods[-1]['width']+diff, 1)
+    return bar_periods
+
+  def _get_recent_adjustments(self, timespan, snapshot, numbers='values', total_width=99):
+    """Get data for a display of recent adjustments."""
+    adjustments_data = []
+    if snapshot['era'] is None:
+      return adjustments_data
+    # Get a list of adjustments in the last `timespan` seconds.
+    now = snapshot['now']
+    cutoff = now - timespan
+    adjustments = [adjustment for adjustment in snapshot['adjustments'] if adjustment[2] >= cutoff]
+    logging.info('Found {} adjustments in last {}.'.format(len(adjustments), timespan))
+    for mode, delta, timestamp in adjustments:
+      if delta >= 0:
+        sign = '+'
+      else:
+        sign = '-'
+      x = round(total_width * (timestamp-cutoff) / timespan, 1)
+      magnitude = format_timespan(abs(delta), numbers, label_smallest=False)
+      adjustments_data.append({'mode':mode, 'sign':sign, 'magnitude':magnitude, 'x':x,
+                               'mode_name':get_mode_name(mode, self.abbrev),
+                               'timespan':format_timespan(abs(delta), numbers)})
+    return adjustments_data
+
   def get_ratio(self, num_mode, denom_mode, all_elapsed=None):
     if all_elapsed is None:
       all_elapsed = self.get_all_elapsed()
@@ -437,9 +957,18 @@ class WorkTimes(object):
 
 
 class WorkTimesFiles(WorkTimes):
+  """Keep the status and elapsed times in local files.
+  Each change is appended to a journal while holding a lock on it, so simultaneous invocations can't
+  lose each other's changes, and a crash can at worst cut off the last record. Once the journal
+  gets long, it's compacted into the status and log files (the snapshot), which are replaced whole
+  by renaming new versions into place. Journal records are numbered, and the log file records the
+  last one it includes, so none are counted twice if a compaction is interrupted."""
+
+  SEQ_KEY = 'seq'
 
   def __init__(self, modes=MODES, hidden=HIDDEN, abbrev=True,
-               log_path=LOG_PATH, status_path=STATUS_PATH):
+               log_path=LOG_PATH, status_path=STATUS_PATH, journal_path=None,
+               compact_size=JOURNAL_COMPACT_SIZE):
     super().__init__(modes=modes, hidden=hidden, abbrev=abbrev)
     if isinstance(log_path, pathlib.Path):
       self.log_path = log_path
@@ -449,53 +978,86 @@ class WorkTimesFiles(WorkTimes):
       self.status_path = status_path
     else:
       self.status_path = pathlib.Path(status_path)
+    if journal_path is None:
+      self.journal_path = self.log_path.with_name(JOURNAL_PATH.name)
+    elif isinstance(journal_path, pathlib.Path):
+      self.journal_path = journal_path
+    else:
+      self.journal_path = pathlib.Path(journal_path)
+    self.compact_size = compact_size
+    # The open journal, while we hold the lock on it.
+    self._journal = None
+    self._shared = False
+    # Records not yet written to the journal.
+    self._pending = []
+    # The state, as of when we last loaded it.
+    self._status = None
     self._log = None
+    self._seq = 0
+    self._snapshot_seq = 0
+    self._journal_length = 0
 
   def clear(self):
+    with self._locked():
+      self._append('clear')
+
+  def forget(self):
+    # The state is always reloaded once we have the lock.
+    self._status = None
     self._log = None
-    self._write_file({}, self.status_path)
-    self._write_file({}, self.log_path)
 
-  def get_status(self):
-    data = self._read_file(self.status_path)
-    if not data:
-      return None, None
-    else:
-      if len(data.keys()) != 1:
-        raise WorkTimeError('Status file {!r} contains {} statuses.'
-                            .format(str(self.status_path), len(data.keys())))
-      mode = list(data.keys())[0]
-      start = data[mode]
-      self.validate_mode(mode)
+  def get_status(self, now=None):
+    with self._locked(shared=True):
+      if not self._status:
+        return None, None
+      mode, start = list(self._status.items())[0]
+    if now is None:
       now = int(time.time())
-      return mode, now - start
+    return mode, now - start
 
   def set_status(self, mode):
     self.validate_mode(mode)
-    data = {}
-    if mode is not None:
-      start = int(time.time())
-      data[mode] = start
-    self._write_file(data, self.status_path)
+    with self._locked():
+      self._append('status', mode, int(time.time()))
+
+  def switch_mode(self, new_mode):
+    self.validate_mode(new_mode)
+    # Hold the lock from reading the old status to writing the new one, and end the old Period at
+    # the same second the new one starts.
+    with self._locked():
+      now = int(time.time())
+      old_mode, old_elapsed = self.get_status(now=now)
+      if old_mode is not None and old_mode not in self.hidden:
+        if old_mode == new_mode:
+          return old_mode, None
+        self._append('elapsed', old_mode, old_elapsed)
+      self._append('status', new_mode, now)
+    return old_mode, old_elapsed
+
+  def apply_batch(self, operations):
+    # Make all the changes or none of them.
+    with self._locked():
+      return super().apply_batch(operations)
 
   def get_elapsed(self, mode):
     """Read the log file and get the elapsed time for the given mode."""
     self.validate_mode(mode)
-    if self._log is None:
-      self._log = self._read_log()
-    return self._log.get(mode, 0)
+    with self._locked(shared=True):
+      return self._log.get(mode, 0)
 
   def set_elapsed(self, mode, elapsed):
     self.validate_mode(mode)
-    if self._log is None:
-      self._log = self._read_log()
-    self._log[mode] = elapsed
-    self._write_file(self._log, self.log_path)
+    with self._locked():
+      self._append('elapsed', mode, elapsed - self._log.get(mode, 0))
+
+  def add_elapsed(self, mode, delta):
+    self.validate_mode(mode)
+    with self._locked():
+      self._append('elapsed', mode, delta)
 
   def get_all_elapsed(self):
-    if self._log is None:
-      self._log = self._read_log()
-    return self._log
+    with self._locked(shared=True):
+      return dict(self._log)
 
   def write_summary(self, summary, current_inclusive=False):
     # Write the given summary data to the files.
@@ -506,29 +1068,155 @@ class WorkTimesFiles(WorkTimes):
     else:
       mode_start = now-summary['current_elapsed']
       status = {current_mode:mode_start}
-    self._write_file(status, self.status_path)
-    self._log = {}
+    log = {}
     for elapsed_data in summary['elapsed']:
       mode = elapsed_data['mode']
       elapsed = elapsed_data['time']
       if mode == current_mode and current_inclusive:
         elapsed -= summary['current_elapsed']
-      self._log[mode] = elapsed
-    self._write_file(self._log, self.log_path)
-
-  def _read_log(self):
-    """Read the elapsed times log file and store the result in the self._log cache.
-    Notes on the format of the log file:
-    - The order of the lines is not guaranteed (so that it can be written straight
-      from a dict).
-    - It is not required to contain all modes, even if zero. Any mode not in the
-      file is assumed to be zero."""
-    self._log = self._read_file(self.log_path)
-    for mode in self._log.keys():
+      log[mode] = elapsed
+    # This replaces everything, so write it straight to a new snapshot.
+    with self._locked():
+      self._pending = []
+      self._status = status
+      self._log = log
+      self._compact()
+
+  @contextlib.contextmanager
+  def _locked(self, shared=False):
+    """Hold the lock on the journal, with the current state loaded, inside this context.
+    Changes are written to the journal all at once when leaving the outermost context, and only if
+    it exits without an exception. Use `shared` to allow other readers at the same time (but no
+    changes)."""
+    if self._journal is not None:
+      # We already hold the lock.
+      if self._shared and not shared:
+        raise WorkTimeError('Cannot make changes while holding a shared lock.')
+      yield
+      return
+    import fcntl
+    if shared and not self.journal_path.exists():
+      # Nothing has been journaled yet, and just reading shouldn't create the journal. The snapshot
+      # files are only ever replaced whole, so they're safe to read without the lock.
+      journal = io.BytesIO()
+      lock = None
+    else:
+      if shared:
+        file_mode = 'rb'
+        lock = fcntl.LOCK_SH
+      else:
+        file_mode = 'a+b'
+        lock = fcntl.LOCK_EX
+      try:
+        journal = self.journal_path.open(file_mode)
+      except OSError as error:
+        raise WorkTimeError(error)
+    with journal:
+      if lock is not None:
+        fcntl.flock(journal, lock)
+      self._journal = journal
+      self._shared = shared
+      try:
+        self._load()
+        yield
+        if not shared:
+          self._commit()
+      finally:
+        self._journal = None
+        self._shared = False
+        self._pending = []
+
+  def _load(self):
+    """Read the snapshot, then play back the journal records made since."""
+    status = self._read_file(self.status_path) or {}
+    if len(status) > 1:
+      raise WorkTimeError('Status file {!r} contains {} statuses.'
+                          .format(str(self.status_path), len(status)))
+    self._status = status
+    self._log = self._read_file(self.log_path) or {}
+    self._snapshot_seq = self._seq = self._log.pop(self.SEQ_KEY, 0)
+    for mode in list(self._status.keys()) + list(self._log.keys()):
       if mode not in self.modes:
-        raise WorkTimeError('Log file {!r} contains invalid mode {!r}.'
-                            .format(str(self.log_path), mode))
-    return self._log
+        raise WorkTimeError('Invalid mode {!r} in the status or log file.'.format(mode))
+    self._journal.seek(0)
+    data = self._journal.read()
+    end = data.rfind(b'\n') + 1
+    if end < len(data):
+      logging.warning('Ignoring an incomplete record at the end of the journal {!r}.'
+                      .format(str(self.journal_path)))
+      if not self._shared:
+        self._journal.truncate(end)
+    lines = data[:end].decode('utf-8').splitlines()
+    for line_num, line in enumerate(lines, 1):
+      fields = line.split('\t')
+      try:
+        seq, kind, mode, value = int(fields[0]), fields[1], fields[2], int(fields[3])
+      except (ValueError, IndexError):
+        raise WorkTimeError('Invalid record on line {} of the journal {!r}.'
+                            .format(line_num, str(self.journal_path)))
+      if mode == '-':
+        mode = None
+      self.validate_mode(mode)
+      self._apply_record(seq, kind, mode, value)
+    self._journal_length = len(lines)
+
+  def _append(self, kind, mode=None, value=0):
+    self._seq += 1
+    if mode is None:
+      mode_str = '-'
+    else:
+      mode_str = mode
+    self._pending.append('{}\t{}\t{}\t{}\n'.format(self._seq, kind, mode_str, value))
+    self._journal_length += 1
+    self._apply_record(self._seq, kind, mode, value)
+
+  def _apply_record(self, seq, kind, mode, value):
+    # The status is the same no matter how many times its records are played back, but changes
+    # to the elapsed times already in the log file must be skipped.
+    if kind == 'status':
+      if mode is None:
+        self._status = {}
+      else:
+        self._status = {mode:value}
+    elif kind == 'clear':
+      self._status = {}
+      if seq > self._snapshot_seq:
+        self._log = {}
+    elif kind == 'elapsed':
+      if seq > self._snapshot_seq:
+        self._log[mode] = self._log.get(mode, 0) + value
+    else:
+      raise WorkTimeError('Invalid record type {!r} in the journal {!r}.'
+                          .format(kind, str(self.journal_path)))
+    self._seq = max(self._seq, seq)
+
+  def _commit(self):
+    if self._pending:
+      try:
+        self._journal.write(''.join(self._pending).encode('utf-8'))
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+      except OSError as error:
+        raise WorkTimeError(error)
+      self._pending = []
+    if self._journal_length >= self.compact_size:
+      self._compact()
+
+  def _compact(self):
+    """Write the current state to the snapshot files, then empty the journal.
+    The status file must be written first: its journal records are played back even if they're
+    already in the snapshot, so it's only the log file that says which ones are included."""
+    self._write_file(self._status, self.status_path)
+    log = dict(self._log)
+    log[self.SEQ_KEY] = self._seq
+    self._write_file(log, self.log_path)
+    try:
+      self._journal.truncate(0)
+      os.fsync(self._journal.fileno())
+    except OSError as error:
+      raise WorkTimeError(error)
+    self._snapshot_seq = self._seq
+    self._journal_length = 0
 
   def _read_file(self, path):
     """Read a generic data file storing keys and integer values.
@@ -553,55 +1241,322 @@ class WorkTimesFiles(WorkTimes):
         raise WorkTimeError(error)
       return data
     else:
-      logging.warning('Status file {!r} not found. Assuming no current status.'.format(str(path)))
+      # Normal until the journal is first compacted.
+      logging.info('Status file {!r} not found. Assuming no current status.'.format(str(path)))
       return None
 
   def _write_file(self, data, path):
+    """Replace the file at `path` in one step, by writing a temporary file and renaming it."""
+    temp_path = path.with_name(path.name+'.tmp')
     try:
-      with path.open(mode='w') as filehandle:
+      with temp_path.open(mode='w') as filehandle:
         for mode, value in data.items():
           filehandle.write('{}\t{}\n'.format(mode, value))
+        filehandle.flush()
+        os.fsync(filehandle.fileno())
+      os.replace(temp_path, path)
+      # Make sure the rename itself is on disk before anything that depends on it.
+      directory = os.open(str(path.parent), os.O_RDONLY)
+      try:
+        os.fsync(directory)
+      finally:
+        os.close(directory)
     except OSError as error:
       raise WorkTimeError(error)
 
 
-class WorkTimesDatabase(WorkTimes):
+class WorkTimesSQLite(WorkTimes):
+  """Keep the full history in a local SQLite database, in the same shape as the website's (Eras,
+  Periods, Adjustments and Totals), so the command line can show recent ratios too.
+  This only needs the standard library, and sqlite3 isn't even loaded until the first query.
+  Queries use parameters, so sqlite3 reuses the prepared statement each time one is repeated."""
 
-  def __init__(self, user=None, era=None, modes=MODES, hidden=HIDDEN, abbrev=True):
+  def __init__(self, modes=MODES, hidden=HIDDEN, abbrev=True, db_path=SQLITE_PATH,
+               log_path=LOG_PATH, status_path=STATUS_PATH):
     super().__init__(modes=modes, hidden=hidden, abbrev=abbrev)
-    self.user = user
-    if era is None:
-      try:
-        era = Era.objects.get(user=self.user, current=True)
-      except Era.DoesNotExist:
-        era = None
-    self.era = era
+    if isinstance(db_path, pathlib.Path):
+      self.db_path = db_path
+    else:
+      self.db_path = pathlib.Path(db_path)
+    # The files to start from when creating the database (see _import_files()).
+    self.log_path = log_path
+    self.status_path = status_path
+    self._sqlite3 = None
+    self._connection = None
+    self._in_transaction = False
+    # Cache of the data needed for a summary, loaded all at once by get_summary().
+    self._snapshot = None
+
+  @property
+  def connection(self):
+    if self._connection is None:
+      self._connect()
+    return self._connection
+
+  def _connect(self):
+    import sqlite3
+    self._sqlite3 = sqlite3
+    try:
+      # Manage transactions ourselves.
+      self._connection = sqlite3.connect(str(self.db_path), timeout=TIMEOUT, isolation_level=None)
+    except sqlite3.Error as error:
+      raise WorkTimeError(error)
+    self._execute('PRAGMA synchronous = NORMAL')
+    if self._execute('PRAGMA user_version').fetchone()[0] < SQLITE_SCHEMA_VERSION:
+      self._create_schema()
+
+  def _create_schema(self):
+    # In WAL mode, readers don't block the writer or vice versa. The setting is saved in the file.
+    self._execute('PRAGMA journal_mode = WAL')
+    with self._transaction():
+      version = self._execute('PRAGMA user_version').fetchone()[0]
+      if version >= SQLITE_SCHEMA_VERSION:
+        # Another process created it first.
+        return
+      for statement in SQLITE_SCHEMA.split(';'):
+        if statement.strip():
+          self._execute(statement)
+      if version == 0:
+        self._import_files()
+      self._execute('PRAGMA user_version = {:d}'.format(SQLITE_SCHEMA_VERSION))
+
+  def _import_files(self):
+    """Start from the totals and current status in the files kept by WorkTimesFiles, if any.
+    There's no history of Periods to bring over, so recent ratios start from now."""
+    work_times_files = WorkTimesFiles(modes=self.modes, hidden=self.hidden,
+                                      log_path=self.log_path, status_path=self.status_path)
+    paths = (work_times_files.log_path, work_times_files.status_path, work_times_files.journal_path)
+    if not any(path.exists() for path in paths):
+      return
+    all_elapsed = work_times_files.get_all_elapsed()
+    mode, elapsed = work_times_files.get_status()
+    if not all_elapsed and mode is None:
+      return
+    logging.warning('Importing the current totals and status from {}.'
+                    .format(str(work_times_files.log_path.parent)))
+    era_id = self._get_era_id(create=True)
+    for total_mode, total_elapsed in all_elapsed.items():
+      self._add_to_total(era_id, total_mode, total_elapsed)
+    if mode is not None:
+      self._execute('INSERT INTO period (era_id, mode, start) VALUES (?, ?, ?)',
+                    (era_id, mode, int(time.time())-elapsed))
 
-  def clear(self, new_description=''):
-    # Create a new Era
-    new_era = Era(user=self.user, current=True, description=new_description)
-    # Get the current Era, if any, and mark it as not the current one.
+  def _execute(self, sql, parameters=()):
     try:
-      old_era = Era.objects.get(user=self.user, current=True)
-      old_era.current = False
-    except Era.DoesNotExist:
-      old_era = None
-    # Get the current Period, if any, and end it.
-    if old_era:
-      try:
-        current_period = Period.objects.get(era=old_era, end=None, next=None)
-        current_period.end = int(time.time())
-      except Period.DoesNotExist:
-        current_period = None
+      return self.connection.execute(sql, parameters)
+    except self._sqlite3.Error as error:
+      raise WorkTimeError(error)
+
+  @contextlib.contextmanager
+  def _transaction(self, write=True):
+    """Run everything inside this context in one transaction.
+    A `write` transaction takes the database's write lock right away, so that invocations making
+    changes at the same time take turns instead of one failing partway through."""
+    if self._in_transaction:
+      yield
+      return
+    if write:
+      self._execute('BEGIN IMMEDIATE')
     else:
-      current_period = None
-    # Commit changes.
+      self._execute('BEGIN')
+    self._in_transaction = True
+    try:
+      yield
+    except BaseException:
+      self._execute('ROLLBACK')
+      raise
+    else:
+      self._execute('COMMIT')
+    finally:
+      self._in_transaction = False
+
+  def _get_era_id(self, create=False):
+    row = self._execute('SELECT id FROM era WHERE current = 1').fetchone()
+    if row is not None:
+      return row[0]
+    elif create:
+      return self._execute("INSERT INTO era (description, current) VALUES ('', 1)").lastrowid
+    else:
+      return None
+
+  def _add_to_total(self, era_id, mode, delta):
+    self._execute('INSERT INTO total (era_id, mode, elapsed) VALUES (?, ?, ?) '
+                  'ON CONFLICT (era_id, mode) DO UPDATE SET elapsed = elapsed + excluded.elapsed',
+                  (era_id, mode, delta))
+
+  def clear(self):
+    # Like the website, start a new Era, leaving the old one's history intact.
+    with self._transaction():
+      old_era_id = self._get_era_id()
+      if old_era_id is not None:
+        self._execute('UPDATE period SET "end" = ? WHERE era_id = ? AND "end" IS NULL',
+                      (int(time.time()), old_era_id))
+        self._execute('UPDATE era SET current = 0 WHERE id = ?', (old_era_id,))
+      self._get_era_id(create=True)
+
+  def get_status(self):
+    # Use the data already loaded by get_summary(), if any.
+    if self._snapshot is not None:
+      if self._snapshot['current'] is None:
+        return None, None
+      mode, start = self._snapshot['current']
+      self.validate_mode(mode)
+      return mode, self._snapshot['now'] - start
+    row = self._execute('SELECT period.mode, period.start FROM period '
+                        'JOIN era ON period.era_id = era.id '
+                        'WHERE era.current = 1 AND period."end" IS NULL').fetchone()
+    if row is None:
+      return None, None
+    mode, start = row
+    self.validate_mode(mode)
+    return mode, int(time.time()) - start
+
+  def switch_mode(self, mode):
+    self.validate_mode(mode)
+    with self._transaction():
+      era_id = self._get_era_id(create=True)
+      now = int(time.time())
+      old_period = self._execute('SELECT id, mode, start FROM period '
+                                 'WHERE era_id = ? AND "end" IS NULL', (era_id,)).fetchone()
+      if old_period is None:
+        old_mode = old_elapsed = None
+      else:
+        old_id, old_mode, old_start = old_period
+        if old_mode == mode:
+          return old_mode, None
+        # End the old Period, and add its elapsed time to the Total.
+        old_elapsed = now - old_start
+        self._execute('UPDATE period SET "end" = ? WHERE id = ?', (now, old_id))
+        if old_mode is not None and old_mode not in self.hidden:
+          self._add_to_total(era_id, old_mode, old_elapsed)
+      self._execute('INSERT INTO period (era_id, mode, start) VALUES (?, ?, ?)', (era_id, mode, now))
+    return old_mode, old_elapsed
+
+  def add_elapsed(self, mode, delta):
+    assert mode is not None, mode
+    self.validate_mode(mode)
+    with self._transaction():
+      era_id = self._get_era_id(create=True)
+      self._execute('INSERT INTO adjustment (era_id, mode, delta, timestamp) VALUES (?, ?, ?, ?)',
+                    (era_id, mode, delta, int(time.time())))
+      self._add_to_total(era_id, mode, delta)
+
+  def apply_batch(self, operations):
+    # Make all the changes or none of them.
+    with self._transaction():
+      return super().apply_batch(operations)
+
+  def get_elapsed(self, mode):
+    if mode is None:
+      return None
+    self.validate_mode(mode)
+    elapsed = self.get_all_elapsed().get(mode, 0)
+    current_mode, current_elapsed = self.get_status()
+    if current_mode == mode:
+      elapsed += current_elapsed
+    return elapsed
+
+  def get_all_elapsed(self):
+    if self._snapshot is not None:
+      # Return a copy, since callers add the current period to it.
+      return dict(self._snapshot['totals'])
+    rows = self._execute('SELECT total.mode, total.elapsed FROM total '
+                         'JOIN era ON total.era_id = era.id WHERE era.current = 1')
+    return dict(rows.fetchall())
+
+  def get_summary(self, numbers='values', modes=RATIO_MODES, timespans=(6*60*60,)):
+    now = int(time.time())
+    if timespans:
+      cutoff = now - max(timespans)
+    else:
+      cutoff = now
+    # Read it all in one transaction, so it's from one moment even if a change is being made.
+    with self._transaction(write=False):
+      self._snapshot = self._query_snapshot(cutoff, now)
+    try:
+      summary = super().get_summary(numbers=numbers, modes=modes)
+      self._add_snapshot_summary(summary, self._snapshot, numbers, modes, timespans)
+    finally:
+      self._snapshot = None
+    return summary
+
+  def _query_snapshot(self, cutoff, now):
+    """Fetch all the data needed for a summary, in the same form as
+    WorkTimesDatabase._query_snapshot()."""
+    snapshot = {'now':now, 'cutoff':cutoff, 'era':None, 'eras':[], 'totals':{}, 'current':None,
+                'periods':[], 'adjustments':[]}
+    era_id = None
+    for other_era_id, description, current in self._execute('SELECT id, description, current '
+                                                             'FROM era'):
+      if current:
+        era_id = other_era_id
+        snapshot['era'] = {'id':era_id, 'description':description}
+      else:
+        snapshot['eras'].append((other_era_id, description))
+    if era_id is None:
+      return snapshot
+    rows = self._execute('SELECT mode, elapsed FROM total WHERE era_id = ?', (era_id,))
+    snapshot['totals'] = dict(rows.fetchall())
+    periods = self._execute('SELECT mode, start, "end" FROM period '
+                            'WHERE era_id = ? AND ("end" >= ? OR "end" IS NULL) ORDER BY start',
+                            (era_id, cutoff))
+    for mode, start, end in periods:
+      if end is None:
+        snapshot['current'] = (mode, start)
+      else:
+        snapshot['periods'].append((mode, start, end))
+    adjustments = self._execute('SELECT mode, delta, timestamp FROM adjustment '
+                                'WHERE era_id = ? AND timestamp >= ? ORDER BY timestamp',
+                                (era_id, cutoff))
+    snapshot['adjustments'] = adjustments.fetchall()
+    return snapshot
+
+  def _get_snapshot_totals(self, timespans, snapshot):
+    # Loading NumPy would take much longer than it could save over the few Periods in a report.
+    now = snapshot['now']
+    cutoffs = [now-timespan for timespan in timespans]
+    periods = list(snapshot['periods'])
+    if snapshot['current'] is not None:
+      mode, start = snapshot['current']
+      periods.append((mode, start, None))
+    return clip_totals_python(periods, snapshot['adjustments'], cutoffs, now)
+
+
+class WorkTimesDatabase(WorkTimes):
+
+  def __init__(self, user=None, era=None, modes=MODES, hidden=HIDDEN, abbrev=True):
+    super().__init__(modes=modes, hidden=hidden, abbrev=abbrev)
+    self.user = user
+    if era is None:
+      try:
+        era = Era.objects.get(user=self.user, current=True)
+      except Era.DoesNotExist:
+        era = None
+    self.era = era
+    # Cache of the data needed for a summary, loaded all at once by get_summary().
+    self._snapshot = None
+
+  def clear(self, new_description=''):
+    # Create a new Era
+    new_era = Era(user=self.user, current=True, description=new_description)
     with transaction.atomic():
+      # Get the current Era, if any, and mark it as not the current one.
+      try:
+        old_era = Era.objects.select_for_update().get(user=self.user, current=True)
+      except Era.DoesNotExist:
+        old_era = None
       new_era.save()
       if old_era:
-        old_era.save()
-      if current_period:
-        current_period.save()
+        # End the current Period, if any.
+        if old_era.current_period_id is not None:
+          end = int(time.time())
+          Period.objects.filter(pk=old_era.current_period_id).update(end=end)
+          self._add_to_rollups(old_era, old_era.current_mode, old_era.current_start, end)
+        old_era.current = False
+        old_era.current_period = old_era.current_mode = old_era.current_start = None
+        old_era.save(update_fields=['current', 'current_period', 'current_mode', 'current_start'])
+      self.invalidate_cache(old_era, new_era)
+    self.era = new_era
 
   def switch_era(self, new_era=None, id=None):
     # Get the new era, make it the current one.
@@ -613,74 +1568,87 @@ class WorkTimesDatabase(WorkTimes):
     else:
       assert new_era is not None
     new_era.current = True
-    # Get the old era, make it not current anymore.
-    try:
-      old_era = Era.objects.get(user=self.user, current=True)
-      old_era.current = False
-    except Era.DoesNotExist:
-      old_era = None
-    # Commit changes.
     with transaction.atomic():
+      # Get the old era, make it not current anymore.
+      try:
+        old_era = Era.objects.select_for_update().get(user=self.user, current=True)
+        old_era.current = False
+      except Era.DoesNotExist:
+        old_era = None
+      # Commit changes.
       if old_era is not None:
-        old_era.save()
-      new_era.save()
+        old_era.save(update_fields=['current'])
+      new_era.save(update_fields=['current'])
+      self.invalidate_cache(old_era, new_era)
+    self.era = new_era
     return True
 
   def get_status(self, era=None):
+    # Use the data already loaded by get_summary(), if any.
+    if era is None and self._snapshot is not None:
+      if self._snapshot['current'] is None:
+        return None, None
+      mode, start = self._snapshot['current']
+      self.validate_mode(mode)
+      return mode, self._snapshot['now'] - start
     # Get the current Era, if not already given.
     if era is None:
       era = self.era
       if era is None:
         return None, None
-    # Get the current Period.
-    try:
-      current_period = Period.objects.get(era=era, end=None, next=None)
-    except Period.DoesNotExist:
+    # The Era row says what the current Period is.
+    period_id, mode, start = (Era.objects.values_list('current_period', 'current_mode', 'current_start')
+                                         .get(pk=era.pk))
+    if period_id is None:
       return None, None
     # Calculate and return mode, elapsed
-    self.validate_mode(current_period.mode)
+    self.validate_mode(mode)
     now = int(time.time())
-    return current_period.mode, now - current_period.start
+    return mode, now - start
 
-  def switch_mode(self, mode, era=None):
-    # Note: If mode is None, this will just create a new Period where the mode is None.
+  def switch_mode(self, mode, era=None, now=None):
+    """Start a new Period in `mode`, ending the current one. `now` is when the switch happened, if
+    it was made earlier (e.g. offline), though it can't go back before the current Period started.
+    Note: If mode is None, this will just create a new Period where the mode is None."""
     self.validate_mode(mode)
-    # Get the current Era, or create one if it doesn't exist.
-    if era is None:
-      era, created = Era.objects.get_or_create(user=self.user, current=True)
-    # Create a new Period.
-    now = int(time.time())
-    new_period = Period(era=era, mode=mode, start=now)
-    # Get the old Period, if any.
-    try:
-      old_period = Period.objects.get(era=era, end=None, next=None)
-    except Period.DoesNotExist:
-      old_period = None
-    if old_period:
-      if old_period.mode == mode:
-        return old_period.mode, None
-      # If there was an old Period, end it, and add its elapsed time to the Total.
-      old_period.end = now
-      new_period.prev = old_period
-      if mode is None:
-        logging.info('No mode.')
-        total = None
-      else:
-        total, created = Total.objects.get_or_create(era=era, mode=old_period.mode)
-        total.elapsed += old_period.elapsed
-    else:
-      total = None
-    # Commit changes.
     with transaction.atomic():
+      # Get the current Era, or create one if it doesn't exist.
+      if era is None:
+        era, created = Era.objects.get_or_create(user=self.user, current=True)
+      # Lock the Era, so two switches at once can't both end the same Period and start new ones.
+      self._lock_era(era)
+      now = self._get_change_time(era, now)
+      # The old Period, if any, is the one the Era points to.
+      old_period_id = era.current_period_id
+      old_mode = era.current_mode
+      old_elapsed = None
+      if old_period_id is not None:
+        if old_mode == mode:
+          return old_mode, None
+        # If there was an old Period, end it, and add its elapsed time to the Total.
+        old_elapsed = now - era.current_start
+        Period.objects.filter(pk=old_period_id).update(end=now)
+        self._add_to_rollups(era, old_mode, era.current_start, now)
+        if old_mode is not None:
+          self._add_to_total(era, old_mode, old_elapsed)
+      # Create a new Period, recording what the Totals were when it started, for get_totals_asof().
+      # Adjustments made in the same second it started (or after, if the switch was backdated)
+      # count as coming after it.
+      totals = self._query_totals(era)
+      later_adjustments = (Adjustment.objects.filter(era=era, timestamp__gte=now)
+                                             .values('mode').annotate(delta=models.Sum('delta'))
+                                             .values_list('mode', 'delta'))
+      for adjusted_mode, delta in later_adjustments:
+        totals[adjusted_mode] -= delta
+      new_period = Period(era=era, mode=mode, start=now, prev_id=old_period_id)
+      new_period.cumulative = json.dumps(totals, sort_keys=True)
       new_period.save()
-      if old_period:
-        old_period.save()
-      if total:
-        total.save()
-    if old_period:
-      return old_period.mode, old_period.elapsed
-    else:
-      return None, None
+      era.current_period = new_period
+      era.current_mode = mode
+      era.current_start = now
+      era.save(update_fields=['current_period', 'current_mode', 'current_start'])
+      self.invalidate_cache(era)
+    return old_mode, old_elapsed
 
   def get_elapsed(self, mode):
     if mode is None:
@@ -691,12 +1659,11 @@ class WorkTimesDatabase(WorkTimes):
       era = Era.objects.get(user=self.user, current=True)
     except Era.DoesNotExist:
       return 0
-    # Get the current Period.
+    # Add the current Period, if it's in this mode.
     now = int(time.time())
-    try:
-      current_period = Period.objects.get(era=era, mode=mode, end=None, next=None)
-      elapsed_period = now - current_period.start
-    except Period.DoesNotExist:
+    if era.current_period_id is not None and era.current_mode == mode:
+      elapsed_period = now - era.current_start
+    else:
       elapsed_period = 0
     # Get the Total for this mode.
     try:
@@ -706,75 +1673,466 @@ class WorkTimesDatabase(WorkTimes):
       elapsed_total = 0
     return elapsed_period + elapsed_total
 
-  def add_elapsed(self, mode, delta, era=None):
+  def add_elapsed(self, mode, delta, era=None, now=None):
+    """Add `delta` seconds to the Total for `mode`. `now` is when the adjustment was made, if it was
+    earlier (limited like in switch_mode())."""
     assert mode is not None, mode
     self.validate_mode(mode)
-    # Get the current Era or create it if it doesn't exist.
-    if era is None:
-      era, created = Era.objects.get_or_create(user=self.user, current=True)
-    now = int(time.time())
-    # Create an Adjustment, and add to the Total for this mode.
-    adjustment = Adjustment(era=era, mode=mode, delta=delta, timestamp=now)
-    total, created = Total.objects.get_or_create(era=era, mode=mode)
-    total.elapsed += delta
-    # Commit changes.
     with transaction.atomic():
-      adjustment.save()
-      total.save()
+      # Get the current Era or create it if it doesn't exist.
+      if era is None:
+        era, created = Era.objects.get_or_create(user=self.user, current=True)
+      self._lock_era(era)
+      now = self._get_change_time(era, now)
+      # Create an Adjustment, and add to the Total for this mode.
+      Adjustment.objects.create(era=era, mode=mode, delta=delta, timestamp=now)
+      self._add_to_total(era, mode, delta)
+      self._add_to_rollups(era, mode, *adjustment_span(delta, now))
+      self.invalidate_cache(era)
     return True
 
+  def apply_batch(self, operations, era=None):
+    """Apply all the operations in one transaction, with the Era locked the whole time.
+    If any of them fail, none are applied. Each operation can include the 'timestamp' when it was
+    made, if that was earlier."""
+    with transaction.atomic():
+      if era is None:
+        era, created = Era.objects.get_or_create(user=self.user, current=True)
+      self._lock_era(era)
+      results = []
+      for operation in operations:
+        if operation.get('mode') not in self.modes:
+          raise WorkTimeError('Invalid mode {!r}.'.format(operation.get('mode')))
+        timestamp = operation.get('timestamp')
+        if timestamp is not None and (not isinstance(timestamp, int)
+                                      or isinstance(timestamp, bool)):
+          raise WorkTimeError('Invalid timestamp {!r}.'.format(timestamp))
+        if operation.get('type') == 'switch':
+          results.append(self.switch_mode(operation.get('mode'), era=era, now=timestamp))
+        elif operation.get('type') == 'adjust':
+          delta = operation.get('delta')
+          if not isinstance(delta, int) or isinstance(delta, bool):
+            raise WorkTimeError('Invalid adjustment delta {!r}.'.format(delta))
+          self.add_elapsed(operation.get('mode'), delta, era=era, now=timestamp)
+          results.append(None)
+        else:
+          raise WorkTimeError('Invalid operation type {!r}.'.format(operation.get('type')))
+    self.era = era
+    return results
+
   def get_all_elapsed(self):
-    try:
-      era = Era.objects.get(user=self.user, current=True)
-    except Era.DoesNotExist:
+    if self._snapshot is not None:
+      # Return a copy, since callers add the current period to it.
+      return dict(self._snapshot['totals'])
+    if self.era is None:
       return {}
-    data = {}
-    for total in Total.objects.filter(era=era):
-      data[total.mode] = total.elapsed
-    return data
+    return self._query_totals(self.era)
+
+  def iter_history(self, era=None, batch_size=1000):
+    """Yield every Period and Adjustment in the `era` as a dict, in chronological order.
+    Periods are placed by their start and Adjustments by when they were made. Rows are fetched
+    `batch_size` at a time, so memory use doesn't grow with the length of the Era."""
+    if era is None:
+      era = self.era
+      if era is None:
+        return
+    periods = (Period.objects.filter(era=era).order_by('start', 'id')
+                             .values_list('mode', 'start', 'end').iterator(chunk_size=batch_size))
+    adjustments = (Adjustment.objects.filter(era=era).order_by('timestamp', 'id')
+                                     .values_list('mode', 'delta', 'timestamp')
+                                     .iterator(chunk_size=batch_size))
+    period_dicts = ({'type':'period', 'mode':mode, 'start':start, 'end':end}
+                    for mode, start, end in periods)
+    adjustment_dicts = ({'type':'adjustment', 'mode':mode, 'delta':delta, 'timestamp':timestamp}
+                        for mode, delta, timestamp in adjustments)
+    yield from heapq.merge(period_dicts, adjustment_dicts,
+                           key=lambda record: record.get('start', record.get('timestamp')))
+
+  def import_history(self, records, era=None, batch_size=1000):
+    """Add the Periods and Adjustments in `records` (dicts like `parse_history()` yields) to the
+    `era` (by default, the current one).
+    The Periods must be finished, in chronological order, and can't overlap each other or any
+    Period already in the Era. The Adjustments can be in any order. Everything is checked before
+    anything is written. Then the records
+    are inserted in batches, linked into the chain of Periods, and added to each Total once.
+    Returns the number of Periods and Adjustments added."""
+    if era is None:
+      era, created = Era.objects.get_or_create(user=self.user, current=True)
+    now = int(time.time())
+    periods = []
+    adjustments = []
+    for record in records:
+      line_num = record.get('line')
+      try:
+        self.validate_mode(record['mode'])
+      except WorkTimeError as error:
+        raise WorkTimeError('Line {}: {}'.format(line_num, error))
+      if record['type'] == 'period':
+        if not record['start'] <= record['end'] <= now:
+          raise WorkTimeError('Line {}: Period must start before it ends, and end in the past.'
+                              .format(line_num))
+        if periods and record['start'] < periods[-1].end:
+          raise WorkTimeError('Line {}: Period is out of order or overlaps the one before it.'
+                              .format(line_num))
+        periods.append(Period(era=era, mode=record['mode'], start=record['start'],
+                              end=record['end']))
+      else:
+        if record['mode'] is None or record['timestamp'] > now:
+          raise WorkTimeError('Line {}: Adjustment must have a mode and be in the past.'
+                              .format(line_num))
+        adjustments.append(Adjustment(era=era, mode=record['mode'], delta=record['delta'],
+                                      timestamp=record['timestamp']))
+    # Adjustments can come in any order, but they're replayed in order.
+    adjustments.sort(key=lambda adjustment: adjustment.timestamp)
+    with transaction.atomic():
+      self._lock_era(era)
+      if periods:
+        neighbors = self._check_import_overlap(era, periods, now)
+        rebuild = True
+      elif adjustments:
+        # Only Periods that started after an Adjustment include it in their cumulative totals.
+        last_start = (Period.objects.filter(era=era).order_by('-start')
+                                    .values_list('start', flat=True).first())
+        rebuild = last_start is not None and adjustments[0].timestamp < last_start
+      else:
+        rebuild = False
+      if rebuild:
+        # Fill in the cumulative totals of the new Periods (and any later ones) before saving.
+        self.rebuild_cumulative(era, batch_size=batch_size, new_periods=periods,
+                                new_adjustments=adjustments)
+      if periods:
+        Period.objects.bulk_create(periods, batch_size=batch_size)
+        self._link_imported_periods(era, periods, *neighbors)
+      Adjustment.objects.bulk_create(adjustments, batch_size=batch_size)
+      # Add everything to the Totals, once per mode.
+      amounts = collections.defaultdict(int)
+      for period in periods:
+        if period.mode is not None:
+          amounts[period.mode] += period.end - period.start
+      for adjustment in adjustments:
+        amounts[adjustment.mode] += adjustment.delta
+      for mode, amount in amounts.items():
+        self._add_to_total(era, mode, amount)
+      spans = [(period.mode, period.start, period.end, 1) for period in periods]
+      for adjustment in adjustments:
+        spans.append((adjustment.mode, *adjustment_span(adjustment.delta, adjustment.timestamp)))
+      self._add_spans_to_rollups(era, spans)
+      self.invalidate_cache(era)
+    return len(periods), len(adjustments)
+
+  def _check_import_overlap(self, era, periods, now):
+    """Make sure none of the new `periods` overlap a Period already in the `era`.
+    Returns the existing Periods around and among them, as (id, start, prev_id) tuples: the one
+    right before, a list of the ones in between, and the one right after."""
+    low = periods[0].start
+    high = periods[-1].end
+    existing = (Period.objects.filter(era=era).order_by('start', 'id')
+                              .values_list('id', 'start', 'end', 'prev_id'))
+    before = existing.filter(start__lt=low).last()
+    among = list(existing.filter(start__gte=low, start__lte=high))
+    after = existing.filter(start__gt=high).first()
+    ends = [period.end for period in periods]
+    if before is None:
+      nearby = among
+    else:
+      nearby = [before] + among
+    for period_id, start, end, prev_id in nearby:
+      if end is None:
+        end = max(start, now)
+      # The first new Period that ends after this one starts is the only one that could overlap.
+      i = bisect.bisect_right(ends, start)
+      if i < len(periods) and periods[i].start < end:
+        raise WorkTimeError('Period from {} to {} overlaps an existing Period ({} to {}).'
+                            .format(periods[i].start, periods[i].end, start, end))
+    return before, among, after
+
+  def _link_imported_periods(self, era, periods, before, among, after):
+    """Fit the newly created `periods` into the chain of `prev` links, in order of start time."""
+    # Find the existing Periods that will come right after a new one.
+    chain = [(start, 0, period_id) for period_id, start, end, prev_id in among]
+    chain.extend((period.start, 1, None) for period in periods)
+    chain.sort(key=lambda link: link[:2])
+    if after is not None:
+      chain.append((after[1], 0, after[0]))
+    moved = [link[2] for prev_link, link in zip(chain, chain[1:]) if prev_link[1] and not link[1]]
+    # Unlink those first, so no two Periods point at the same one at once.
+    Period.objects.filter(pk__in=moved).update(prev=None)
+    # Then point every unlinked Period in the range at the one that starts right before it.
+    low = periods[0].start
+    if after is None:
+      high = periods[-1].end
+    else:
+      high = after[1]
+    # (The redundant `start <= start` lets the database find it with the (era, start) index.)
+    earlier = (Period.objects.filter(era=era, start__lte=models.OuterRef('start'))
+                             .filter(models.Q(start__lt=models.OuterRef('start')) |
+                                     models.Q(id__lt=models.OuterRef('id')))
+                             .order_by('-start', '-id').values('id')[:1])
+    (Period.objects.filter(era=era, prev=None, start__gte=low, start__lte=high)
+                   .update(prev=models.Subquery(earlier)))
+
+  def _query_totals(self, era):
+    return dict(Total.objects.filter(era=era).values_list('mode', 'elapsed'))
+
+  def _lock_era(self, era):
+    """Lock the `era`'s row until the end of the transaction, and reload its current Period fields.
+    Every change to an Era takes this lock first, so they happen one at a time."""
+    era.current_period_id, era.current_mode, era.current_start = (
+      Era.objects.select_for_update()
+                 .values_list('current_period', 'current_mode', 'current_start').get(pk=era.pk)
+    )
+
+  def _add_to_total(self, era, mode, delta):
+    """Add `delta` seconds to the Total for `mode` in the database itself, so no other change to it
+    can be lost. Call this inside the transaction making the change, with the Era locked."""
+    updated = Total.objects.filter(era=era, mode=mode).update(elapsed=models.F('elapsed')+delta)
+    if not updated:
+      Total.objects.create(era=era, mode=mode, elapsed=delta)
+
+  def _get_change_time(self, era, now=None):
+    """Get the time to record a change to the `era` at: `now` if given, but not in the future, and
+    not before the latest Period started (its cumulative totals are already recorded)."""
+    current_time = int(time.time())
+    if now is None or now > current_time:
+      return current_time
+    if era.current_period_id is not None:
+      latest_start = era.current_start
+    else:
+      latest_start = (Period.objects.filter(era=era).order_by('-start')
+                      .values_list('start', flat=True).first())
+    if latest_start is not None and now < latest_start:
+      return latest_start
+    return now
+
+  def get_totals_asof(self, timestamp, era=None):
+    """Get the total time spent in each mode as of `timestamp`: what the Totals were then, plus
+    however much of the Period in progress at the time had elapsed.
+    This uses the totals recorded at the start of each Period, so it only needs the last Period to
+    start before `timestamp` and the Adjustments made since then, however long the Era is.
+    Adjustments count in full at the moment they were made, like they do in the Totals. Those made
+    in the same second a Period started aren't in its recorded totals."""
+    if era is None:
+      era = self.era
+      if era is None:
+        return {}
+    period = (Period.objects.filter(era=era, start__lte=timestamp).order_by('-start', '-id')
+              .values_list('mode', 'start', 'end', 'cumulative').first())
+    adjustments = Adjustment.objects.filter(era=era, timestamp__lte=timestamp)
+    if period is None:
+      totals = {}
+    else:
+      mode, start, end, cumulative = period
+      if cumulative is None:
+        raise WorkTimeError('Period starting at {} has no cumulative totals. Run the '
+                            '"rebuild_cumulative" command to fill them in.'.format(start))
+      totals = json.loads(cumulative)
+      if mode is not None:
+        if end is None:
+          end = min(timestamp, int(time.time()))
+        elif end > timestamp:
+          end = timestamp
+        totals[mode] = totals.get(mode, 0) + end - start
+      adjustments = adjustments.filter(timestamp__gte=start)
+    for mode, delta in adjustments.values_list('mode', 'delta'):
+      totals[mode] = totals.get(mode, 0) + delta
+    return totals
+
+  def get_totals_between(self, start, end, era=None):
+    """Get the time spent in each mode between the timestamps `start` and `end`."""
+    totals = self.get_totals_asof(end, era=era)
+    for mode, elapsed in self.get_totals_asof(start, era=era).items():
+      totals[mode] = totals.get(mode, 0) - elapsed
+    return totals
+
+  def rebuild_cumulative(self, era, batch_size=1000, new_periods=(), new_adjustments=()):
+    """Recalculate the cumulative totals of every Period in the `era` from scratch.
+    This replays the Periods and Adjustments in order, the same way switch_mode() and
+    add_elapsed() would have added them to the Totals. Adjustments made in the same second a Period
+    started are counted as coming after it. Only Periods whose totals changed are saved.
+    `new_periods` and `new_adjustments` are unsaved objects to include in the replay (in order).
+    The totals are set on the `new_periods`, but they're left for the caller to save."""
+    periods = (Period.objects.filter(era=era).order_by('start', 'id')
+                             .only('mode', 'start', 'end', 'cumulative')
+                             .iterator(chunk_size=batch_size))
+    periods = heapq.merge(periods, new_periods, key=lambda period: period.start)
+    adjustments = (Adjustment.objects.filter(era=era).order_by('timestamp', 'id')
+                                     .values_list('mode', 'delta', 'timestamp')
+                                     .iterator(chunk_size=batch_size))
+    new_adjustments = ((adjustment.mode, adjustment.delta, adjustment.timestamp)
+                       for adjustment in new_adjustments)
+    adjustments = heapq.merge(adjustments, new_adjustments, key=lambda adjustment: adjustment[2])
+    next_adjustment = next(adjustments, None)
+    totals = {}
+    last_period = None
+    batch = []
+    count = 0
+    with transaction.atomic():
+      for period in periods:
+        # switch_mode() adds the last Period to the Totals whenever it had a mode.
+        if last_period is not None and last_period.mode is not None:
+          totals[last_period.mode] = totals.get(last_period.mode, 0) + last_period.elapsed
+        while next_adjustment is not None and next_adjustment[2] < period.start:
+          mode, delta, timestamp = next_adjustment
+          totals[mode] = totals.get(mode, 0) + delta
+          next_adjustment = next(adjustments, None)
+        cumulative = json.dumps(totals, sort_keys=True)
+        changed = period.cumulative != cumulative
+        period.cumulative = cumulative
+        if period.pk is not None and changed:
+          batch.append(period)
+          if len(batch) >= batch_size:
+            Period.objects.bulk_update(batch, ['cumulative'])
+            batch = []
+        last_period = period
+        count += 1
+      Period.objects.bulk_update(batch, ['cumulative'])
+    return count
 
   #TODO: Remove.
   #      The parent class takes care of the basic interface, which is all get_summary() should be.
   #      Instead, let the view call special methods for all the display-related stuff.
-  def get_summary(self, numbers='values', modes=RATIO_MODES, timespans=(6*60*60,)):
-    summary = super().get_summary(numbers=numbers, modes=modes)
-    #TODO: Remove this deletion once we've gotten rid of get_summary().
-    if 'ratio_str' in summary:
-      del summary['ratio_str']
+  def get_summary(self, numbers='values', modes=RATIO_MODES, timespans=(6*60*60,), asof=None,
+                  between=None):
+    # Load everything we need up front, so the number of queries doesn't depend on the number of
+    # timespans or on how many of the methods below need the same data.
+    # Long timespans are totaled from the Rollup table instead, but the history bar needs the
+    # Periods from the shortest one.
+    snapshot_timespans = [timespan for timespan in timespans
+                          if timespan < ROLLUP_MIN_TIMESPAN or timespan == min(timespans)]
+    with time_phase('snapshot'):
+      self._snapshot = self._load_snapshot(snapshot_timespans)
+    # Only use the snapshot for this summary: later calls have to see the current time and data.
     try:
-      era = Era.objects.get(user=self.user, current=True)
-      summary['era'] = era.description
-    except Era.DoesNotExist:
-      era = None
-      summary['era'] = None
-    summary['eras'] = []
-    for other_era in Era.objects.filter(user=self.user, current=False):
-      era_dict = {'id':other_era.id}
-      if other_era.description:
-        era_dict['name'] = other_era.description[:22]
-      else:
-        era_dict['name'] = str(other_era.id)
-      summary['eras'].append(era_dict)
-    summary['eras'].sort(key=lambda era_dict: era_dict['name'])
-    if timespans:
-      ratios = self._get_recent_ratios(timespans, numbers, modes, era=era)
-      #TODO: Make 'ratios' a dict with keys 'num', 'denom', and 'timespans', which is the regular list.
-      summary['ratios'].extend(ratios)
-      summary['ratio_meta'] = {}
-      summary['ratio_meta']['num'] = get_mode_name(RATIO_MODES[0], self.abbrev)
-      summary['ratio_meta']['denom'] = get_mode_name(RATIO_MODES[1], self.abbrev)
-      timespan = list(sorted(timespans))[0]
-      summary['history'] = {}
-      summary['history']['periods'] = self._get_recent_bars(timespan, numbers=numbers, era=era)
-      summary['history']['adjustments'] = self._get_recent_adjustments(timespan, numbers=numbers,
-                                                                       era=era)
-      if numbers == 'values':
-        summary['history']['timespan'] = timespan
-      elif numbers == 'text':
-        summary['history']['timespan'] = timestring(timespan, format='even', abbrev=False)
+      summary = super().get_summary(numbers=numbers, modes=modes)
+      #TODO: Remove this deletion once we've gotten rid of get_summary().
+      if 'ratio_str' in summary:
+        del summary['ratio_str']
+      with time_phase('ratios_and_bars'):
+        self._add_snapshot_summary(summary, self._snapshot, numbers, modes, timespans)
+    finally:
+      self._snapshot = None
+    if asof is not None:
+      summary['asof'] = {'timestamp':asof}
+      totals = self.get_totals_asof(asof)
+      summary['asof']['elapsed'] = self._format_elapsed(totals, numbers)
+    if between is not None:
+      start, end = between
+      summary['between'] = {'start':start, 'end':end}
+      totals = self.get_totals_between(start, end)
+      summary['between']['elapsed'] = self._format_elapsed(totals, numbers)
     summary['settings'] = self._get_user_settings()
     return summary
 
+  def invalidate_cache(self, *eras):
+    """Mark any cached summary data for the given Eras as stale, by bumping their versions.
+    Call this after every change to an Era or its Periods, Adjustments, or Totals, inside the same
+    transaction. This also notifies any clients listening for changes to the user's data.
+    Versions go by the millisecond, so if the transaction is rolled back, the next change won't
+    reuse the version any data cached during it was stored under."""
+    self._snapshot = None
+    eras = [era for era in eras if era is not None]
+    if not eras:
+      return
+    era_ids = [era.id for era in eras]
+    version = Greatest(models.F('version')+1, int(time.time()*1000))
+    Era.objects.filter(pk__in=era_ids).update(version=version)
+    versions = dict(Era.objects.filter(pk__in=era_ids).values_list('id', 'version'))
+    for era in eras:
+      era.version = versions[era.id]
+    if self.era is not None and self.era.id in versions:
+      self.era.version = versions[self.era.id]
+    # Wait until the change is visible to other processes, or they could re-cache the old data.
+    transaction.on_commit(lambda: self._publish_change(versions))
+
+  def _publish_change(self, versions):
+    if self.user is not None and events_enabled():
+      get_broker().publish(self.user.id, 'change', {'versions':versions})
+
+  def get_version(self):
+    """Get a number which changes every time the current Era is written to."""
+    if self.era is None:
+      return None
+    return self.era.version
+
+  def _cache_key(self, kind, era, version=None):
+    if self.user is None:
+      user_id = None
+    else:
+      user_id = self.user.id
+    key = 'worktime:{}:{}:{}'.format(kind, user_id, era.id)
+    if version is not None:
+      key += ':{}'.format(version)
+    return key
+
+  def _load_snapshot(self, timespans):
+    """Get all the data needed for a summary, from the cache if possible.
+    The cached data only changes on a write, so it can be reused across requests. Only the
+    time-dependent parts of the summary have to be recomputed from it."""
+    now = int(time.time())
+    if not timespans:
+      cutoff = now
+    elif self._windows_in_sql():
+      # Only the history bar, over the shortest timespan, needs the Periods themselves.
+      cutoff = now - min(timespans)
+    else:
+      cutoff = now - max(timespans)
+    if self.era is None:
+      return self._query_snapshot(cutoff, now)
+    cache = get_cache()
+    key = self._cache_key('snapshot', self.era, self.era.version)
+    snapshot = cache.get(key)
+    # The cached data only covers Periods back to its own cutoff.
+    if snapshot is None or snapshot['cutoff'] > cutoff:
+      snapshot = self._query_snapshot(cutoff, now)
+      cache.set(key, snapshot, SNAPSHOT_CACHE_TIMEOUT)
+    else:
+      snapshot['now'] = now
+    return snapshot
+
+  def _query_snapshot(self, cutoff, now):
+    """Fetch all the data needed for a summary in a fixed number of queries.
+    Periods and Adjustments are returned as plain tuples: (mode, start, end) and
+    (mode, delta, timestamp), respectively. Only those overlapping the time since `cutoff` are
+    included. The current Period is stored separately, as (mode, start)."""
+    snapshot = {'now':now, 'cutoff':cutoff, 'era':None, 'eras':[], 'totals':{}, 'current':None,
+                'periods':[], 'adjustments':[]}
+    era = self._query_eras(snapshot)
+    if era is None:
+      return snapshot
+    snapshot['totals'] = dict(Total.objects.filter(era=era).values_list('mode', 'elapsed'))
+    if era.current_period_id is not None:
+      snapshot['current'] = (era.current_mode, era.current_start)
+    periods = (Period.objects.filter(era=era, end__gte=cutoff).order_by('start')
+                             .values_list('mode', 'start', 'end'))
+    snapshot['periods'] = list(periods)
+    adjustments = (Adjustment.objects.filter(era=era, timestamp__gte=cutoff)
+                                     .order_by('timestamp')
+                                     .values_list('mode', 'delta', 'timestamp'))
+    snapshot['adjustments'] = list(adjustments)
+    return snapshot
+
+  def _query_eras(self, snapshot):
+    """Add the user's Eras to the `snapshot`: the current one as its 'era', and the (id, description)
+    of the others as its 'eras'. Returns the current Era, or None."""
+    era = None
+    for other_era in Era.objects.filter(user=self.user):
+      if other_era.current:
+        era = other_era
+        snapshot['era'] = {'id':era.id, 'description':era.description}
+      else:
+        snapshot['eras'].append((other_era.id, other_era.description))
+    return era
+
+  def get_meta(self):
+    """Get just the parts of a summary which rarely change: the Eras and the user's settings.
+    This takes one query."""
+    snapshot = {'era':None, 'eras':[]}
+    self._query_eras(snapshot)
+    meta = {}
+    self._add_eras(meta, snapshot)
+    meta['settings'] = self._get_user_settings()
+    return meta
+
   def _get_user_settings(self):
     settings = {}
     for setting in User.SETTINGS:
@@ -787,190 +2145,424 @@ class WorkTimesDatabase(WorkTimes):
         settings[setting] = getattr(self.user, setting)
     return settings
 
-  def _get_recent_ratios(self, timespans, numbers='values', modes=RATIO_MODES, era=None):
-    """Get ratios for only the last `timespan`s seconds."""
-    ratios = []
-    if era is None:
-      try:
-        era = Era.objects.get(user=self.user, current=True)
-      except Era.DoesNotExist:
-        return ratios
-    now = int(time.time())
-    cutoffs = [now-timespan for timespan in timespans]
-    min_cutoff = min(cutoffs)
-    periods = Period.objects.filter(era=era, end__gte=min_cutoff).order_by('start')
-    try:
-      current_period = Period.objects.get(era=era, end=None, next=None)
-    except Period.DoesNotExist:
-      current_period = None
+  def _get_window_totals(self, timespans, snapshot):
+    """Get the number of seconds spent in each mode in the last `timespan`s seconds.
+    Returns a list of dicts mapping modes to seconds, one for each timespan."""
+    now = snapshot['now']
+    short_timespans = [timespan for timespan in timespans if timespan < ROLLUP_MIN_TIMESPAN]
+    short_totals = dict(zip(short_timespans, self._get_snapshot_totals(short_timespans, snapshot)))
+    long_timespans = [timespan for timespan in timespans if timespan not in short_totals]
+    cutoffs = [now-timespan for timespan in long_timespans]
+    long_totals = dict(zip(long_timespans, self._get_rollup_totals(cutoffs, snapshot)))
     totals = []
-    for c in range(len(timespans)):
-      totals.append(collections.defaultdict(int))
-    for period in list(periods) + [current_period]:
-      for c, cutoff in enumerate(cutoffs):
-        if period and (period.end is None or period.end >= cutoff):
-          if period.start >= cutoff:
-            totals[c][period.mode] += period.elapsed
-          else:
-            totals[c][period.mode] += period.elapsed - (cutoff-period.start)
-    #TODO: If an adjustment happened earlier than this cutoff, but during a period that ended after
-    #      it, that might cause unnatural-feeling results. E.g. Maybe I left it on 'w' for an hour,
-    #      but took a 30 min break and forgot to turn it off. So I did an adjustment of -30, but
-    #      then left it on 'w' because I was back. This could possibly make a really weird ratio.
-    for adjustment in Adjustment.objects.filter(era=era, timestamp__gte=min_cutoff):
-      for c, cutoff in enumerate(cutoffs):
-        if adjustment.timestamp >= cutoff:
-          # Expand the adjustment backward into a "virtual period" `delta` long, ending when
-          # the adjustment was made. Then, only count the part of this "virtual period" that's
-          # after the cutoff.
-          time_btwn_adj_and_cutoff = adjustment.timestamp - cutoff
-          if abs(adjustment.delta) > time_btwn_adj_and_cutoff:
-            sign = int(adjustment.delta / abs(adjustment.delta))
-            totals[c][adjustment.mode] += sign * time_btwn_adj_and_cutoff
-          else:
-            totals[c][adjustment.mode] += adjustment.delta
-    # Make sure there are no negative totals.
-    for timespan_totals in totals:
+    for timespan in timespans:
+      if timespan in short_totals:
+        timespan_totals = short_totals[timespan]
+      else:
+        timespan_totals = long_totals[timespan]
+      # Make sure there are no negative totals.
       for mode in timespan_totals.keys():
         if timespan_totals[mode] < 0:
           timespan_totals[mode] = 0
-    # Calculate the ratios.
-    for c, timespan in enumerate(timespans):
-      ratio = {'totals':totals[c]}
-      mode0 = modes[0]
-      mode1 = modes[1]
-      logging.info('Totals for last {}s: {} in {}, {} in {}.'
-                   .format(timespan, totals[c][mode0], mode0, totals[c][mode1], mode1))
-      # Store the value of the ratio.
-      if totals[c][mode1] == 0:
-        if numbers == 'values':
-          ratio['value'] = float('inf')
-        elif numbers == 'text':
-          ratio['value'] = '∞'
-      else:
-        ratio['value'] = totals[c][mode0]/totals[c][mode1]
-        if numbers == 'text':
-          ratio['value'] = '{:0.2f}'.format(ratio['value'])
-      # Store the period of time the recent ratio is for.
-      if numbers == 'values':
-        ratio['timespan'] = timespan
-      elif numbers == 'text':
-        ratio['timespan'] = timestring(timespan, format='even', abbrev=True)
-      ratios.append(ratio)
-    return ratios
-
-  def _get_recent_bars(self, timespan, numbers='values', era=None, total_width=99):
-    """Get data for a display of recent periods."""
-    bar_periods = []
-    # Get current Era.
+      totals.append(timespan_totals)
+    return totals
+
+  def _windows_in_sql(self):
+    """Whether the database totals up the windows of the recent ratios (the default), instead of
+    clip_totals() working through the snapshot's Periods. The WORKTIME_WINDOW_ENGINE setting can be
+    set to 'memory' to do it in Python."""
+    return getattr(django_settings, 'WORKTIME_WINDOW_ENGINE', 'sql') == 'sql'
+
+  def _get_snapshot_totals(self, timespans, snapshot):
+    if self._windows_in_sql():
+      now = snapshot['now']
+      cutoffs = [now-timespan for timespan in timespans]
+      return self._query_window_totals(snapshot['era']['id'], cutoffs, now)
+    return super()._get_snapshot_totals(timespans, snapshot)
+
+  def _query_window_totals(self, era_id, cutoffs, now):
+    """The same as `clip_totals()`, but done by the database, in one query.
+    Each window is a pair of grouped SELECTs (Periods and Adjustments) and they're all combined
+    with UNION ALL, so the database returns one row per (window, mode) and no Periods are loaded."""
+    if not cutoffs:
+      return []
+    big_int = models.BigIntegerField()
+    now_value = models.Value(now, output_field=big_int)
+    queries = []
+    for c, cutoff in enumerate(cutoffs):
+      cutoff_value = models.Value(cutoff, output_field=big_int)
+      window = models.Value(c, output_field=models.IntegerField())
+      # SUM(LEAST(end, now) - GREATEST(start, cutoff)), with the current Period ending now.
+      end = Least(Coalesce('end', now_value), now_value, output_field=big_int)
+      clipped = end - Greatest('start', cutoff_value, output_field=big_int)
+      periods = (Period.objects.filter(era_id=era_id)
+                               .filter(models.Q(end__gte=cutoff) | models.Q(end=None))
+                               .annotate(window=window)
+                               .values('window', 'mode')
+                               .annotate(seconds=models.Sum(clipped, output_field=big_int)))
+      # Adjustments count as "virtual periods" ending when they were made (see clip_totals()).
+      since_cutoff = models.F('timestamp') - cutoff_value
+      clipped = models.Case(
+        models.When(delta__lt=0, then=-Least(-models.F('delta'), since_cutoff, output_field=big_int)),
+        default=Least('delta', since_cutoff, output_field=big_int),
+        output_field=big_int,
+      )
+      adjustments = (Adjustment.objects.filter(era_id=era_id, timestamp__gte=cutoff)
+                                       .annotate(window=window)
+                                       .values('window', 'mode')
+                                       .annotate(seconds=models.Sum(clipped, output_field=big_int)))
+      queries.append(periods.values_list('window', 'mode', 'seconds'))
+      queries.append(adjustments.values_list('window', 'mode', 'seconds'))
+    totals = [collections.defaultdict(int) for cutoff in cutoffs]
+    for window, mode, seconds in queries[0].union(*queries[1:], all=True):
+      totals[window][mode] += seconds
+    return totals
+
+  def _get_rollup_totals(self, cutoffs, snapshot):
+    """Total up the time spent in each mode since each of the `cutoffs`, using whole Rollup buckets
+    for as much of it as possible. The partial buckets at either edge are clipped exactly from the
+    raw Periods and Adjustments there. Returns a list of dicts mapping modes to seconds, one for
+    each cutoff. Totals can be negative. This takes three queries, however many cutoffs there
+    are."""
+    if not cutoffs:
+      return []
+    era_id = snapshot['era']['id']
+    now = snapshot['now']
+    small = min(ROLLUP_SIZES)
+    large = max(ROLLUP_SIZES)
+    # The edges of each window are [cutoff, head) and [tail, now). Between them, use large buckets
+    # where they fit. The tail is the same for all of them.
+    tail = now - now % small
+    windows = []
+    for cutoff in cutoffs:
+      head = min(-(-cutoff // small) * small, tail)
+      large_head = -(-head // large) * large
+      large_tail = tail - tail % large
+      if large_head >= large_tail:
+        large_head = large_tail = tail
+      buckets = (models.Q(size=small, start__gte=head, start__lt=large_head) |
+                 models.Q(size=large, start__gte=large_head, start__lt=large_tail) |
+                 models.Q(size=small, start__gte=large_tail, start__lt=tail))
+      windows.append((cutoff, head, buckets))
+    all_totals = [collections.defaultdict(int) for cutoff in cutoffs]
+    # Sum each window's buckets in its own column.
+    sums = {'window{}'.format(w):models.Sum(models.Case(models.When(buckets,
+                                                                    then=models.F('elapsed')),
+                                                        default=0))
+            for w, (cutoff, head, buckets) in enumerate(windows)}
+    min_bucket = min(head for cutoff, head, buckets in windows)
+    rollups = (Rollup.objects.filter(era_id=era_id, start__gte=min_bucket, start__lt=tail)
+                             .values('mode').annotate(**sums))
+    for row in rollups:
+      for w, totals in enumerate(all_totals):
+        totals[row['mode']] += row['window{}'.format(w)] or 0
+    # Finished Periods overlapping the edges: those ending inside them, plus the ones spanning
+    # each `head`. Periods in an Era don't overlap, so there's at most one of those per window.
+    edges = models.Q(end__gt=tail)
+    for cutoff, head, buckets in windows:
+      edges |= models.Q(end__gt=cutoff, end__lte=head) | models.Q(start__lt=head, end__gt=head)
+    edge_periods = (Period.objects.filter(era_id=era_id, end__isnull=False).filter(edges)
+                                  .values_list('mode', 'start', 'end'))
+    # Adjustments whose "virtual periods" overlap the edges.
+    edges = models.Q(timestamp__gt=tail)
+    for cutoff, head, buckets in windows:
+      edges |= models.Q(timestamp__gte=cutoff) & (
+        models.Q(delta__gte=0, timestamp__lt=head+models.F('delta')) |
+        models.Q(delta__lt=0, timestamp__lt=head-models.F('delta'))
+      )
+    edge_adjustments = (Adjustment.objects.filter(era_id=era_id).filter(edges)
+                                          .values_list('mode', 'delta', 'timestamp'))
+    edge_adjustments = [(mode,)+adjustment_span(delta, timestamp)
+                        for mode, delta, timestamp in edge_adjustments]
+    for (cutoff, head, buckets), totals in zip(windows, all_totals):
+      for mode, start, end in edge_periods:
+        totals[mode] += overlap(start, end, cutoff, head) + overlap(start, end, tail, now)
+      for mode, start, end, sign in edge_adjustments:
+        # Only count the ones made since the cutoff (`end` is when it was made).
+        if end >= cutoff:
+          seconds = overlap(start, end, cutoff, head) + overlap(start, end, tail, now)
+          totals[mode] += sign * seconds
+      # The current Period isn't in the Rollups yet.
+      if snapshot['current'] is not None:
+        mode, start = snapshot['current']
+        totals[mode] += overlap(start, now, cutoff, now)
+    return all_totals
+
+  def _add_to_rollups(self, era, mode, start, end, sign=1):
+    """Add the time from `start` to `end` to the Rollup buckets for `mode` (or subtract it, if
+    `sign` is -1). Call this inside the transaction making the change, with the Era locked."""
+    self._add_spans_to_rollups(era, [(mode, start, end, sign)])
+
+  def _add_spans_to_rollups(self, era, spans):
+    """Add many (mode, start, end, sign) spans of time to the Rollup buckets at once. Call this inside
+    the transaction making the change, with the Era locked, so no one else creates the same buckets
+    at the same time."""
     if era is None:
-      try:
-        era = Era.objects.get(user=self.user, current=True)
-      except Era.DoesNotExist:
-        return bar_periods
-    # Get a list of periods in the last `timespan` seconds.
-    now = int(time.time())
-    cutoff = now - timespan
-    periods = Period.objects.filter(era=era, end__gte=cutoff).order_by('start')
-    n_periods = len(periods)
-    try:
-      current_period = Period.objects.get(era=era, end=None, next=None)
-      n_periods += 1
-    except Period.DoesNotExist:
-      current_period = None
-    logging.info('Found {} periods in last {}.'.format(n_periods, timespan))
-    # Create a list of bars from the periods.
-    last_end = None
-    for period in list(periods) + [current_period]:
-      if period is None:
+      return
+    amounts = collections.defaultdict(int)
+    for mode, start, end, sign in spans:
+      if mode is None or end <= start:
         continue
-      # If we detect a gap between this period and the last one, insert an empty one.
-      if last_end and period.start - last_end > 1:
-        elapsed = period.start - last_end
-        width = round(total_width * elapsed / timespan, 1)
-        bar_periods.append({'mode':None, 'width':width, 'start':last_end, 'end':period.start,
-                            'timespan':format_timespan(elapsed, numbers), 'mode_name':'None'})
-        last_end = period.start
-      if period.start < cutoff:
-        if period.end is None:
-          elapsed = timespan
-        else:
-          elapsed = period.end - cutoff
-      else:
-        elapsed = period.elapsed
-      if period.end is None:
-        end = now
-      else:
-        end = period.end
-      last_end = end
-      width = round(total_width * elapsed / timespan, 1)
-      bar_periods.append({'mode':period.mode, 'width':width, 'start':period.start, 'end':end,
-                          'timespan':format_timespan(period.elapsed, numbers),
-                          'mode_name':get_mode_name(period.mode, self.abbrev)})
-      logging.info('Found {} {} sec long ({}%): {} to {}'
-                   .format(period.mode, period.elapsed, width, period.start, period.end))
-    # Fill in empty gaps at start or end of timespan with empty bars.
-    if len(bar_periods) == 0:
-      bar_periods.append({'mode':None, 'width':total_width, 'start':cutoff, 'end':now,
-                          'timespan':format_timespan(timespan, numbers), 'mode_name':'None'})
+      for size in ROLLUP_SIZES:
+        for bucket, seconds in split_into_buckets(start, end, size):
+          amounts[(mode, size, bucket)] += sign * seconds
+    if not amounts:
+      return
+    modes = set(mode for mode, size, bucket in amounts.keys())
+    min_bucket = min(bucket for mode, size, bucket in amounts.keys())
+    max_bucket = max(bucket for mode, size, bucket in amounts.keys())
+    rollups = Rollup.objects.filter(era=era, mode__in=modes, start__gte=min_bucket,
+                                    start__lte=max_bucket)
+    updated = []
+    for rollup in rollups:
+      seconds = amounts.pop((rollup.mode, rollup.size, rollup.start), None)
+      if seconds is not None:
+        rollup.elapsed += seconds
+        updated.append(rollup)
+    Rollup.objects.bulk_update(updated, ['elapsed'], batch_size=1000)
+    Rollup.objects.bulk_create([Rollup(era=era, mode=mode, size=size, start=bucket, elapsed=seconds)
+                                for (mode, size, bucket), seconds in amounts.items()],
+                               batch_size=1000)
+
+  def rebuild_rollups(self, era, batch_size=1000):
+    """Recompute all the Rollup buckets for `era` from its Periods and Adjustments."""
+    amounts = collections.defaultdict(int)
+    def add(mode, start, end, sign=1):
+      for size in ROLLUP_SIZES:
+        for bucket, seconds in split_into_buckets(start, end, size):
+          amounts[(mode, size, bucket)] += sign * seconds
+    periods = (Period.objects.filter(era=era, end__isnull=False, mode__isnull=False)
+                             .values_list('mode', 'start', 'end'))
+    for mode, start, end in periods.iterator(chunk_size=batch_size):
+      add(mode, start, end)
+    adjustments = Adjustment.objects.filter(era=era).values_list('mode', 'delta', 'timestamp')
+    for mode, delta, timestamp in adjustments.iterator(chunk_size=batch_size):
+      add(mode, *adjustment_span(delta, timestamp))
+    rollups = [Rollup(era=era, mode=mode, size=size, start=bucket, elapsed=seconds)
+               for (mode, size, bucket), seconds in amounts.items() if seconds]
+    with transaction.atomic():
+      Rollup.objects.filter(era=era).delete()
+      Rollup.objects.bulk_create(rollups, batch_size=batch_size)
+    self.invalidate_cache(era)
+    return len(rollups)
+
+
+
+def parse_history(lines):
+  """Parse JSONL `lines` like the ones `format_history()` writes into a series of dicts.
+  Each dict gets a 'line' key with its line number. Raises WorkTimeError on invalid records."""
+  for line_num, line in enumerate(lines, 1):
+    if isinstance(line, bytes):
+      line = line.decode('utf-8')
+    if not line.strip():
+      continue
+    try:
+      record = json.loads(line)
+    except ValueError:
+      raise WorkTimeError('Line {}: Invalid JSON.'.format(line_num))
+    if not isinstance(record, dict):
+      raise WorkTimeError('Line {}: Record must be an object.'.format(line_num))
+    if record.get('type') == 'period':
+      fields = ('start', 'end')
+    elif record.get('type') == 'adjustment':
+      fields = ('delta', 'timestamp')
     else:
-      if bar_periods[0]['start'] > cutoff+10:
-        elapsed = bar_periods[0]['start'] - cutoff
-        width = round(total_width * elapsed / timespan, 1)
-        bar_periods.insert(0, {'mode':None, 'width':width, 'end':bar_periods[0]['start'], 'start':cutoff,
-                               'timespan':format_timespan(elapsed, numbers), 'mode_name':'None'})
-      if bar_periods[-1]['end'] < now-10:
-        elapsed = now - bar_periods[-1]['end']
-        width = round(total_width * elapsed / timespan, 1)
-        bar_periods.append({'mode':None, 'width':width, 'start':bar_periods[-1]['end'], 'end':now,
-                            'timespan':format_timespan(elapsed, numbers), 'mode_name':'None'})
-    # Some post-processing to drop periods that are too small and make sure it all adds up to
-    # total_width.
-    bar_periods = [p for p in bar_periods if p['width'] >= 0.3]
-    total_width = sum([p['width'] for p in bar_periods])
-    if total_width != total_width:
-      diff = min(0.3, total_width - total_width)
-      bar_periods[-1]['width'] = round(bar_periods[-1]['width']+diff, 1)
-    return bar_periods
+      raise WorkTimeError('Line {}: Invalid type {!r}.'.format(line_num, record.get('type')))
+    for field in fields:
+      value = record.get(field)
+      if not isinstance(value, int) or isinstance(value, bool):
+        raise WorkTimeError('Line {}: Invalid {} {!r}.'.format(line_num, field, value))
+    record.setdefault('mode', None)
+    record['line'] = line_num
+    yield record
+
+
+def format_history(records, format='csv', chunk_size=EXPORT_CHUNK_SIZE):
+  """Turn the dicts from `iter_history()` into text in the given `format` ('csv' or 'jsonl').
+  This is a generator which yields the text in chunks of around `chunk_size` characters."""
+  buffer = io.StringIO()
+  if format == 'csv':
+    writer = csv.DictWriter(buffer, EXPORT_FIELDS)
+    writer.writeheader()
+    write = writer.writerow
+  elif format == 'jsonl':
+    write = lambda record: buffer.write(json.dumps(record)+'\n')
+  else:
+    raise ValueError('Invalid export format {!r}.'.format(format))
+  for record in records:
+    write(record)
+    if buffer.tell() >= chunk_size:
+      yield buffer.getvalue()
+      buffer.seek(0)
+      buffer.truncate()
+  if buffer.tell():
+    yield buffer.getvalue()
+
+
+def split_into_buckets(start, end, size):
+  """Split the time from `start` to `end` into the `size`-second buckets it overlaps.
+  Yields (bucket_start, seconds) for each bucket."""
+  bucket = start - start % size
+  while bucket < end:
+    yield bucket, min(end, bucket+size) - max(start, bucket)
+    bucket += size
+
+
+def adjustment_span(delta, timestamp):
+  """Expand an adjustment into a "virtual period" `delta` long, ending when the adjustment was
+  made. Returns (start, end, sign), where `sign` is -1 if `delta` is negative."""
+  if delta < 0:
+    return timestamp+delta, timestamp, -1
+  else:
+    return timestamp-delta, timestamp, 1
+
+
+def clip_totals(periods, adjustments, cutoffs, now):
+  """Total up the time spent in each mode since each of the `cutoffs`.
+  `periods` are (mode, start, end) tuples, where `end` is None for the current one. `adjustments`
+  are (mode, delta, timestamp) tuples. Returns a list of dicts mapping modes to seconds, one for
+  each cutoff. Totals can be negative. This uses NumPy, if it's installed, to clip everything
+  against every cutoff at once."""
+  numpy = import_numpy()
+  if numpy is None or not cutoffs:
+    return clip_totals_python(periods, adjustments, cutoffs, now)
+  all_modes = sorted({period[0] for period in periods} | {adj[0] for adj in adjustments}, key=str)
+  mode_indices = {mode:i for i, mode in enumerate(all_modes)}
+  cutoff_array = numpy.array(cutoffs, dtype=numpy.int64)[:, numpy.newaxis]
+  sums = numpy.zeros((len(cutoffs), len(all_modes)), dtype=numpy.int64)
+  # Which modes had anything inside each timespan (even if it added up to zero).
+  present = numpy.zeros((len(cutoffs), len(all_modes)), dtype=bool)
+  if periods:
+    starts = numpy.array([period[1] for period in periods], dtype=numpy.int64)
+    ends = numpy.array([now if period[2] is None else period[2] for period in periods],
+                       dtype=numpy.int64)
+    onehot = _onehot(numpy, [mode_indices[period[0]] for period in periods], len(all_modes))
+    # Count the part of each period after each cutoff.
+    included = ends >= cutoff_array
+    clipped = numpy.where(included, ends - numpy.maximum(starts, cutoff_array), 0)
+    sums += clipped @ onehot
+    present |= (included.astype(numpy.int64) @ onehot) > 0
+  if adjustments:
+    deltas = numpy.array([adj[1] for adj in adjustments], dtype=numpy.int64)
+    timestamps = numpy.array([adj[2] for adj in adjustments], dtype=numpy.int64)
+    onehot = _onehot(numpy, [mode_indices[adj[0]] for adj in adjustments], len(all_modes))
+    # Count the part of each adjustment's "virtual period" after each cutoff.
+    gaps = timestamps - cutoff_array
+    included = gaps >= 0
+    clipped = numpy.where(included, numpy.sign(deltas) * numpy.minimum(numpy.abs(deltas), gaps), 0)
+    sums += clipped @ onehot
+    present |= (included.astype(numpy.int64) @ onehot) > 0
+  totals = []
+  for c in range(len(cutoffs)):
+    cutoff_totals = collections.defaultdict(int)
+    for mode, i in mode_indices.items():
+      if present[c, i]:
+        cutoff_totals[mode] = int(sums[c, i])
+    totals.append(cutoff_totals)
+  return totals
+
+
+def _onehot(numpy, indices, width):
+  onehot = numpy.zeros((len(indices), width), dtype=numpy.int64)
+  onehot[numpy.arange(len(indices)), indices] = 1
+  return onehot
+
+
+def clip_totals_python(periods, adjustments, cutoffs, now):
+  """The same as `clip_totals()`, without NumPy."""
+  totals = []
+  for c in range(len(cutoffs)):
+    totals.append(collections.defaultdict(int))
+  for mode, start, end in periods:
+    if end is None:
+      elapsed = now - start
+    else:
+      elapsed = end - start
+    for c, cutoff in enumerate(cutoffs):
+      if end is None or end >= cutoff:
+        if start >= cutoff:
+          totals[c][mode] += elapsed
+        else:
+          totals[c][mode] += elapsed - (cutoff-start)
+  #TODO: If an adjustment happened earlier than this cutoff, but during a period that ended after
+  #      it, that might cause unnatural-feeling results. E.g. Maybe I left it on 'w' for an hour,
+  #      but took a 30 min break and forgot to turn it off. So I did an adjustment of -30, but
+  #      then left it on 'w' because I was back. This could possibly make a really weird ratio.
+  for mode, delta, timestamp in adjustments:
+    for c, cutoff in enumerate(cutoffs):
+      if timestamp >= cutoff:
+        # Expand the adjustment backward into a "virtual period" `delta` long, ending when
+        # the adjustment was made. Then, only count the part of this "virtual period" that's
+        # after the cutoff.
+        time_btwn_adj_and_cutoff = timestamp - cutoff
+        if abs(delta) > time_btwn_adj_and_cutoff:
+          sign = int(delta / abs(delta))
+          totals[c][mode] += sign * time_btwn_adj_and_cutoff
+        else:
+          totals[c][mode] += delta
+  return totals
 
-  def _get_recent_adjustments(self, timespan, numbers='values', era=None, total_width=99):
-    """Get data for a display of recent adjustments."""
-    adjustments_data = []
-    # Get current Era.
-    if era is None:
-      try:
-        era = Era.objects.get(user=self.user, current=True)
-      except Era.DoesNotExist:
-        return adjustments_data
-    # Get a list of adjustments in the last `timespan` seconds.
-    now = int(time.time())
-    cutoff = now - timespan
-    adjustments = Adjustment.objects.filter(era=era, timestamp__gte=cutoff).order_by('timestamp')
-    logging.info('Found {} adjustments in last {}.'.format(len(adjustments), timespan))
-    for adjustment in adjustments:
-      if adjustment.delta >= 0:
-        sign = '+'
-      else:
-        sign = '-'
-      x = round(total_width * (adjustment.timestamp-cutoff) / timespan, 1)
-      magnitude = format_timespan(abs(adjustment.delta), numbers, label_smallest=False)
-      adjustments_data.append({'mode':adjustment.mode, 'sign':sign, 'magnitude':magnitude, 'x':x,
-                               'mode_name':get_mode_name(adjustment.mode, self.abbrev),
-                               'timespan':format_timespan(abs(adjustment.delta), numbers)})
-    return adjustments_data
+
+_numpy = None
+_requests = None
+
+def import_numpy():
+  """Import NumPy the first time it's needed, since it's slow to load.
+  Returns None if it's not installed."""
+  global _numpy
+  if _numpy is None:
+    try:
+      import numpy
+      _numpy = numpy
+    except ImportError:
+      _numpy = False
+  return _numpy or None
+
+
+def import_requests():
+  """Import requests the first time it's needed, since it takes longer to load than the rest of
+  the command line script. Returns None if it's not installed."""
+  global _requests
+  if _requests is None:
+    try:
+      import requests
+      _requests = requests
+    except ImportError:
+      _requests = False
+  return _requests or None
+
+
+def overlap(start, end, range_start, range_end):
+  """How many seconds of the time from `start` to `end` falls between `range_start` and
+  `range_end`."""
+  return max(0, min(end, range_end) - max(start, range_start))
+
+
+def get_cache():
+  """Get the Django cache used for summary data.
+  This can be set to a dedicated cache with the WORKTIME_CACHE setting. To bound its size, give
+  that cache a MAX_ENTRIES option (the local-memory backend evicts the least recently used entries
+  first)."""
+  return caches[getattr(django_settings, 'WORKTIME_CACHE', 'default')]
 
 
 class WorkTimesWeb(WorkTimes):
 
   def __init__(self, modes=MODES, hidden=HIDDEN, abbrev=True, api_endpoint=API_ENDPOINT,
                timeout=TIMEOUT, verify=True, cookie=None, status_path=None, log_path=None,
-               summary_path=None):
+               summary_path=None, retries=RETRIES, pool_size=POOL_SIZE, queue_path=None,
+               last_summary_path=None):
+    """If `queue_path` is given, changes made while the website can't be reached are saved there,
+    and sent the next time it can be. Until then, the status is worked out from the last summary
+    the website sent, which is saved to `last_summary_path` (by default, next to the queue)."""
     super().__init__(modes=modes, hidden=hidden, abbrev=abbrev)
     #TODO: Actually support abbrev.
     self.api_endpoint = api_endpoint
     self.timeout = timeout
+    self.retries = retries
     self.verify = verify
     self.cookie = cookie
+    self.session = make_session(verify=verify, cookie=cookie, pool_size=pool_size)
     if isinstance(summary_path, pathlib.Path) or summary_path is None:
       self.summary_path = summary_path
     else:
@@ -980,50 +2572,250 @@ class WorkTimesWeb(WorkTimes):
                                              status_path=status_path, log_path=log_path)
     else:
       self.work_times_files = None
+    self.queue_path = queue_path
+    if queue_path is not None and last_summary_path is None:
+      last_summary_path = queue_path.with_name(LAST_SUMMARY_PATH.name)
+    self.last_summary_path = last_summary_path
     # Cache of current status.
     self._summary = None
+    # The last ETag and response for each url we've gotten, for conditional requests.
+    self._validators = {}
 
   #TODO: Finish implementing rest of the methods.
 
+  def forget(self):
+    # Keep the ETags, so re-fetching an unchanged summary is still cheap.
+    self._summary = None
+
   def clear(self):
     #TODO: Support --sync.
     self._summary = None
+    if self.queue_path is not None:
+      # Changes made before clearing belong to the old era.
+      self._send_with_queue([])
     self._make_request('/clear', method='post', timeout=self.timeout)
 
   def switch_mode(self, new_mode):
     # Override this method from the parent, since it's a special case with web.
-    self.validate_mode(new_mode)
-    # Get the old status.
-    old_mode, old_elapsed = self.get_status()
-    if old_mode == new_mode:
-      return old_mode, None
-    # Make the switch.
-    params = {'mode':new_mode}
-    if self.work_times_files:
+    # Going through /batch gets us the old status and the new summary in the same request.
+    [(old_mode, old_elapsed)] = self.apply_batch([{'type':'switch', 'mode':new_mode}])
+    if self.work_times_files and old_mode != new_mode:
       self.work_times_files.set_status(new_mode)
       #TODO: Sync worklog.txt too.
-    # Invalidate the cache right before the change.
-    self._summary = None
-    self._make_request('/switch', method='post', data=params, timeout=self.timeout)
     return old_mode, old_elapsed
 
   def add_elapsed(self, mode, delta):
     # Override this method in the parent, since it's a special case with web.
     #TODO: Support --sync.
-    self.validate_mode(mode)
+    self.apply_batch([{'type':'adjust', 'mode':mode, 'delta':delta}])
+
+  def apply_batch(self, operations):
+    for operation in operations:
+      self.validate_mode(operation.get('mode'))
     self._summary = None
-    params = {'mode':mode}
-    if delta < 0:
-      params['subtract'] = abs(delta)//60
+    if self.queue_path is None:
+      return self._send_batch(operations)
+    import uuid
+    # Record when each change was made, in case it has to wait in the queue. The id lets the server
+    # recognize it if it's sent more than once.
+    now = int(time.time())
+    operations = [dict(operation, timestamp=now, id=uuid.uuid4().hex) for operation in operations]
+    try:
+      return self._send_with_queue(operations)
+    except WorkTimeOfflineError as error:
+      logging.warning('Could not reach the website ({}). Saved the change to send later.'
+                      .format(error))
+      self._summary, results = self._project_summary()
+      return results[len(results)-len(operations):]
+
+  def _send_batch(self, operations):
+    # Send them all in one request, and keep the summary that comes back.
+    headers = {'Content-Type':'application/json'}
+    ids = [operation.pop('id') for operation in operations if 'id' in operation]
+    if ids:
+      import hashlib
+      # The same operations always get the same key, so if we never heard back about them and send
+      # them again, the server won't apply them twice.
+      headers['Idempotency-Key'] = hashlib.sha256(','.join(ids).encode('ascii')).hexdigest()
+    data = json.dumps({'operations':operations})
+    response = self._make_request('/batch?numbers=values', method='post', format='json', data=data,
+                                  headers=headers, timeout=self.timeout)
+    self._set_summary(response['summary'])
+    return [tuple(result) if result else result for result in response['results']]
+
+  def _send_with_queue(self, operations):
+    """Send any changes waiting in the queue, then the new `operations`, and return the results of
+    the new ones. If the website can't be reached, the new operations are added to the queue and the
+    WorkTimeOfflineError is raised. If it refuses the queued changes, they're moved to a
+    ".rejected" file next to the queue, so they don't block every later change."""
+    with self._locked_queue() as queue_file:
+      queued = self._read_queue(queue_file)
+      try:
+        if queued:
+          # Send the queue on its own, so it's the same request each time it's tried.
+          try:
+            self._send_batch([dict(operation) for operation in queued])
+          except WorkTimeOfflineError:
+            raise
+          except WorkTimeError as error:
+            self._reject_queue(queued, error)
+          else:
+            logging.warning('Sent {} change(s) saved while offline.'.format(len(queued)))
+          queue_file.truncate(0)
+        if operations:
+          return self._send_batch([dict(operation) for operation in operations])
+        return []
+      except WorkTimeOfflineError:
+        self._append_queue(queue_file, operations)
+        raise
+
+  def _reject_queue(self, operations, error):
+    """Set aside queued `operations` the website refused, adding them to the ".rejected" file."""
+    rejected_path = self.queue_path.with_name(self.queue_path.name+'.rejected')
+    try:
+      with rejected_path.open('a') as rejected_file:
+        self._append_queue(rejected_file, operations)
+    except OSError as error:
+      raise WorkTimeError(error)
+    logging.error('The website refused the {} change(s) saved in {} ({}). Moved them to {}.'
+                  .format(len(operations), self.queue_path, error, rejected_path))
+
+  def _has_queue(self):
+    # Check without taking the lock, so it's quick in the usual case.
+    try:
+      return self.queue_path is not None and self.queue_path.stat().st_size > 0
+    except FileNotFoundError:
+      return False
+
+  @contextlib.contextmanager
+  def _locked_queue(self, shared=False):
+    """Hold the lock on the queue file inside this context, and give the open file."""
+    import fcntl
+    try:
+      queue_file = self.queue_path.open('a+')
+    except OSError as error:
+      raise WorkTimeError(error)
+    with queue_file:
+      if shared:
+        fcntl.flock(queue_file, fcntl.LOCK_SH)
+      else:
+        fcntl.flock(queue_file, fcntl.LOCK_EX)
+      yield queue_file
+
+  def _read_queue(self, queue_file):
+    queue_file.seek(0)
+    operations = []
+    for line in queue_file:
+      try:
+        operations.append(json.loads(line))
+      except ValueError:
+        # A write was cut off partway through.
+        logging.warning('Ignoring an invalid line in the queue {!r}.'.format(str(self.queue_path)))
+    return operations
+
+  def _append_queue(self, queue_file, operations):
+    try:
+      for operation in operations:
+        queue_file.write(json.dumps(operation)+'\n')
+      queue_file.flush()
+      os.fsync(queue_file.fileno())
+    except OSError as error:
+      raise WorkTimeError(error)
+
+  def _set_summary(self, summary):
+    """Keep a new `summary` from the website, and save it to work out the status from if the website
+    can't be reached later."""
+    self._summary = summary
+    if self.last_summary_path is None:
+      return
+    temp_path = self.last_summary_path.with_name(self.last_summary_path.name+'.tmp')
+    try:
+      with temp_path.open(mode='w') as summary_file:
+        json.dump({'time':int(time.time()), 'summary':summary}, summary_file)
+      os.replace(temp_path, self.last_summary_path)
+    except OSError as error:
+      logging.warning('Could not save the summary to {!r}: {}'
+                      .format(str(self.last_summary_path), error))
+
+  def _project_summary(self):
+    """Work out what the summary will be once the queued changes reach the website, starting from
+    the last summary it sent. Returns the summary and the result of each queued operation, or
+    (None, []) if there's nothing to go on."""
+    with self._locked_queue(shared=True) as queue_file:
+      queued = self._read_queue(queue_file)
+    try:
+      with self.last_summary_path.open() as summary_file:
+        saved = json.load(summary_file)
+    except (OSError, ValueError):
+      if not queued:
+        return None, []
+      saved = {'time':0, 'summary':{'current_mode':None, 'current_elapsed':None, 'elapsed':[]}}
+    summary = dict(saved['summary'])
+    mode = summary['current_mode']
+    totals = {elapsed['mode']: elapsed['time'] for elapsed in summary['elapsed']}
+    if mode is None or summary['current_elapsed'] is None:
+      start = None
     else:
-      params['add'] = delta//60
-    self._make_request('/adjust', method='post', data=params, timeout=self.timeout)
+      # The elapsed times include the current Period.
+      start = saved['time'] - summary['current_elapsed']
+      totals[mode] = totals.get(mode, 0) - summary['current_elapsed']
+    # Play back the queue, the same way the server will.
+    results = []
+    for operation in queued:
+      if operation['type'] == 'adjust':
+        totals[operation['mode']] = totals.get(operation['mode'], 0) + operation['delta']
+        results.append(None)
+      elif operation['mode'] == mode:
+        results.append((mode, None))
+      elif start is None:
+        results.append((mode, None))
+        mode, start = operation['mode'], operation['timestamp']
+      else:
+        # A switch can't go back before the Period it ends started.
+        timestamp = max(operation['timestamp'], start)
+        if mode is not None:
+          totals[mode] = totals.get(mode, 0) + timestamp - start
+        results.append((mode, timestamp - start))
+        mode, start = operation['mode'], timestamp
+    summary['current_mode'] = mode
+    summary['current_mode_name'] = get_mode_name(mode, abbrev=self.abbrev)
+    if mode is None or start is None:
+      summary['current_elapsed'] = None
+    else:
+      summary['current_elapsed'] = int(time.time()) - start
+      totals[mode] = totals.get(mode, 0) + summary['current_elapsed']
+    elapsed_list = []
+    for elapsed in summary['elapsed']:
+      elapsed_list.append(dict(elapsed, time=totals.pop(elapsed['mode'], 0)))
+    for mode, elapsed in totals.items():
+      elapsed_list.append({'mode':mode, 'time':elapsed})
+    summary['elapsed'] = elapsed_list
+    summary['queued'] = len(queued)
+    return summary, results
 
   def get_summary(self, numbers='values'):
     # Override this method in the parent, since it's a special case with web.
     if self._summary is None:
-      self._summary = self._make_request('?format=json&numbers={}'.format(numbers),
-                                         format='json', timeout=self.timeout)
+      try:
+        if self._has_queue():
+          # Send the changes saved while offline first. The response includes the summary.
+          self._send_with_queue([])
+        if self._summary is None:
+          summary = self._make_request('?format=json&numbers={}'.format(numbers), format='json',
+                                       timeout=self.timeout)
+          if numbers == 'values':
+            self._set_summary(summary)
+          else:
+            self._summary = summary
+      except WorkTimeOfflineError as error:
+        if self.queue_path is None or numbers != 'values':
+          raise
+        summary, results = self._project_summary()
+        if summary is None:
+          raise
+        logging.warning('Could not reach the website ({}). Showing the last status it sent, plus '
+                        '{} change(s) saved since.'.format(error, summary['queued']))
+        self._summary = summary
     if self.work_times_files:
       self.work_times_files.write_summary(self._summary, current_inclusive=True)
     if self.summary_path:
@@ -1046,29 +2838,96 @@ class WorkTimesWeb(WorkTimes):
       all_elapsed[elapsed['mode']] = elapsed['time']
     return all_elapsed
 
+  def export(self, out_file, format='csv'):
+    """Download the full history of the current era and write it to `out_file`.
+    The response is streamed straight to the file, so it's never all in memory."""
+    response = self._make_request('/export?format={}'.format(format), format='response',
+                                  timeout=self.timeout, stream=True)
+    with response:
+      for chunk in response.iter_content(chunk_size=EXPORT_CHUNK_SIZE, decode_unicode=True):
+        out_file.write(chunk)
+
+  def import_history(self, in_file):
+    """Upload the JSONL history in `in_file` to be added to the current era.
+    Returns the number of Periods and Adjustments added."""
+    self._summary = None
+    headers = {'Content-Type':'application/x-ndjson'}
+    result = self._make_request('/import', method='post', format='json', data=in_file,
+                                headers=headers, timeout=self.timeout)
+    return result['periods'], result['adjustments']
+
   def _make_request(self, url_end, method='get', format='text', **kwargs):
-    if 'headers' in kwargs:
-      kwargs['headers']['User-Agent'] = USER_AGENT
+    requests = import_requests()
+    if 'headers' not in kwargs:
+      kwargs['headers'] = {}
+    validator = self._validators.get((url_end, format))
+    if method == 'get' and validator:
+      kwargs['headers']['If-None-Match'] = validator[0]
+    if method == 'post' and 'Idempotency-Key' not in kwargs['headers']:
+      import uuid
+      # This makes retries safe: the server won't make the same change twice.
+      kwargs['headers']['Idempotency-Key'] = str(uuid.uuid4())
+    if hasattr(kwargs.get('data'), 'read'):
+      # We can't rewind a file that's being uploaded to send it again.
+      attempts = 1
     else:
-      kwargs['headers'] = {'User-Agent':USER_AGENT}
-    if not self.verify:
-      kwargs['verify'] = False
-    if self.cookie:
-      kwargs['cookies'] = {COOKIE_NAME:self.cookie}
-    try:
-      if method == 'get':
-        response = requests.get(self.api_endpoint+url_end, **kwargs)
-      elif method == 'post':
-        response = requests.post(self.api_endpoint+url_end, **kwargs)
-    except requests.exceptions.RequestException as error:
-      raise WorkTimeError(error)
-    if response.status_code != 200:
+      attempts = self.retries + 1
+    for attempt in range(attempts):
+      if attempt > 0:
+        delay = RETRY_BACKOFF * 2**(attempt-1)
+        logging.warning('Request for {!r} failed. Retrying in {}s.'.format(url_end, delay))
+        time.sleep(delay)
+      try:
+        if method == 'get':
+          response = self.session.get(self.api_endpoint+url_end, **kwargs)
+        elif method == 'post':
+          response = self.session.post(self.api_endpoint+url_end, **kwargs)
+      except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as error:
+        if attempt+1 < attempts:
+          continue
+        raise WorkTimeOfflineError(error)
+      except requests.exceptions.RequestException as error:
+        raise WorkTimeError(error)
+      if response.status_code not in RETRY_STATUSES:
+        break
+    if response.status_code in OFFLINE_STATUSES:
+      raise WorkTimeOfflineError('Error making request: response code {} ({}).'
+                                 .format(response.status_code, response.reason))
+    if response.status_code == 304 and validator:
+      logging.info('Response for {!r} unchanged.'.format(url_end))
+      return validator[1]
+    if response.status_code == 400 and response.text:
+      # The server explains what was wrong with the request.
+      raise WorkTimeError('Error making request: {}'.format(response.text))
+    elif response.status_code != 200:
       raise WorkTimeError('Error making request: response code {} ({}).'
                           .format(response.status_code, response.reason))
-    if format == 'text':
-      return response.text
+    if format == 'response':
+      return response
+    elif format == 'text':
+      result = response.text
     elif format == 'json':
-      return response.json()
+      result = response.json()
+    if method == 'get' and response.headers.get('ETag'):
+      self._validators[(url_end, format)] = (response.headers['ETag'], result)
+    return result
+
+
+def make_session(verify=True, cookie=None, pool_size=POOL_SIZE):
+  """Make a `requests.Session` which keeps up to `pool_size` connections open, so that requests
+  after the first skip the TCP and TLS handshakes."""
+  requests = import_requests()
+  if requests is None:
+    raise WorkTimeError('The requests module is required to use the website.')
+  session = requests.Session()
+  adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+  session.mount('https://', adapter)
+  session.mount('http://', adapter)
+  session.headers['User-Agent'] = USER_AGENT
+  session.verify = verify
+  if cookie:
+    session.cookies.set(COOKIE_NAME, cookie)
+  return session
 
 
 class WorkTimeError(Exception):
@@ -1086,6 +2945,10 @@ class WorkTimeError(Exception):
     return '{}({})'.format(type(self).__name__, repr(self.data))
 
 
+class WorkTimeOfflineError(WorkTimeError):
+  """The website couldn't be reached, as opposed to it rejecting the request."""
+
+
 def fail(message):
   logging.critical(message)
   if __name__ == '__main__':